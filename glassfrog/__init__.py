@@ -1,12 +1,22 @@
 #!/usr/bin/env python3
-from flask import Flask, json, request, render_template, flash
+from flask import Flask, request, render_template, flash, g
 from flask_sqlalchemy import SQLAlchemy
 import requests
-import re
+import os
 import sys
+import concurrent.futures
+import functools
+import jwt
 
 from .functions import apiCalls
 from .functions import messageFunctions as messageFunctions
+from .functions import rendering
+from .functions import prefetcher
+from .functions import snapshotStore
+from .functions import notificationQueue
+from .functions import jsonCodec
+from .functions import commandRouter
+from .functions.orgGraph import getOrgGraph
 from .strings import *
 from .models import *
 from .settings import config
@@ -14,7 +24,86 @@ from .settings import config
 app = Flask(__name__)
 app.config.from_object(config)
 app.config.from_envvar('HIPFROG_SETTINGS', silent=True)
+if app.config['CACHE_SQLITE_PATH'] is None:
+    app.config['CACHE_SQLITE_PATH'] = os.path.join(app.instance_path, 'hipfrog-cache.sqlite')
 db.init_app(app)
+apiCalls.configure(app.config)
+
+webhookExecutor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=app.config['ASYNC_WEBHOOK_WORKERS'])
+upstreamExecutor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=app.config['UPSTREAM_WORKERS'])
+webhookCommands = commandRouter.CommandRouter()
+snapshotPrefetcher = prefetcher.SnapshotPrefetcher(app)
+if app.config['PREFETCH_ENABLED']:
+    snapshotPrefetcher.start()
+outboundQueue = notificationQueue.NotificationQueue(app)
+if app.config['NOTIFICATION_QUEUE_ENABLED']:
+    outboundQueue.start()
+
+
+def submitUpstream(function, *args, **kwargs):
+    # Runs function on upstreamExecutor, sharing the GlassFrog calls of the current request
+    return upstreamExecutor.submit(apiCalls.runWithMemo, apiCalls.getRequestMemo(), function,
+                                   *args, **kwargs)
+
+
+def sendRoomMessage(color, message, installation, **kwargs):
+    # Queued when NOTIFICATION_QUEUE_ENABLED, otherwise sent right away
+    if app.config['NOTIFICATION_QUEUE_ENABLED']:
+        outboundQueue.enqueue(installation, color, message, **kwargs)
+        return
+    hipchatApiHandler = apiCalls.HipchatApiHandler()
+    hipchatApiHandler.sendMessage(color=color, message=message, installation=installation,
+                                  **kwargs)
+
+
+def jsonResponse(obj):
+    return app.response_class(jsonCodec.dumps(obj), mimetype='application/json')
+
+
+def webhook(view):
+    # Verifies the JWT HipChat signs every webhook with, see VERIFY_WEBHOOK_JWT. The parsed
+    # body is left in g.requestdata for the view.
+    @functools.wraps(view)
+    def verifiedView(*args, **kwargs):
+        if app.config['VERIFY_WEBHOOK_JWT']:
+            authorization = request.headers.get('Authorization', '')
+            if authorization.startswith('JWT '):
+                signed_request = authorization[len('JWT '):]
+            else:
+                signed_request = request.args.get('signed_request', '')
+            try:
+                installation, claims = messageFunctions.verifyJWT(
+                    signed_request, leeway=app.config['JWT_LEEWAY'])
+            except jwt.InvalidTokenError:
+                return ('', 401)
+        try:
+            g.requestdata = jsonCodec.loads(request.get_data())
+        except ValueError:
+            return ('', 400)
+        if not isinstance(g.requestdata, dict):
+            return ('', 400)
+        if app.config['VERIFY_WEBHOOK_JWT'] and \
+                g.requestdata.get('oauth_client_id', claims['iss']) != claims['iss']:
+            return ('', 401)
+        return view(*args, **kwargs)
+    return verifiedView
+
+
+@app.after_request
+def countUpstreamCalls(response):
+    memo = g.get('glassfrogMemo')
+    if memo is not None:
+        upstreamCalls = str(memo.upstreamCalls)
+        if memo.deferred:
+            # Still answering, the memo is recorded when the deferred message is sent
+            upstreamCalls += '+'
+        else:
+            apiCalls.recordRequestMemo(memo)
+        if app.config['CACHE_STATS_ENABLED']:
+            response.headers['X-Glassfrog-Upstream-Calls'] = upstreamCalls
+    return response
 
 
 @app.route('/')
@@ -26,14 +115,15 @@ def home():
 
 @app.route('/capabilities.json')
 def capabilities():
-    capabilities_dict = apiCalls.getCapabilitiesDict(app.config['PUBLIC_URL'])
-    return json.jsonify(capabilities_dict)
+    capabilities_dict = apiCalls.getCapabilitiesDict(app.config['PUBLIC_URL'],
+                                                     app.config['CONSOLIDATED_WEBHOOK'])
+    return jsonResponse(capabilities_dict)
 
 
 @app.route('/installed', methods=['GET', 'POST'])
 def installed():
     if request.method == 'POST':
-        installdata = json.loads(request.get_data())
+        installdata = jsonCodec.loads(request.get_data())
 
         installation = Installation(oauthId=installdata['oauthId'],
                                     capabilitiesUrl=installdata['capabilitiesUrl'],
@@ -61,11 +151,13 @@ def installed():
 
         db.session.add(installation)
         db.session.commit()
+        apiCalls.invalidateRoom(installation)
+        messageFunctions.invalidateInstallation(installation.oauthId)
 
         # Pointless query on the installation object to make sure it is still around for testing...
         installation.id
 
-        hipchatApiHandler.sendMessage(
+        sendRoomMessage(
             color=strings.succes_color,
             message=strings.installed_successfully,
             installation=installation)
@@ -75,12 +167,47 @@ def installed():
 @app.route('/installed/<oauthId>', methods=['DELETE'])
 def uninstall(oauthId):
     installation = Installation.query.filter_by(oauthId=oauthId).first()
+    glassfrogToken = installation.glassfrogToken
+    apiCalls.invalidateRoom(installation)
     db.session.delete(installation)
     db.session.commit()
+    messageFunctions.invalidateInstallation(oauthId)
+    snapshotStore.deleteSnapshots(glassfrogToken)
     # TODO why are they not uninstalled?
     return ('', 200)
 
 
+def getLinkListFragments(kind, items):
+    # Yields comma separated links to the GlassFrog pages of items
+    for index, item in enumerate(items):
+        yield '{0}<a href="https://app.glassfrog.com/{1}/{2}">{3}</a>'.format(
+            ', ' if index > 0 else '', kind, str(item['id']), item['name'])
+
+
+def getCircleTreeFragments(orgGraph, circleIds, maxDepth=None, depth=0, visited=None):
+    # Yields the nested list of circles below circleIds, down to maxDepth levels of subcircles
+    if visited is None:
+        visited = set()
+    for circleId in circleIds:
+        circle = orgGraph.getCircle(circleId)
+        if circle is None or circleId in visited:
+            continue
+        visited.add(circleId)
+        yield ('<li><a href="https://app.glassfrog.com/circles/{0}">{1}</a>'
+               ).format(str(circle.id), circle.name)
+        children = orgGraph.getChildren(circleId)
+        if children != []:
+            if maxDepth is not None and depth >= maxDepth:
+                yield subcircles_not_listed.format(len(children))
+            else:
+                yield '<ul>'
+                for fragment in getCircleTreeFragments(orgGraph, children, maxDepth, depth + 1,
+                                                       visited):
+                    yield fragment
+                yield '</ul>'
+        yield '</li>'
+
+
 def getCircles(glassfrogToken):
     apiEndpoint = 'circles'
     glassfrogApiHandler = apiCalls.GlassfrogApiHandler()
@@ -88,45 +215,19 @@ def getCircles(glassfrogToken):
                                                               glassfrogToken)
 
     if code == 200:
-        message = 'The following circles are in your organization:<br /><ul>'
-
-        def getSubCircles(circleId):
-            sub_circle_hierarchy = {}
-            for supported_role in responsebody['linked']['supported_roles']:
-                if supported_role['links']['circle'] == circleId:
-                    sub_circleId = supported_role['links']['supporting_circle']
-                    sub_circle_hierarchy[sub_circleId] = getSubCircles(sub_circleId)
-            return sub_circle_hierarchy
-
-        circle_hierarchy = {}
-
-        for supported_role in responsebody['linked']['supported_roles']:
-            if supported_role['links']['circle'] is None:
-                sub_circleId = supported_role['links']['supporting_circle']
-                circle_hierarchy[sub_circleId] = getSubCircles(sub_circleId)
-
-        def getCircleWithId(circleId):
-            for circle in responsebody['circles']:
-                if circle['id'] == circleId:
-                    return circle
-
-        def getCircleMessage(circle_hierarchy):
-            message = ''
-            for circleId in circle_hierarchy:
-                circle = getCircleWithId(circleId)
-                message += ('<li><a href="https://app.glassfrog.com/circles/{0}">{1}</a>'
-                            ).format(str(circle['id']), circle['name'])
-                if circle_hierarchy[circleId] != {}:
-                    message += '<ul>'
-                    message += getCircleMessage(circle_hierarchy[circleId])
-                    message += '</ul>'
-                message += '</li>'
-            return message
-
-        message += '</ul>'
-
-        message += getCircleMessage(circle_hierarchy)
-        message += strings.help_hipfrog_circle
+        orgGraph = getOrgGraph(glassfrogToken, responsebody)
+
+        def getCirclesFragments():
+            yield 'The following circles are in your organization:<br /><ul>'
+            yield '</ul>'
+            for fragment in getCircleTreeFragments(orgGraph, orgGraph.getAnchorCircles(),
+                                                   app.config['CIRCLE_TREE_MAX_DEPTH']):
+                yield fragment
+
+        message = rendering.joinFragments(getCirclesFragments(),
+                                          app.config['HIPCHAT_MESSAGE_LIMIT'],
+                                          suffix=help_hipfrog_circle,
+                                          truncatedMessage=message_truncated)
     else:
         message = responsebody['message']
 
@@ -143,8 +244,9 @@ def getIdForCircleIdentifier(glassfrogToken, circleIdentifier):
         success = True
 
         if code == 200:
+            orgGraph = getOrgGraph(glassfrogToken, responsebody)
             circleId = messageFunctions.getMatchingCircle(
-                responsebody['circles'], circleIdentifier)
+                orgGraph.circleList, circleIdentifier)
             if circleId == -999:  # no match
                 message = no_circle_matched.format(circleIdentifier)
                 success = False
@@ -185,7 +287,9 @@ def getIdForRoleIdentifier(glassfrogToken, roleIdentifier):
                                                                   glassfrogToken)
 
         if code == 200:
-            roleId = messageFunctions.getMatchingRole(responsebody['roles'], roleIdentifier)
+            # The organization's roles are cached as an OrgSnapshot, a circle's as its payload
+            roles = responsebody.roles if apiEndpoint == 'roles' else responsebody['roles']
+            roleId = messageFunctions.getMatchingRole(roles, roleIdentifier)
             if roleId == -999:  # no match
                 message = no_role_matched.format(roleIdentifier)
                 success = False
@@ -249,12 +353,18 @@ def getCircleCircleId(glassfrogToken, circleId):
                 domain_list += ['{}'.format(domain['description'])]
             domains += ' ' + ', '.join(domain_list)
             message_list += [domains]
-        # Parent circle
-        # TODO add circle name
-        if responsebody['linked']['supported_roles'][0]['links']['circle'] is not None:
+        # Parent circle, named from the (cached) circles of the organization
+        parentId = responsebody['linked']['supported_roles'][0]['links']['circle']
+        if parentId is not None:
+            parentLabel = 'Parent circle'
+            circlesCode, circlesResponsebody = glassfrogApiHandler.glassfrogApiCall(
+                'circles', glassfrogToken)
+            if circlesCode == 200:
+                parentCircle = getOrgGraph(glassfrogToken, circlesResponsebody).getCircle(parentId)
+                if parentCircle is not None:
+                    parentLabel += ' - {}'.format(parentCircle.name)
             message_list += [('<strong><a href="https://app.glassfrog.com/circles/{}">'
-                              'Parent circle</a></strong>').format(
-                responsebody['linked']['supported_roles'][0]['links']['circle'])]
+                              '{}</a></strong>').format(parentId, parentLabel)]
         # Follow up links
         message_list += [strings.help_hipfrog_circle_circleid.format(
             messageFunctions.makeMentionName(responsebody['circles'][0]['name']))]
@@ -296,7 +406,6 @@ def getCircleRoles(glassfrogToken, circleId):
 
         subcircles = []
         roles = []
-        message = ""
 
         for role in sorted(responsebody['roles'], key=lambda k: k['name']):
             if role['links']['supporting_circle'] is not None:
@@ -304,30 +413,27 @@ def getCircleRoles(glassfrogToken, circleId):
             else:
                 roles += [role]
 
+        def getCircleRolesFragments():
+            if subcircles != []:
+                yield '<strong>Subcircles:</strong> '
+                for fragment in getLinkListFragments('roles', subcircles):
+                    yield fragment
+                yield '<br />'
+            if roles != []:
+                yield '<strong>Roles:</strong> '
+                for fragment in getLinkListFragments('roles', roles):
+                    yield fragment
+                yield '<br />'
+
+        more = "<strong>More:</strong><ul>"
         if subcircles != []:
-            message += '<strong>Subcircles:</strong> '
-            subcircle_list = []
-            for subcircle in subcircles:
-                subcircle_list += [('<a href="https://app.glassfrog.com/roles/{0}">{1}</a>'
-                                    ).format(str(subcircle['id']), subcircle['name'])]
-            message += ', '.join(subcircle_list)
-            message += '<br />'
-
+            more += help_hipfrog_circle_circleid_subcircles
         if roles != []:
-            message += '<strong>Roles:</strong> '
-            role_list = []
-            for role in roles:
-                role_list += [('<a href="https://app.glassfrog.com/roles/{0}">{1}</a>'
-                               ).format(str(role['id']), role['name'])]
-            message += ', '.join(role_list)
-            message += '<br />'
-
-        message += "<strong>More:</strong><ul>"
-        if subcircles != []:
-            message += help_hipfrog_circle_circleid_subcircles
-        if roles != []:
-            message += help_hipfrog_circle_circleid_roles
-        message += "</ul>"
+            more += help_hipfrog_circle_circleid_roles
+        more += "</ul>"
+        message = rendering.joinFragments(getCircleRolesFragments(),
+                                          app.config['HIPCHAT_MESSAGE_LIMIT'],
+                                          suffix=more, truncatedMessage=message_truncated)
     else:
         message = responsebody['message']
 
@@ -341,332 +447,447 @@ def getRoleRoleId(glassfrogToken, roleId):
                                                               glassfrogToken)
 
     if code == 200:
-        message_list = []
-        # Title with role name
-        message_list += [('<strong><a href="https://app.glassfrog.com/roles/{}">Role -'
-                          ' {}</a></strong><br/>').format(
-                          roleId, responsebody['roles'][0]['name'])]
-        # Purpose
-        if responsebody['roles'][0]['purpose'] is not None:
-            message_list += ['<strong>Purpose:</strong> {}'.format(
-                responsebody['roles'][0]['purpose'])]
-        # Domains
-        if responsebody['linked']['domains'] != []:
-            if len(responsebody['linked']['domains']) > 1:
-                domains = '<strong>Domains:</strong>'
-            else:
-                domains = '<strong>Domain:</strong>'
-            domain_list = []
-            for domain in responsebody['linked']['domains']:
-                domain_list += ['{}'.format(domain['description'])]
-            domains += ' ' + ', '.join(domain_list)
-            message_list += [domains]
-        # Circle
-        if responsebody['linked']['circles'] != []:
-            message_list += [('<strong>Circle:</strong> '
-                              '<a href="https://app.glassfrog.com/circles/{0}">{1}</a>').format(
-                responsebody['linked']['circles'][0]['id'],
-                responsebody['linked']['circles'][0]['name'])]
-        # People
-        if responsebody['linked']['people'] != []:
-            if len(responsebody['linked']['people']) > 1:
-                people = '<strong>People:</strong> '
-            else:
-                people = '<strong>Person:</strong> '
-            person_list = []
-            for person in responsebody['linked']['people']:
-                person_list += [('<a href="https://app.glassfrog.com/people/{0}">{1}</a>'
-                                 ).format(str(person['id']), person['name'])]
-            people += ', '.join(person_list)
-            message_list += [people]
-        # Accountabilities
-        if responsebody['linked']['accountabilities'] != []:
-            if len(responsebody['linked']['accountabilities']) > 1:
-                accountabilities = '<strong>Accountabilities:</strong><ul>'
-            else:
-                accountabilities = '<strong>Accountability:</strong> '
-            for accountability in responsebody['linked']['accountabilities']:
-                if len(responsebody['linked']['accountabilities']) > 1:
-                    accountabilities += '<li>'
-                accountabilities += '{}'.format(accountability['description'])
-                if len(responsebody['linked']['accountabilities']) > 1:
-                    accountabilities += '</li>'
-            if len(responsebody['linked']['accountabilities']) > 1:
-                accountabilities += '</ul>'
-            message_list += [accountabilities]
-        message_list += [help_hipfrog_role_roleid.format(
-                messageFunctions.makeMentionName(responsebody['linked']['circles'][0]['name']),
-                messageFunctions.makeMentionName(responsebody['roles'][0]['name'])
-            )]
-        # Joining with new lines
-        message = '<br/>'.join(message_list)
+        role = responsebody['roles'][0]
+        linked = responsebody['linked']
+
+        def getRoleFragments():
+            # Title with role name, the other sections each on a new line
+            yield ('<strong><a href="https://app.glassfrog.com/roles/{}">Role -'
+                   ' {}</a></strong><br/>').format(roleId, role['name'])
+            # Purpose
+            if role['purpose'] is not None:
+                yield '<br/><strong>Purpose:</strong> {}'.format(role['purpose'])
+            # Domains
+            if linked['domains'] != []:
+                if len(linked['domains']) > 1:
+                    yield '<br/><strong>Domains:</strong> '
+                else:
+                    yield '<br/><strong>Domain:</strong> '
+                for index, domain in enumerate(linked['domains']):
+                    yield '{}{}'.format(', ' if index > 0 else '', domain['description'])
+            # Circle
+            if linked['circles'] != []:
+                yield ('<br/><strong>Circle:</strong> '
+                       '<a href="https://app.glassfrog.com/circles/{0}">{1}</a>').format(
+                    linked['circles'][0]['id'], linked['circles'][0]['name'])
+            # People
+            if linked['people'] != []:
+                if len(linked['people']) > 1:
+                    yield '<br/><strong>People:</strong> '
+                else:
+                    yield '<br/><strong>Person:</strong> '
+                for fragment in getLinkListFragments('people', linked['people']):
+                    yield fragment
+            # Accountabilities
+            if len(linked['accountabilities']) > 1:
+                yield '<br/><strong>Accountabilities:</strong><ul>'
+                for accountability in linked['accountabilities']:
+                    yield '<li>{}</li>'.format(accountability['description'])
+                yield '</ul>'
+            elif linked['accountabilities'] != []:
+                yield '<br/><strong>Accountability:</strong> {}'.format(
+                    linked['accountabilities'][0]['description'])
+
+        more = '<br/>' + help_hipfrog_role_roleid.format(
+            messageFunctions.makeMentionName(linked['circles'][0]['name']),
+            messageFunctions.makeMentionName(role['name']))
+        message = rendering.joinFragments(getRoleFragments(),
+                                          app.config['HIPCHAT_MESSAGE_LIMIT'],
+                                          suffix=more, truncatedMessage=message_truncated)
     else:
         message = responsebody['message']
 
     return code, message
 
 
-@app.route('/hipfrog', methods=['GET', 'POST'])
-def hipfrog():
-    requestdata = json.loads(request.get_data())
-    callingMessage = requestdata['item']['message']['message'].lower().split()
-    oauthId = requestdata['oauth_client_id']
-    installation = messageFunctions.getInstallationFromOauthId(oauthId)
+def getMentionList(names, mentionNames):
+    mention_list = []
+    for name in names:
+        if name in mentionNames:
+            mention_list += ['@'+mentionNames[name]]
+        else:
+            mention_list += [name]
+    return mention_list
 
-    if installation.glassfrogToken is None:
-        message = strings.set_token_first
-        message_dict = messageFunctions.createMessageDict(strings.error_color, message)
-    elif len(callingMessage) == 1:
-        message = strings.help_hipfrog
-        message_dict = messageFunctions.createMessageDict(strings.succes_color, message)
-    elif len(callingMessage) > 1:
-        # /hipfrog something
-        message = strings.missing_functionality.format(callingMessage[1])
-        message_dict = messageFunctions.createMessageDict(strings.error_color, message)
-    # TODO Generate message_dict and color here
-    return json.jsonify(message_dict)
 
+def getUniqueIds(itemIds):
+    # Ids in their first order, whether they were given as numbers or as text
+    uniqueIds = []
+    seen = set()
+    for itemId in itemIds:
+        if str(itemId) not in seen:
+            seen.add(str(itemId))
+            uniqueIds += [itemId]
+    return uniqueIds
 
-def getMentionsForRole(installation, roleId):
-    glassfrogApiHandler = apiCalls.GlassfrogApiHandler()
 
-    # get role details
-    apiEndpoint = 'roles/{}'.format(roleId)
-    code, role_responsebody = glassfrogApiHandler.glassfrogApiCall(
-        apiEndpoint, installation.glassfrogToken)
-    if code != 200:
-        message = role_responsebody['message']
-        return code, message
+def getMentionsMessage(labels, names, room_future):
+    # Single line naming every role or circle, each person mentioned once
+    message = "{}: ".format(", ".join(labels))
+    if names != []:
+        # Get names of people in room
+        room_code, mentionNames = room_future.result()
+        message += ", ".join(getMentionList(names, mentionNames))
+    else:
+        message += "(not fullfilled)"
+    return message
 
-    role_names = []
 
-    message = "{} in {}: ".format(
-        role_responsebody['roles'][0]['name'], role_responsebody['linked']['circles'][0]['name'])
+def getMentionsForRoles(installation, roleIds):
+    glassfrogApiHandler = apiCalls.GlassfrogApiHandler()
+    hipchatApiHandler = apiCalls.HipchatApiHandler()
 
-    if role_responsebody['linked']['people'] != []:
+    # Details of all roles and the room members are fetched concurrently, the room once
+    role_futures = [submitUpstream(glassfrogApiHandler.glassfrogApiCall,
+                                   'roles/{}'.format(roleId), installation.glassfrogToken)
+                    for roleId in getUniqueIds(roleIds)]
+    room_future = submitUpstream(
+        hipchatApiHandler.getRoomMentionNames, installation=installation)
+
+    labels = []
+    role_names = []
+    for role_future in role_futures:
+        code, role_responsebody = role_future.result()
+        if code != 200:
+            message = role_responsebody['message']
+            return code, message
+        labels += ["{} in {}".format(role_responsebody['roles'][0]['name'],
+                                     role_responsebody['linked']['circles'][0]['name'])]
         # Get names of people in role
         for person in role_responsebody['linked']['people']:
-            role_names += [person['name']]
-        # Get names of people in room
-        hipchatApiHandler = apiCalls.HipchatApiHandler()
-        room_code, room_members = hipchatApiHandler.getRoomMembers(installation=installation)
+            if person['name'] not in role_names:
+                role_names += [person['name']]
 
-        mention_list = []
+    return code, getMentionsMessage(labels, role_names, room_future)
 
-        for role_name in role_names:
-            inroom = False
-            for room_member in room_members['items']:
-                if room_member['name'] == role_name:
-                    mention_list += ['@'+room_member['mention_name']]
-                    inroom = True
-                    break
-            if not inroom:
-                mention_list += [role_name]
 
-        message += ", ".join(mention_list)
-    else:
-        message += "(not fullfilled)"
-
-    return code, message
+def getMentionsForRole(installation, roleId):
+    return getMentionsForRoles(installation, [roleId])
 
 
-def getMentionsForCircle(installation, circleId):
+def getMentionsForCircles(installation, circleIds):
     glassfrogApiHandler = apiCalls.GlassfrogApiHandler()
+    hipchatApiHandler = apiCalls.HipchatApiHandler()
+
+    # The (cached) circles of the organization, the members of all circles and the room
+    # members are fetched concurrently. Only circles the organization does not list yet
+    # have their details fetched for their name.
+    circleIds = getUniqueIds(circleIds)
+    circles_future = submitUpstream(
+        glassfrogApiHandler.glassfrogApiCall, 'circles', installation.glassfrogToken)
+    members_futures = [submitUpstream(glassfrogApiHandler.glassfrogApiCall,
+                                      'circles/{}/people'.format(circleId),
+                                      installation.glassfrogToken)
+                       for circleId in circleIds]
+    room_future = submitUpstream(
+        hipchatApiHandler.getRoomMentionNames, installation=installation)
+
+    circlesCode, circlesResponsebody = circles_future.result()
+    orgGraph = None
+    if circlesCode == 200:
+        orgGraph = getOrgGraph(installation.glassfrogToken, circlesResponsebody)
+    circle_futures = {}
+    for circleId in circleIds:
+        if orgGraph is None or orgGraph.getCircle(int(circleId)) is None:
+            circle_futures[circleId] = submitUpstream(
+                glassfrogApiHandler.getCircleForCircleId, circleId, installation.glassfrogToken)
+
+    labels = []
+    circle_names = []
+    for circleId, members_future in zip(circleIds, members_futures):
+        if circleId in circle_futures:
+            code, circle_responsebody = circle_futures[circleId].result()
+            if code != 200:
+                message = circle_responsebody['message']
+                return code, message
+            labels += [circle_responsebody['circles'][0]['name']]
+        else:
+            labels += [orgGraph.getCircle(int(circleId)).name]
 
-    # Get circle details
-    code, circle_responsebody = glassfrogApiHandler.getCircleForCircleId(
-        circleId, installation.glassfrogToken)
-    if code != 200:
-        message = circle_responsebody['message']
-        return code, message
+        code, members_responsebody = members_future.result()
+        if code != 200:
+            message = members_responsebody['message']
+            return code, message
+        # Get names of people in circle
+        for person in members_responsebody['people']:
+            if person['name'] not in circle_names:
+                circle_names += [person['name']]
 
-    # Get circle members
-    apiEndpoint = 'circles/{}/people'.format(circleId)
-    code, members_responsebody = glassfrogApiHandler.glassfrogApiCall(
-        apiEndpoint, installation.glassfrogToken)
-    if code != 200:
-        message = members_responsebody['message']
-        return code, message
+    return code, getMentionsMessage(labels, circle_names, room_future)
 
-    circle_names = []
 
-    message = "{}: ".format(circle_responsebody['circles'][0]['name'])
+def getMentionsForCircle(installation, circleId):
+    return getMentionsForCircles(installation, [circleId])
 
-    if members_responsebody['people'] != []:
-        # Get names of people in circle
-        for person in members_responsebody['people']:
-            circle_names += [person['name']]
-        # Get names of people in room
-        hipchatApiHandler = apiCalls.HipchatApiHandler()
-        room_code, room_members = hipchatApiHandler.getRoomMembers(installation=installation)
 
-        mention_list = []
+def webhookResponse(message_dict):
+    # None when the answers were already sent to the room
+    if message_dict is None:
+        return ('', 204)
+    return jsonResponse(message_dict)
 
-        for circle_name in circle_names:
-            inroom = False
-            for room_member in room_members['items']:
-                if room_member['name'] == circle_name:
-                    mention_list += ['@'+room_member['mention_name']]
-                    inroom = True
-                    break
-            if not inroom:
-                mention_list += [circle_name]
 
-        message += ", ".join(mention_list)
-    else:
-        message += "(not fullfilled)"
+def respondWithinBudget(route, installation, getMessageDict):
+    # Routes listed in ASYNC_WEBHOOK_ROUTES answer the webhook with an empty response once
+    # ASYNC_WEBHOOK_BUDGET seconds have passed, and post the message to the room when it is ready
+    if route not in app.config['ASYNC_WEBHOOK_ROUTES']:
+        return webhookResponse(getMessageDict())
 
-    return code, message
+    memo = apiCalls.getRequestMemo()
 
+    def runInAppContext():
+        with app.app_context():
+            return apiCalls.runWithMemo(memo, getMessageDict)
 
-@app.route('/atrole', methods=['GET', 'POST'])
-def atRole():
-    requestdata = json.loads(request.get_data())
-    callingMessage = requestdata['item']['message']['message']
+    future = webhookExecutor.submit(runInAppContext)
+    try:
+        return webhookResponse(future.result(timeout=app.config['ASYNC_WEBHOOK_BUDGET']))
+    except concurrent.futures.TimeoutError:
+        memo.deferred = True
+        future.add_done_callback(lambda done: sendDeferredMessage(done, installation, memo))
+        return ('', 204)
+
+
+def sendDeferredMessage(future, installation, memo=None):
+    if memo is not None:
+        apiCalls.recordRequestMemo(memo)
+    try:
+        message_dict = future.result()
+    except Exception:
+        app.logger.exception('Deferred webhook response failed')
+        message_dict = messageFunctions.createMessageDict(strings.error_color,
+                                                          strings.deferred_response_failed)
+    if message_dict is None:
+        return
+    sendRoomMessage(
+        color=message_dict['color'],
+        message=message_dict['message'],
+        installation=installation,
+        message_format=message_dict['message_format'])
+
+
+def handleCommand(commandName=None):
+    # Shared by the webhook routes: parses the message and dispatches the command of the
+    # route, or without a commandName every command in the message
+    requestdata = g.requestdata
     oauthId = requestdata['oauth_client_id']
     installation = messageFunctions.getInstallationFromOauthId(oauthId)
 
-    message_format = 'html'
-
     if installation.glassfrogToken is None:
         message = strings.set_token_first
         message_dict = messageFunctions.createMessageDict(strings.error_color, message)
+        return jsonResponse(message_dict)
+    callingMessage = requestdata['item']['message']['message']
+    if commandName is not None:
+        commands = [commandRouter.getCommand(callingMessage, commandName)]
     else:
-        try:
-            roleIdentifier = re.search(strings.regex_at_role_roleId, callingMessage).group(1)
+        commands = list(commandRouter.parseMessage(callingMessage).values())
+        if commands == []:
+            return ('', 204)
+    asyncRoutes = [command.name for command in commands
+                   if command.name in app.config['ASYNC_WEBHOOK_ROUTES']]
+    return respondWithinBudget(asyncRoutes[0] if asyncRoutes else commands[0].name,
+                               installation,
+                               lambda: getCommandsMessageDict(commands, installation,
+                                                              requestdata))
+
+
+def getCommandsMessageDict(commands, installation, requestdata):
+    message_dicts = [webhookCommands.dispatch(command, installation, requestdata)
+                     for command in commands]
+    if len(message_dicts) == 1:
+        return message_dicts[0]
+    # A webhook has room for one answer, several are sent to the room in order
+    for message_dict in message_dicts:
+        sendRoomMessage(
+            color=message_dict['color'],
+            message=message_dict['message'],
+            installation=installation,
+            message_format=message_dict['message_format'])
+    return None
+
+
+@webhookCommands.handles('hipfrog')
+def getHipfrogMessageDict(command, installation, requestdata):
+    if command.arguments == []:
+        message = strings.help_hipfrog
+        return messageFunctions.createMessageDict(strings.succes_color, message)
+    # /hipfrog something
+    message = strings.missing_functionality.format(command.arguments[0])
+    return messageFunctions.createMessageDict(strings.error_color, message)
+
+
+@app.route('/hipfrog', methods=['GET', 'POST'])
+@webhook
+def hipfrog():
+    return handleCommand('hipfrog')
+
+
+@webhookCommands.handles('atrole')
+def getAtRoleMessageDict(command, installation, requestdata):
+    callingMessage = requestdata['item']['message']['message']
+    message_format = 'html'
+
+    # Every role mentioned in the message is answered in one /cc line
+    roleIdentifiers = getUniqueIds(command.identifiers)
+    if roleIdentifiers == []:
+        code = 404
+        message = ("Please specify a role name after @role.")
+    else:
+        roleIds = []
+        for roleIdentifier in roleIdentifiers:
             # Convert roleIdentifier to roleId if needed
             success, roleId, message = getIdForRoleIdentifier(
                 installation.glassfrogToken, roleIdentifier)
             if not success:
-                code = 404
-            else:
-                code, mentions = getMentionsForRole(installation, roleId)
-                from_mention = requestdata['item']['message']['from']['mention_name']
-                message = '@'+from_mention+' said: '+callingMessage+' /cc '+mentions
-                message_format = "text"
-        except AttributeError:
+                break
+            roleIds += [roleId]
+        if not success:
             code = 404
-            message = ("Please specify a role name after @role.")
+        else:
+            code, mentions = getMentionsForRoles(installation, roleIds)
+            from_mention = requestdata['item']['message']['from']['mention_name']
+            message = '@'+from_mention+' said: '+callingMessage+' /cc '+mentions
+            message_format = "text"
 
-        color = strings.succes_color if code == 200 else strings.error_color
-        message_dict = messageFunctions.createMessageDict(color, message, message_format)
-    return json.jsonify(message_dict)
+    color = strings.succes_color if code == 200 else strings.error_color
+    return messageFunctions.createMessageDict(color, message, message_format)
 
 
-@app.route('/atcircle', methods=['GET', 'POST'])
-def atCircle():
-    requestdata = json.loads(request.get_data())
-    callingMessage = requestdata['item']['message']['message']
-    oauthId = requestdata['oauth_client_id']
-    installation = messageFunctions.getInstallationFromOauthId(oauthId)
+@app.route('/atrole', methods=['GET', 'POST'])
+@webhook
+def atRole():
+    return handleCommand('atrole')
+
 
+@webhookCommands.handles('atcircle')
+def getAtCircleMessageDict(command, installation, requestdata):
+    callingMessage = requestdata['item']['message']['message']
     message_format = 'html'
 
-    if installation.glassfrogToken is None:
-        message = strings.set_token_first
-        message_dict = messageFunctions.createMessageDict(strings.error_color, message)
+    # Every circle mentioned in the message is answered in one /cc line
+    circleIdentifiers = getUniqueIds(command.identifiers)
+    if circleIdentifiers == []:
+        code = 404
+        message = ("Please specify a circle name after @circle.")
     else:
-        try:
-            circleIdentifier = re.search(strings.regex_at_circle_circleId, callingMessage).group(1)
+        circleIds = []
+        for circleIdentifier in circleIdentifiers:
             # Convert circleIdentifier to circleId if needed
             success, circleId, message = getIdForCircleIdentifier(
                 installation.glassfrogToken, circleIdentifier)
             if not success:
-                code = 404
-            else:
-                code, mentions = getMentionsForCircle(installation, circleId)
-                from_mention = requestdata['item']['message']['from']['mention_name']
-                message = '@'+from_mention+' said: '+callingMessage+' /cc '+mentions
-                message_format = "text"
-        except AttributeError:
+                break
+            circleIds += [circleId]
+        if not success:
             code = 404
-            message = ("Please specify a circle name after @circle.")
+        else:
+            code, mentions = getMentionsForCircles(installation, circleIds)
+            from_mention = requestdata['item']['message']['from']['mention_name']
+            message = '@'+from_mention+' said: '+callingMessage+' /cc '+mentions
+            message_format = "text"
 
-        color = strings.succes_color if code == 200 else strings.error_color
-        message_dict = messageFunctions.createMessageDict(color, message, message_format)
-    return json.jsonify(message_dict)
+    color = strings.succes_color if code == 200 else strings.error_color
+    return messageFunctions.createMessageDict(color, message, message_format)
 
 
-@app.route('/slashcircle', methods=['GET', 'POST'])
-def slashCircle():
-    requestdata = json.loads(request.get_data())
-    callingMessage = requestdata['item']['message']['message'].lower().split()
-    oauthId = requestdata['oauth_client_id']
-    installation = messageFunctions.getInstallationFromOauthId(oauthId)
+@app.route('/atcircle', methods=['GET', 'POST'])
+@webhook
+def atCircle():
+    return handleCommand('atcircle')
 
-    if installation.glassfrogToken is None:
-        message = strings.set_token_first
-        message_dict = messageFunctions.createMessageDict(strings.error_color, message)
-    elif len(callingMessage) > 1:
-        circleIdentifier = callingMessage[1]
-        # Convert circleIdentifier to circleId if needed
-        success, circleId, message = getIdForCircleIdentifier(
-            installation.glassfrogToken, circleIdentifier)
-        if not success:
-            message_dict = messageFunctions.createMessageDict(strings.error_color, message)
-        else:
-            if len(callingMessage) > 2:
-                if callingMessage[2] == 'people' or callingMessage[2] == 'members':
-                    # /[circles, circle] [circleId] [people, members]
-                    code, message = getCircleMembers(installation.glassfrogToken, circleId)
-                    color = strings.succes_color if code == 200 else strings.error_color
-                    message_dict = messageFunctions.createMessageDict(color,
-                                                                      message)
-                elif callingMessage[2] == 'roles':
-                    # /[circles, circle] [circleId] roles
-                    code, message = getCircleRoles(installation.glassfrogToken, circleId)
-                    color = strings.succes_color if code == 200 else strings.error_color
-                    message_dict = messageFunctions.createMessageDict(color,
-                                                                      message)
-                else:
-                    # /[circles, circle] [circleId] something
-                    message = strings.circles_missing_functionality.format(
-                        callingMessage[2], circleIdentifier)
-                    message_dict = messageFunctions.createMessageDict(strings.error_color,
-                                                                      message)
-            else:
-                # /[circles, circle] [circleId]
-                code, message = getCircleCircleId(installation.glassfrogToken, circleId)
-                color = strings.succes_color if code == 200 else strings.error_color
-                message_dict = messageFunctions.createMessageDict(color, message)
-    else:
+
+# /[circles, circle] [circleId] subcommand, the functions are looked up on every call
+circleSubcommands = {'people': getCircleMembers,
+                     'members': getCircleMembers,
+                     'roles': getCircleRoles}
+
+
+@webhookCommands.handles('slashcircle')
+def getSlashCircleMessageDict(command, installation, requestdata):
+    if command.arguments == []:
         # /[circles, circle]
         code, message = getCircles(installation.glassfrogToken)
-        message_dict = messageFunctions.createMessageDict(strings.succes_color, message)
+        return messageFunctions.createMessageDict(strings.succes_color, message)
+
+    circleIdentifier = command.arguments[0]
+    # Convert circleIdentifier to circleId if needed
+    success, circleId, message = getIdForCircleIdentifier(
+        installation.glassfrogToken, circleIdentifier)
+    if not success:
+        return messageFunctions.createMessageDict(strings.error_color, message)
+
+    if len(command.arguments) > 1:
+        subcommand = circleSubcommands.get(command.arguments[1])
+        if subcommand is None:
+            # /[circles, circle] [circleId] something
+            message = strings.circles_missing_functionality.format(
+                command.arguments[1], circleIdentifier)
+            return messageFunctions.createMessageDict(strings.error_color, message)
+        code, message = subcommand(installation.glassfrogToken, circleId)
+    else:
+        # /[circles, circle] [circleId]
+        code, message = getCircleCircleId(installation.glassfrogToken, circleId)
+    color = strings.succes_color if code == 200 else strings.error_color
+    return messageFunctions.createMessageDict(color, message)
 
-    return json.jsonify(message_dict)
+
+@app.route('/slashcircle', methods=['GET', 'POST'])
+@webhook
+def slashCircle():
+    return handleCommand('slashcircle')
+
+
+@webhookCommands.handles('slashrole')
+def getSlashRoleMessageDict(command, installation, requestdata):
+    if command.arguments == []:
+        # /[roles, role]
+        message = strings.help_hipfrog_role
+        return messageFunctions.createMessageDict(strings.succes_color, message)
+
+    roleIdentifier = command.arguments[0]
+    # Convert roleIdentifier to roleId if needed
+    success, roleId, message = getIdForRoleIdentifier(
+        installation.glassfrogToken, roleIdentifier)
+    if not success:
+        return messageFunctions.createMessageDict(strings.error_color, message)
+    # /[roles, role] [roleId]
+    code, message = getRoleRoleId(installation.glassfrogToken, roleId)
+    color = strings.succes_color if code == 200 else strings.error_color
+    return messageFunctions.createMessageDict(color, message)
 
 
 @app.route('/slashrole', methods=['GET', 'POST'])
+@webhook
 def slashRole():
-    requestdata = json.loads(request.get_data())
-    callingMessage = requestdata['item']['message']['message'].lower().split()
-    oauthId = requestdata['oauth_client_id']
-    installation = messageFunctions.getInstallationFromOauthId(oauthId)
+    return handleCommand('slashrole')
+
+
+@app.route('/command', methods=['GET', 'POST'])
+@webhook
+def command():
+    # The single webhook of CONSOLIDATED_WEBHOOK, for any command
+    return handleCommand()
+
+
+@app.route('/cachestats')
+def cacheStats():
+    if not app.config['CACHE_STATS_ENABLED']:
+        return ('', 404)
+    cacheStats = apiCalls.getCacheStats()
+    cacheStats['prefetcher'] = snapshotPrefetcher.stats()
+    cacheStats['notifications'] = outboundQueue.stats()
+    return jsonResponse(cacheStats)
 
-    if installation.glassfrogToken is None:
-        message = strings.set_token_first
-        message_dict = messageFunctions.createMessageDict(strings.error_color, message)
-    elif len(callingMessage) > 1:
-        roleIdentifier = callingMessage[1]
-        # Convert roleIdentifier to roleId if needed
-        success, roleId, message = getIdForRoleIdentifier(
-            installation.glassfrogToken, roleIdentifier)
-        if not success:
-            message_dict = messageFunctions.createMessageDict(strings.error_color, message)
-        else:
-            # /[roles, role] [roleId]
-            code, message = getRoleRoleId(installation.glassfrogToken, roleId)
-            color = strings.succes_color if code == 200 else strings.error_color
-            message_dict = messageFunctions.createMessageDict(color, message)
-    else:
-        # TODO give help message for /role
-        # /[roles, role]
-        # code, message = getRoles(installation.glassfrogToken)
-        # message_dict = messageFunctions.createMessageDict(strings.succes_color, message)
-        pass
 
-    return json.jsonify(message_dict)
+@app.route('/roomchanged', methods=['POST'])
+@webhook
+def roomChanged():
+    # room_enter and room_exit events change who can be mentioned
+    installation = messageFunctions.getInstallationFromOauthId(g.requestdata['oauth_client_id'])
+    if installation is not None:
+        apiCalls.invalidateRoom(installation)
+    return ('', 204)
 
 
 @app.route('/configure.html', methods=['GET', 'POST'])
@@ -674,14 +895,21 @@ def configure():
     installation = messageFunctions.getInstallationFromJWT(request.args['signed_request'])
 
     if request.method == 'POST':
+        # The installation is a detached snapshot, so update the row directly
+        previousToken = installation.glassfrogToken
         installation.glassfrogToken = request.form['glassfrogtoken']
+        Installation.query.filter_by(oauthId=installation.oauthId).update(
+            {'glassfrogToken': installation.glassfrogToken})
         db.session.commit()
+        apiCalls.invalidateRoom(installation)
+        messageFunctions.invalidateInstallation(installation.oauthId)
+        if previousToken != installation.glassfrogToken:
+            snapshotStore.deleteSnapshots(previousToken)
 
         code, message = getCircles(installation.glassfrogToken)
         if code == 200:
             flashmessage = strings.configured_successfully_flash
-            hipchatApiHandler = apiCalls.HipchatApiHandler()
-            hipchatApiHandler.sendMessage(
+            sendRoomMessage(
                         color=strings.succes_color,
                         message=strings.configured_successfully,
                         installation=installation)
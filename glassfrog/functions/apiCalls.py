@@ -1,22 +1,210 @@
-from flask import json, url_for
+from flask import url_for
+from urllib.parse import urlparse
+import concurrent.futures
+import hashlib
 import requests
+import threading
 
+from . import jsonCodec
+from . import messageFunctions
+from . import orgModels
 from .messageFunctions import createMessageDict
+from .caching import TTLCache, SingleFlight, configureCache, getRequestMemo, runWithMemo
+from .caching import encodeValue, decodeValue
+from .circuitBreaker import CircuitBreaker
 import glassfrog.strings as strings
 
+glassfrogApiUrl = 'https://glassfrog.holacracy.org/api/v3/'
+
+
+class SessionPool(object):
+    # One keep-alive requests.Session per upstream host, shared by all handlers.
+    # The urllib3 connection pool behind each session is thread-safe.
+    def __init__(self, poolsize=10, timeout=(3.05, 10)):
+        self.poolsize = poolsize
+        self.timeout = timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def configure(self, poolsize=None, timeout=None):
+        if poolsize is not None and poolsize != self.poolsize:
+            self.poolsize = poolsize
+            self.close()
+        if timeout is not None:
+            self.timeout = timeout
+
+    def getSession(self, url):
+        parsedUrl = urlparse(url)
+        host = '{}://{}'.format(parsedUrl.scheme, parsedUrl.netloc)
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                        pool_maxsize=self.poolsize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+            return session
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.getSession(url).get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.getSession(url).post(url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+httpSessions = SessionPool()
+
+# Successful GlassFrog responses, keyed on (glassfrogToken, apiEndpoint)
+glassfrogResponseCache = TTLCache()
+
+# GlassFrog requests in flight, keyed on (glassfrogToken, apiEndpoint)
+glassfrogFlights = SingleFlight()
+
+# Consecutive GlassFrog failures, keyed on glassfrogToken
+glassfrogCircuitBreaker = CircuitBreaker()
+
+# Refreshes expired GlassFrog responses after they have been served
+revalidationExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+_revalidating = set()
+
+# Conditional GlassFrog requests answered with 304, or with an unchanged body
+conditionalStats = {'notModified': 0, 'unchanged': 0}
+_conditionalStatsLock = threading.Lock()
+_revalidatingLock = threading.Lock()
+
+# Room privacy and room rosters, keyed on (hipchatApiProvider_url, roomId)
+roomPrivacyCache = TTLCache(ttl=300)
+roomRosterCache = TTLCache(ttl=30)
+
+# GlassFrog calls of all requests answered so far
+requestMemoStats = {'requests': 0, 'calls': 0, 'hits': 0, 'upstreamCalls': 0}
+_requestMemoLock = threading.Lock()
+
 
 class GlassfrogApiHandler(object):
-    def __init__(self):
-        pass
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else glassfrogResponseCache
+
+    def glassfrogApiCall(self, apiEndpoint, glassfrogToken, refresh=False):
+        # refresh: skip the cached response and replace it with a live one
+        memo = getRequestMemo()
+        if memo is None or refresh:
+            return self.getGlassfrogResponse(apiEndpoint, glassfrogToken, refresh)
+        # Within a request every endpoint is asked for once
+        return memo.do((glassfrogToken, apiEndpoint),
+                       lambda: self.getGlassfrogResponse(apiEndpoint, glassfrogToken))
+
+    def getGlassfrogResponse(self, apiEndpoint, glassfrogToken, refresh=False):
+        cacheKey = (glassfrogToken, apiEndpoint)
+        if not refresh:
+            cached = self.cache.get(cacheKey)
+            if cached is not None:
+                return cached[:2]
+            # An expired response is served at once and refreshed in the background
+            stale = self.cache.getStale(cacheKey)
+            if stale is not None:
+                if glassfrogCircuitBreaker.isFailing(glassfrogToken):
+                    markStale()
+                self.revalidate(apiEndpoint, glassfrogToken)
+                return stale[:2]
+        return self.fetchGlassfrog(apiEndpoint, glassfrogToken)
+
+    def fetchGlassfrog(self, apiEndpoint, glassfrogToken):
+        memo = getRequestMemo()
+
+        def request():
+            # Only the request that actually calls GlassFrog counts it
+            if memo is not None:
+                memo.countUpstream()
+            return self.requestGlassfrog(apiEndpoint, glassfrogToken)
+        # Concurrent fetches of the same endpoint share a single request
+        return glassfrogFlights.do((glassfrogToken, apiEndpoint), request)
 
-    def glassfrogApiCall(self, apiEndpoint, glassfrogToken):
+    def requestGlassfrog(self, apiEndpoint, glassfrogToken):
+        if not glassfrogCircuitBreaker.allow(glassfrogToken):
+            return 503, {'message': strings.glassfrog_unavailable}
+
+        # The last good response, if any, makes this a conditional request
+        cacheKey = (glassfrogToken, apiEndpoint)
+        previous = self.cache.peek(cacheKey)
         headers = {'X-Auth-Token': glassfrogToken}
-        apiUrl = 'https://glassfrog.holacracy.org/api/v3/'+apiEndpoint
-        apiResponse = requests.get(apiUrl, headers=headers)
+        if previous is not None:
+            validators = previous[2]
+            if validators['etag'] is not None:
+                headers['If-None-Match'] = validators['etag']
+            if validators['lastModified'] is not None:
+                headers['If-Modified-Since'] = validators['lastModified']
+
+        apiUrl = glassfrogApiUrl+apiEndpoint
+        try:
+            apiResponse = httpSessions.get(apiUrl, headers=headers)
+        except requests.RequestException:
+            glassfrogCircuitBreaker.recordFailure(glassfrogToken)
+            return 503, {'message': strings.glassfrog_unavailable}
         code = apiResponse.status_code
-        responsebody = json.loads(apiResponse.text)
+
+        if code == 304 and previous is not None:
+            glassfrogCircuitBreaker.recordSuccess(glassfrogToken)
+            recordConditional('notModified')
+            self.cache.set(cacheKey, previous)
+            return previous[:2]
+
+        # Without validators an identical body still reuses the parsed response, so the
+        # org graph and name indexes built on it stay valid
+        contentHash = hashlib.sha1(apiResponse.content).hexdigest()
+        if code == 200 and previous is not None and previous[2]['contentHash'] == contentHash:
+            responsebody = previous[1]
+            recordConditional('unchanged')
+        else:
+            try:
+                responsebody = jsonCodec.loads(apiResponse.content)
+            except ValueError:
+                glassfrogCircuitBreaker.recordFailure(glassfrogToken)
+                return 502, {'message': strings.glassfrog_invalid_response.format(code)}
+            if code == 200 and apiEndpoint in orgModels.snapshotEndpoints:
+                # Cached for every organization, so only the records the handlers read are kept
+                try:
+                    responsebody = orgModels.OrgSnapshot(apiEndpoint, responsebody)
+                except (KeyError, TypeError):
+                    glassfrogCircuitBreaker.recordFailure(glassfrogToken)
+                    return 502, {'message': strings.glassfrog_invalid_response.format(code)}
+
+        if code >= 500 or code == 429:
+            glassfrogCircuitBreaker.recordFailure(glassfrogToken)
+        else:
+            glassfrogCircuitBreaker.recordSuccess(glassfrogToken)
+        if code == 200:
+            validators = {'etag': apiResponse.headers.get('ETag'),
+                          'lastModified': apiResponse.headers.get('Last-Modified'),
+                          'contentHash': contentHash}
+            self.cache.set(cacheKey, (code, responsebody, validators))
         return code, responsebody
 
+    def revalidate(self, apiEndpoint, glassfrogToken):
+        cacheKey = (glassfrogToken, apiEndpoint)
+        with _revalidatingLock:
+            if cacheKey in _revalidating:
+                return
+            _revalidating.add(cacheKey)
+
+        def fetch():
+            try:
+                self.fetchGlassfrog(apiEndpoint, glassfrogToken)
+            finally:
+                with _revalidatingLock:
+                    _revalidating.discard(cacheKey)
+        revalidationExecutor.submit(fetch)
+
     def getCircleForCircleId(self, circleId, glassfrogToken):
         apiEndpoint = 'circles/{}'.format(circleId)
         code, responsebody = self.glassfrogApiCall(apiEndpoint, glassfrogToken)
@@ -28,44 +216,211 @@ class HipchatApiHandler(object):
         pass
 
     def getCapabilitiesData(self, capabilitiesUrl):
-        return json.loads(requests.get(capabilitiesUrl).text)
+        return jsonCodec.loads(httpSessions.get(capabilitiesUrl).content)
 
     def getTokenData(self, tokenUrl, client_auth, post_data):
-        return json.loads(requests.post(tokenUrl, auth=client_auth, data=post_data).text)
+        return jsonCodec.loads(
+            httpSessions.post(tokenUrl, auth=client_auth, data=post_data).content)
 
-    def sendMessage(self, color, message, installation):
+    def sendMessage(self, color, message, installation, message_format="html"):
         messageUrl = '{}/room/{}/notification'.format(installation.hipchatApiProvider_url,
                                                       installation.roomId)
         token_header = {"Authorization": "Bearer "+installation.access_token}
-        data = createMessageDict(color, message)
-        messageresponse = requests.post(messageUrl,
-                                        headers=token_header,
-                                        data=data)
+        data = createMessageDict(color, message, message_format)
+        messageresponse = httpSessions.post(messageUrl,
+                                            headers=token_header,
+                                            data=data)
+        return messageresponse
 
-    def getRoomMembers(self, installation):
-        token_header = {"Authorization": "Bearer "+installation.access_token}
+    def getRoomPrivacy(self, installation):
+        roomKey = (installation.hipchatApiProvider_url, installation.roomId)
+        privacy = roomPrivacyCache.get(roomKey)
+        if privacy is not None:
+            return 200, privacy
 
+        token_header = {"Authorization": "Bearer "+installation.access_token}
         requestUrl = '{}/room/{}'.format(installation.hipchatApiProvider_url,
                                          installation.roomId)
-        messageresponse = requests.get(requestUrl, headers=token_header)
+        messageresponse = httpSessions.get(requestUrl, headers=token_header)
 
         if messageresponse.status_code != 200:
-            return messageresponse.status_code, json.loads(messageresponse.text)
+            return messageresponse.status_code, jsonCodec.loads(messageresponse.content)
+
+        privacy = jsonCodec.loads(messageresponse.content)['privacy']
+        roomPrivacyCache.set(roomKey, privacy)
+        return 200, privacy
+
+    def getRoomRoster(self, installation):
+        # Returns code, room members response and a name -> mention_name dict
+        roomKey = (installation.hipchatApiProvider_url, installation.roomId)
+        roster = roomRosterCache.get(roomKey)
+        if roster is not None:
+            return roster
 
-        privacy = json.loads(messageresponse.text)['privacy']
+        code, privacy = self.getRoomPrivacy(installation)
+        if code != 200:
+            return code, privacy, {}
 
+        token_header = {"Authorization": "Bearer "+installation.access_token}
         if privacy == 'public':
             requestUrl = '{}/room/{}/participant'.format(installation.hipchatApiProvider_url,
                                                          installation.roomId)
         elif privacy == 'private':
             requestUrl = '{}/room/{}/member'.format(installation.hipchatApiProvider_url,
                                                     installation.roomId)
-        messageresponse = requests.get(requestUrl, headers=token_header)
+        messageresponse = httpSessions.get(requestUrl, headers=token_header)
+        code = messageresponse.status_code
+        room_members = jsonCodec.loads(messageresponse.content)
+
+        mentionNames = {}
+        if code == 200:
+            for room_member in room_members['items']:
+                mentionNames.setdefault(room_member['name'], room_member['mention_name'])
+            roomRosterCache.set(roomKey, (code, room_members, mentionNames))
+        return code, room_members, mentionNames
+
+    def getRoomMembers(self, installation):
+        code, room_members, mentionNames = self.getRoomRoster(installation)
+        return code, room_members
+
+    def getRoomMentionNames(self, installation):
+        code, room_members, mentionNames = self.getRoomRoster(installation)
+        return code, mentionNames
+
+
+def markStale():
+    # Messages created for the current request mention that GlassFrog could not be reached,
+    # also when the stale response was read on one of its upstream threads
+    memo = getRequestMemo()
+    if memo is not None:
+        memo.stale = True
+
+
+def recordConditional(name):
+    with _conditionalStatsLock:
+        conditionalStats[name] += 1
+
+
+def recordRequestMemo(memo):
+    with _requestMemoLock:
+        requestMemoStats['requests'] += 1
+        for name, count in memo.stats().items():
+            requestMemoStats[name] += count
+
+
+def encodeResponse(value):
+    # A cached (code, responsebody, validators), an OrgSnapshot as the payload it was built from
+    code, responsebody, validators = value
+    if isinstance(responsebody, orgModels.OrgSnapshot):
+        return encodeValue({'snapshot': responsebody.apiEndpoint, 'code': code,
+                            'responsebody': responsebody.toResponse(), 'validators': validators})
+    return encodeValue(value)
+
+
+def decodeResponse(data):
+    value = decodeValue(data)
+    if isinstance(value, dict):
+        return (value['code'], orgModels.OrgSnapshot(value['snapshot'], value['responsebody']),
+                value['validators'])
+    return value
+
+
+def invalidateRoom(installation):
+    roomKey = (installation.hipchatApiProvider_url, installation.roomId)
+    roomPrivacyCache.invalidate(roomKey)
+    roomRosterCache.invalidate(roomKey)
+
 
-        return messageresponse.status_code, json.loads(messageresponse.text)
+def configure(config):
+    global glassfrogApiUrl, glassfrogResponseCache, roomPrivacyCache, roomRosterCache
+    glassfrogApiUrl = config['GLASSFROG_API_URL']
+    jsonCodec.configure(config)
+    httpSessions.configure(poolsize=config['HTTP_POOL_SIZE'],
+                           timeout=(config['HTTP_CONNECT_TIMEOUT'], config['HTTP_READ_TIMEOUT']))
+    glassfrogResponseCache = configureCache(glassfrogResponseCache, config, 'glassfrog',
+                                            ttl=config['GLASSFROG_CACHE_TTL'],
+                                            maxsize=config['GLASSFROG_CACHE_SIZE'],
+                                            stale=config['GLASSFROG_STALE_TTL'],
+                                            encode=encodeResponse, decode=decodeResponse)
+    glassfrogCircuitBreaker.configure(threshold=config['CIRCUIT_BREAKER_THRESHOLD'],
+                                      resetTimeout=config['CIRCUIT_BREAKER_RESET'])
+    roomPrivacyCache = configureCache(roomPrivacyCache, config, 'roomPrivacy',
+                                      ttl=config['ROOM_PRIVACY_TTL'],
+                                      maxsize=config['ROOM_CACHE_SIZE'])
+    roomRosterCache = configureCache(roomRosterCache, config, 'roomRoster',
+                                     ttl=config['ROOM_ROSTER_TTL'],
+                                     maxsize=config['ROOM_CACHE_SIZE'])
+    messageFunctions.installationCache = configureCache(
+        messageFunctions.installationCache, config, 'installation',
+        ttl=config['INSTALLATION_CACHE_TTL'], maxsize=config['INSTALLATION_CACHE_SIZE'],
+        encode=messageFunctions.encodeInstallation, decode=messageFunctions.decodeInstallation)
 
 
-def getCapabilitiesDict(publicUrl):
+def getCacheStats():
+    with _conditionalStatsLock:
+        conditional = dict(conditionalStats)
+    with _requestMemoLock:
+        requestMemo = dict(requestMemoStats)
+    return {'glassfrog': glassfrogResponseCache.stats(),
+            'glassfrogCircuits': glassfrogCircuitBreaker.stats(),
+            'glassfrogFlights': glassfrogFlights.stats(),
+            'glassfrogConditional': conditional,
+            'requestMemo': requestMemo,
+            'roomPrivacy': roomPrivacyCache.stats(),
+            'roomRoster': roomRosterCache.stats(),
+            'installation': messageFunctions.installationCache.stats()}
+
+
+def getCapabilitiesDict(publicUrl, consolidatedWebhook=False):
+    if consolidatedWebhook:
+        # HipChat posts every message with a command once, the /command route answers them all
+        commandWebhooks = [
+            {
+                "event": "room_message",
+                "pattern": strings.regex_any_command,
+                "url": publicUrl+"/command",
+                "name": "Command webhook",
+                "authentication": "jwt"
+            }
+        ]
+    else:
+        commandWebhooks = [
+            {
+                "event": "room_message",
+                "pattern": strings.regex_hipfrog,
+                "url": publicUrl+"/hipfrog",
+                "name": "Hipfrog webhook",
+                "authentication": "jwt"
+            },
+            {
+                "event": "room_message",
+                "pattern": strings.regex_at_role,
+                "url": publicUrl+"/atrole",
+                "name": "At Role webhook",
+                "authentication": "jwt"
+            },
+            {
+                "event": "room_message",
+                "pattern": strings.regex_at_circle,
+                "url": publicUrl+"/atcircle",
+                "name": "At Circle webhook",
+                "authentication": "jwt"
+            },
+            {
+                "event": "room_message",
+                "pattern": strings.regex_slash_role,
+                "url": publicUrl+"/slashrole",
+                "name": "Slash Role webhook",
+                "authentication": "jwt"
+            },
+            {
+                "event": "room_message",
+                "pattern": strings.regex_slash_circle,
+                "url": publicUrl+"/slashcircle",
+                "name": "Slash Circle webhook",
+                "authentication": "jwt"
+            }
+        ]
     capabilities_dict = \
         {
             "name": "HipFrog",
@@ -96,40 +451,17 @@ def getCapabilitiesDict(publicUrl):
                     "allowRoom": True,
                     "callbackUrl": publicUrl+"/installed"
                 },
-                "webhook": [
-                    {
-                        "event": "room_message",
-                        "pattern": strings.regex_hipfrog,
-                        "url": publicUrl+"/hipfrog",
-                        "name": "Hipfrog webhook",
-                        "authentication": "jwt"
-                    },
-                    {
-                        "event": "room_message",
-                        "pattern": strings.regex_at_role,
-                        "url": publicUrl+"/atrole",
-                        "name": "At Role webhook",
-                        "authentication": "jwt"
-                    },
-                    {
-                        "event": "room_message",
-                        "pattern": strings.regex_at_circle,
-                        "url": publicUrl+"/atcircle",
-                        "name": "At Circle webhook",
-                        "authentication": "jwt"
-                    },
+                "webhook": commandWebhooks + [
                     {
-                        "event": "room_message",
-                        "pattern": strings.regex_slash_role,
-                        "url": publicUrl+"/slashrole",
-                        "name": "Slash Role webhook",
+                        "event": "room_enter",
+                        "url": publicUrl+"/roomchanged",
+                        "name": "Room enter webhook",
                         "authentication": "jwt"
                     },
                     {
-                        "event": "room_message",
-                        "pattern": strings.regex_slash_circle,
-                        "url": publicUrl+"/slashcircle",
-                        "name": "Slash Circle webhook",
+                        "event": "room_exit",
+                        "url": publicUrl+"/roomchanged",
+                        "name": "Room exit webhook",
                         "authentication": "jwt"
                     }
                 ],
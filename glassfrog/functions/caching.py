@@ -0,0 +1,469 @@
+from collections import OrderedDict
+import concurrent.futures
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from flask import g, has_request_context
+
+from . import jsonCodec
+
+# The request memo of the threads working for a request, see runWithMemo
+_memoThread = threading.local()
+
+
+class TTLCache(object):
+    # Bounded LRU cache whose entries expire ttl seconds after being stored. Expired
+    # entries stay available to getStale() for another stale seconds.
+    def __init__(self, ttl=60, maxsize=256, stale=0):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.stale = stale
+        self.hits = 0
+        self.misses = 0
+        self.staleHits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, ttl=None, maxsize=None, stale=None):
+        with self._lock:
+            if ttl is not None:
+                self.ttl = ttl
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if stale is not None:
+                self.stale = stale
+            self._evict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                storedAt, value = entry
+                age = time.monotonic() - storedAt
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                if age >= self.ttl + self.stale:
+                    del self._entries[key]
+            self.misses += 1
+            return default
+
+    def getStale(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                storedAt, value = entry
+                if time.monotonic() - storedAt < self.ttl + self.stale:
+                    self._entries.move_to_end(key)
+                    self.staleHits += 1
+                    return value
+                del self._entries[key]
+            return default
+
+    def peek(self, key, default=None):
+        # Like getStale, without counting or refreshing the entry's position
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl + self.stale:
+                return entry[1]
+            return default
+
+    def set(self, key, value, age=0):
+        # age: seconds since value was fetched
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() - age, value)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.staleHits = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'staleHits': self.staleHits,
+                    'size': len(self._entries),
+                    'maxsize': self.maxsize,
+                    'ttl': self.ttl,
+                    'stale': self.stale}
+
+    def _evict(self):
+        while len(self._entries) > max(self.maxsize, 0):
+            self._entries.popitem(last=False)
+
+
+def openPrivateFile(path):
+    # Creates path readable by this user only, and refuses a file someone else created
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    try:
+        fileStat = os.fstat(fd)
+        if fileStat.st_uid != os.getuid():
+            raise PermissionError('{} is not owned by this user'.format(path))
+        if fileStat.st_mode & 0o077:
+            os.fchmod(fd, 0o600)
+    finally:
+        os.close(fd)
+
+
+def encodeValue(value):
+    # Entries are stored as JSON, a tuple is marked so that it reads back as one
+    if isinstance(value, tuple):
+        return jsonCodec.dumps({'tuple': list(value)})
+    return jsonCodec.dumps({'value': value})
+
+
+def decodeValue(data):
+    stored = jsonCodec.loads(data)
+    if 'tuple' in stored:
+        return tuple(stored['tuple'])
+    return stored['value']
+
+
+class SQLiteStore(object):
+    # Serialized cache entries in a SQLite file that all worker processes on a host share.
+    # Entries beyond maxbytes in total, or beyond a namespace's maxsize, are evicted
+    # oldest first.
+    def __init__(self, path, maxbytes=64 * 1024 * 1024):
+        self.path = path
+        self.maxbytes = maxbytes
+        self._local = threading.local()
+        openPrivateFile(path)
+        self.connect().executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                storedAt REAL NOT NULL,
+                PRIMARY KEY (namespace, key));
+            CREATE INDEX IF NOT EXISTS entriesStoredAt ON entries (storedAt);
+        ''')
+
+    def connect(self):
+        # One connection per thread and process
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def getStoredAt(self, namespace, key):
+        row = self.connect().execute(
+            'SELECT storedAt FROM entries WHERE namespace = ? AND key = ?',
+            (namespace, key)).fetchone()
+        return row[0] if row is not None else None
+
+    def get(self, namespace, key):
+        return self.connect().execute(
+            'SELECT storedAt, value FROM entries WHERE namespace = ? AND key = ?',
+            (namespace, key)).fetchone()
+
+    def set(self, namespace, key, value, storedAt, maxsize):
+        connection = self.connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute(
+                'INSERT OR REPLACE INTO entries (namespace, key, value, size, storedAt) '
+                'VALUES (?, ?, ?, ?, ?)', (namespace, key, value, len(value), storedAt))
+            connection.execute(
+                'DELETE FROM entries WHERE namespace = ? AND key IN (SELECT key FROM entries '
+                'WHERE namespace = ? ORDER BY storedAt DESC, rowid DESC LIMIT -1 OFFSET ?)',
+                (namespace, namespace, maxsize))
+            totalSize, = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries'
+                                            ).fetchone()
+            if totalSize > self.maxbytes:
+                connection.execute(
+                    'DELETE FROM entries WHERE rowid IN (SELECT rowid FROM (SELECT rowid, '
+                    'SUM(size) OVER (ORDER BY storedAt DESC, rowid DESC ROWS UNBOUNDED PRECEDING) '
+                    'AS keptSize FROM entries) '
+                    'WHERE keptSize > ?)', (self.maxbytes,))
+
+    def delete(self, namespace, key):
+        self.connect().execute('DELETE FROM entries WHERE namespace = ? AND key = ?',
+                               (namespace, key))
+
+    def clear(self, namespace):
+        self.connect().execute('DELETE FROM entries WHERE namespace = ?', (namespace,))
+
+    def stats(self, namespace):
+        return self.connect().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE namespace = ?',
+            (namespace,)).fetchone()
+
+
+class SharedCache(object):
+    # TTLCache counterpart on a SQLiteStore. Values are stored as encode(value) returns them,
+    # and the last value read per key is kept so that unchanged entries return the same
+    # object without decoding.
+    def __init__(self, store, namespace, ttl=60, maxsize=256, stale=0, encode=encodeValue,
+                 decode=decodeValue):
+        self.store = store
+        self.namespace = namespace
+        self.encode = encode
+        self.decode = decode
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.stale = stale
+        self.hits = 0
+        self.misses = 0
+        self.staleHits = 0
+        self._loaded = OrderedDict()  # key -> (storedAt, value)
+        self._lock = threading.Lock()
+
+    def configure(self, ttl=None, maxsize=None, stale=None):
+        with self._lock:
+            if ttl is not None:
+                self.ttl = ttl
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if stale is not None:
+                self.stale = stale
+
+    def load(self, key, maxAge):
+        storeKey = json.dumps(key)
+        storedAt = self.store.getStoredAt(self.namespace, storeKey)
+        if storedAt is None:
+            return None
+        age = time.time() - storedAt
+        if age >= self.ttl + self.stale:
+            self.store.delete(self.namespace, storeKey)
+            return None
+        if age >= maxAge:
+            return None
+        with self._lock:
+            loaded = self._loaded.get(key)
+            if loaded is not None and loaded[0] == storedAt:
+                self._loaded.move_to_end(key)
+                return loaded
+        row = self.store.get(self.namespace, storeKey)
+        if row is None:
+            return None
+        try:
+            loaded = (row[0], self.decode(row[1]))
+        except (ValueError, TypeError, KeyError):
+            # Not written by this version, read as missing
+            self.store.delete(self.namespace, storeKey)
+            return None
+        with self._lock:
+            self._loaded[key] = loaded
+            while len(self._loaded) > max(self.maxsize, 0):
+                self._loaded.popitem(last=False)
+        return loaded
+
+    def get(self, key, default=None):
+        loaded = self.load(key, self.ttl)
+        with self._lock:
+            if loaded is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return loaded[1]
+
+    def getStale(self, key, default=None):
+        loaded = self.load(key, self.ttl + self.stale)
+        if loaded is None:
+            return default
+        with self._lock:
+            self.staleHits += 1
+        return loaded[1]
+
+    def peek(self, key, default=None):
+        loaded = self.load(key, self.ttl + self.stale)
+        return loaded[1] if loaded is not None else default
+
+    def set(self, key, value, age=0):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        storedAt = time.time() - age
+        self.store.set(self.namespace, json.dumps(key), self.encode(value), storedAt,
+                       self.maxsize)
+        with self._lock:
+            self._loaded[key] = (storedAt, value)
+            self._loaded.move_to_end(key)
+
+    def invalidate(self, key):
+        self.store.delete(self.namespace, json.dumps(key))
+        with self._lock:
+            self._loaded.pop(key, None)
+
+    def clear(self):
+        self.store.clear(self.namespace)
+        with self._lock:
+            self._loaded.clear()
+            self.hits = 0
+            self.misses = 0
+            self.staleHits = 0
+
+    def stats(self):
+        size, totalSize = self.store.stats(self.namespace)
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'staleHits': self.staleHits,
+                    'size': size,
+                    'bytes': totalSize,
+                    'maxsize': self.maxsize,
+                    'maxbytes': self.store.maxbytes,
+                    'ttl': self.ttl,
+                    'stale': self.stale}
+
+
+_stores = {}
+_storesLock = threading.Lock()
+
+
+def getStore(path, maxbytes):
+    with _storesLock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = SQLiteStore(path, maxbytes)
+        store.maxbytes = maxbytes
+        return store
+
+
+def configureCache(cache, config, namespace, ttl, maxsize, stale=0, encode=encodeValue,
+                   decode=decodeValue):
+    # Returns cache with the new settings, or a replacement on the configured CACHE_BACKEND.
+    # encode and decode convert values to and from JSON text for the shared backend.
+    if config['CACHE_BACKEND'] == 'sqlite':
+        store = getStore(config['CACHE_SQLITE_PATH'], config['CACHE_MAX_BYTES'])
+        if not (isinstance(cache, SharedCache) and cache.store is store):
+            return SharedCache(store, namespace, ttl=ttl, maxsize=maxsize, stale=stale,
+                               encode=encode, decode=decode)
+    elif config['CACHE_BACKEND'] == 'memory':
+        if not isinstance(cache, TTLCache):
+            return TTLCache(ttl=ttl, maxsize=maxsize, stale=stale)
+    else:
+        raise ValueError('Unknown CACHE_BACKEND {!r}'.format(config['CACHE_BACKEND']))
+    cache.configure(ttl=ttl, maxsize=maxsize, stale=stale)
+    return cache
+
+
+class SingleFlight(object):
+    # Concurrent calls for the same key wait for the call already in flight and share
+    # its result, or its exception, instead of running the function again
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = concurrent.futures.Future()
+                leader = True
+        if not leader:
+            return call.result()
+
+        try:
+            result = function()
+        except BaseException as error:
+            call.set_exception(error)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {'inFlight': len(self._calls),
+                    'coalesced': self.coalesced}
+
+    def clear(self):
+        with self._lock:
+            self.coalesced = 0
+
+
+class RequestMemo(object):
+    # Results of the calls made while answering one request. A repeated call, also one made
+    # while the first is still running in another thread, returns the first one's result.
+    def __init__(self):
+        self.calls = 0
+        self.hits = 0
+        self.upstreamCalls = 0
+        self.stale = False  # An expired response was served, see apiCalls.markStale
+        self.deferred = False  # Still calling after the response was sent, see respondWithinBudget
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            self.calls += 1
+            result = self._results.get(key)
+            if result is not None:
+                self.hits += 1
+                leader = False
+            else:
+                result = self._results[key] = concurrent.futures.Future()
+                leader = True
+        if not leader:
+            return result.result()
+
+        try:
+            value = function()
+        except BaseException as error:
+            # Not remembered, a later call tries again
+            with self._lock:
+                del self._results[key]
+            result.set_exception(error)
+            raise
+        result.set_result(value)
+        return value
+
+    def countUpstream(self):
+        with self._lock:
+            self.upstreamCalls += 1
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls,
+                    'hits': self.hits,
+                    'upstreamCalls': self.upstreamCalls}
+
+
+def getRequestMemo():
+    # Memo of the GlassFrog calls made for the current request, None outside of one
+    memo = getattr(_memoThread, 'memo', None)
+    if memo is None and has_request_context():
+        memo = g.get('glassfrogMemo')
+        if memo is None:
+            memo = g.glassfrogMemo = RequestMemo()
+    return memo
+
+
+def runWithMemo(memo, function, *args, **kwargs):
+    # Runs function in this thread with the memo of the request it works for
+    previous = getattr(_memoThread, 'memo', None)
+    _memoThread.memo = memo
+    try:
+        return function(*args, **kwargs)
+    finally:
+        _memoThread.memo = previous
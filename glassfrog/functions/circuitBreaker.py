@@ -0,0 +1,62 @@
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    # Tracks consecutive upstream failures per key. After threshold failures the circuit
+    # opens and calls are refused for resetTimeout seconds, then a single trial call is
+    # let through: success closes the circuit, failure opens it again.
+    def __init__(self, threshold=5, resetTimeout=30):
+        self.threshold = threshold
+        self.resetTimeout = resetTimeout
+        self.rejected = 0
+        self._circuits = {}  # key -> [consecutive failures, opened at, trial in flight]
+        self._lock = threading.Lock()
+
+    def configure(self, threshold=None, resetTimeout=None):
+        with self._lock:
+            if threshold is not None:
+                self.threshold = threshold
+            if resetTimeout is not None:
+                self.resetTimeout = resetTimeout
+
+    def allow(self, key):
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None or circuit[1] is None:
+                return True
+            if not circuit[2] and time.monotonic() - circuit[1] >= self.resetTimeout:
+                circuit[2] = True
+                return True
+            self.rejected += 1
+            return False
+
+    def isFailing(self, key):
+        with self._lock:
+            return key in self._circuits
+
+    def recordSuccess(self, key):
+        with self._lock:
+            self._circuits.pop(key, None)
+
+    def recordFailure(self, key):
+        with self._lock:
+            circuit = self._circuits.setdefault(key, [0, None, False])
+            circuit[0] += 1
+            if circuit[0] >= self.threshold:
+                circuit[1] = time.monotonic()
+                circuit[2] = False
+
+    def clear(self):
+        with self._lock:
+            self._circuits.clear()
+            self.rejected = 0
+
+    def stats(self):
+        with self._lock:
+            return {'failing': len(self._circuits),
+                    'open': len([circuit for circuit in self._circuits.values()
+                                 if circuit[1] is not None]),
+                    'rejected': self.rejected,
+                    'threshold': self.threshold,
+                    'resetTimeout': self.resetTimeout}
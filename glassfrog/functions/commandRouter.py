@@ -0,0 +1,106 @@
+import re
+
+import glassfrog.strings as strings
+
+commandSlash = re.compile(strings.regex_command_slash)
+commandMention = re.compile(strings.regex_command_mention)
+# Command name -> pattern finding the names mentioned with it
+mentionPatterns = {'atrole': re.compile(strings.regex_at_role_roleId),
+                   'atcircle': re.compile(strings.regex_at_circle_circleId)}
+
+# Keyword after the / or @ -> command name
+slashCommands = {'hipfrog': 'hipfrog',
+                 'role': 'slashrole', 'roles': 'slashrole',
+                 'circle': 'slashcircle', 'circles': 'slashcircle'}
+atCommands = {'role': 'atrole', 'roles': 'atrole',
+              'circle': 'atcircle', 'circles': 'atcircle'}
+
+
+class Command(object):
+    __slots__ = ('name', 'arguments', 'identifiers')
+
+    def __init__(self, name, arguments=None, identifiers=None):
+        self.name = name
+        self.arguments = arguments if arguments is not None else []  # Lowercase words after it
+        self.identifiers = identifiers if identifiers is not None else []  # Mentioned names
+
+    def __eq__(self, other):
+        return (isinstance(other, Command) and self.name == other.name and
+                self.arguments == other.arguments and self.identifiers == other.identifiers)
+
+    def __repr__(self):
+        return '<Command {} {} {}>'.format(self.name, self.arguments, self.identifiers)
+
+
+# A slash command without arguments -> its Command, shared by every message that is just that
+bareCommands = {'/' + keyword: Command(commandName)
+                for keyword, commandName in slashCommands.items()}
+
+
+def parseSlashCommand(message, commands):
+    # The first word names the command, as a dict lookup instead of a regex when possible
+    command = bareCommands.get(message)
+    if command is not None:
+        commands[command.name] = command
+        return
+    words = message.lower().split()
+    commandName = slashCommands.get(words[0][1:])
+    if commandName is None:
+        # Punctuation right after the keyword, like '/role,'
+        match = commandSlash.match(message)
+        if match is None:
+            return
+        commandName = slashCommands[match.group(1).lower()]
+    commands[commandName] = Command(commandName, words[1:])
+
+
+def parseMentions(message, commands):
+    for match in commandMention.finditer(message):
+        keyword, identifier = match.groups()
+        commandName = atCommands[keyword.lower()]
+        command = commands.get(commandName)
+        if command is None:
+            command = commands[commandName] = Command(commandName)
+        if identifier is not None and commandName == 'atcircle':
+            # Circle names end at a colon, only roles are prefixed with their circle
+            identifier = identifier.split(':')[0] or None
+        if identifier is not None:
+            command.identifiers += [identifier]
+
+
+def parseMessage(message):
+    # All commands in the message by name, in the order they appear. A mention without a
+    # name still makes a command, which is answered with help.
+    commands = {}
+    if message.startswith('/'):
+        parseSlashCommand(message, commands)
+    if '@' in message:
+        parseMentions(message, commands)
+    return commands
+
+
+def getCommand(message, commandName):
+    # The command a webhook was registered for, even if HipChat matched it differently.
+    # Only what that command reads is parsed.
+    command = bareCommands.get(message)
+    if command is not None and command.name == commandName:
+        return command
+    pattern = mentionPatterns.get(commandName)
+    if pattern is not None:
+        return Command(commandName, identifiers=pattern.findall(message))
+    return Command(commandName, message.lower().split()[1:])
+
+
+class CommandRouter(object):
+    # Dispatch table from command names to the functions answering them
+    def __init__(self):
+        self.handlers = {}
+
+    def handles(self, commandName):
+        def register(handler):
+            self.handlers[commandName] = handler
+            return handler
+        return register
+
+    def dispatch(self, command, *args):
+        return self.handlers[command.name](command, *args)
@@ -0,0 +1,56 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JSONCodec(object):
+    # loads takes bytes or str without decoding bytes first, dumps returns str
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+
+codecs = {'stdlib': JSONCodec('stdlib', json.loads,
+                              lambda obj: json.dumps(obj, separators=(',', ':')))}
+if ujson is not None:
+    codecs['ujson'] = JSONCodec('ujson', ujson.loads,
+                                lambda obj: ujson.dumps(obj, ensure_ascii=False,
+                                                        escape_forward_slashes=False))
+if orjson is not None:
+    codecs['orjson'] = JSONCodec('orjson', orjson.loads,
+                                 lambda obj: orjson.dumps(obj).decode('utf-8'))
+
+# Fastest available first
+preferredCodecs = ['orjson', 'ujson', 'stdlib']
+codec = codecs['stdlib']
+
+
+def getCodec(name):
+    if name == 'auto':
+        return codecs[next(name for name in preferredCodecs if name in codecs)]
+    if name not in codecs:
+        raise ValueError('JSON codec {!r} is not available'.format(name))
+    return codecs[name]
+
+
+def configure(config):
+    global codec
+    codec = getCodec(config['JSON_CODEC'])
+
+
+def loads(data):
+    # Raises a ValueError for invalid JSON with every codec
+    return codec.loads(data)
+
+
+def dumps(obj):
+    return codec.dumps(obj)
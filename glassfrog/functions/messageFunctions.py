@@ -1,10 +1,26 @@
 import jwt
-from glassfrog.models import Installation
-from flask import escape
+from jwt.utils import base64url_decode
+from glassfrog.models import Installation, db
+from flask import escape, json
 import Levenshtein
+import sqlalchemy.orm
+import hashlib
+import hmac
+import time
+
+from .caching import TTLCache, getRequestMemo, encodeValue, decodeValue
+from . import orgModels
+import glassfrog.strings as strings
+from .nameIndex import getNameIndex, normalizeName
+
+# Detached installation snapshots, keyed on oauthId
+installationCache = TTLCache(ttl=300, maxsize=1024)
 
 
 def createMessageDict(color, message, message_format="html"):
+    memo = getRequestMemo()
+    if memo is not None and memo.stale:
+        message = str(message) + strings.stale_response
     message_dict = {
         "color": color,
         "message": str(message),
@@ -15,50 +31,114 @@ def createMessageDict(color, message, message_format="html"):
 
 
 def getInstallationFromOauthId(oauthId):
-    installation = Installation.query.filter_by(oauthId=oauthId).first()
+    installation = installationCache.get(oauthId)
+    if installation is None:
+        installation = Installation.query.filter_by(oauthId=oauthId).first()
+        if installation is not None:
+            db.session.expunge(installation)
+            installationCache.set(oauthId, installation)
+    return installation
+
+
+def invalidateInstallation(oauthId):
+    installationCache.invalidate(oauthId)
+
+
+def encodeInstallation(installation):
+    # The column values, for the shared installation cache
+    return encodeValue({column.key: getattr(installation, column.key)
+                        for column in Installation.__table__.columns})
+
+
+def decodeInstallation(data):
+    # A detached installation like the ones the database session hands out
+    columns = decodeValue(data)
+    installation = Installation(columns['oauthId'], columns['capabilitiesUrl'],
+                                columns['roomId'], columns['groupId'], columns['oauthSecret'])
+    for name, value in columns.items():
+        setattr(installation, name, value)
+    sqlalchemy.orm.make_transient_to_detached(installation)
     return installation
 
 
+def decodeJWT(signed_request):
+    # Splits and decodes a token once, without verifying it
+    if isinstance(signed_request, str):
+        signed_request = signed_request.encode('utf-8')
+    try:
+        signing_input, signature_segment = signed_request.rsplit(b'.', 1)
+        header_segment, claims_segment = signing_input.split(b'.', 1)
+        header = json.loads(base64url_decode(header_segment).decode('utf-8'))
+        claims = json.loads(base64url_decode(claims_segment).decode('utf-8'))
+        signature = base64url_decode(signature_segment)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise jwt.DecodeError('Invalid token')
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise jwt.DecodeError('Invalid token')
+    return header, claims, signing_input, signature
+
+
+def verifyJWT(signed_request, leeway=0):
+    # Verifies a HS256 token against the secret of the installation it was issued for
+    header, claims, signing_input, signature = decodeJWT(signed_request)
+    if header.get('alg') != 'HS256':
+        raise jwt.InvalidAlgorithmError('The specified alg value is not allowed')
+    if not isinstance(claims.get('iss'), str):
+        raise jwt.InvalidIssuerError('Invalid issuer')
+    installation = getInstallationFromOauthId(claims['iss'])
+    if installation is None:
+        raise jwt.InvalidIssuerError('Unknown issuer')
+    expected_signature = hmac.new(installation.oauthSecret.encode('utf-8'), signing_input,
+                                  hashlib.sha256).digest()
+    if not hmac.compare_digest(signature, expected_signature):
+        raise jwt.InvalidSignatureError('Signature verification failed')
+    # Time claims are checked like PyJWT does
+    now = time.time()
+    if 'iat' in claims:
+        getTimeClaim(claims, 'iat')
+    if 'nbf' in claims and getTimeClaim(claims, 'nbf') > now + leeway:
+        raise jwt.ImmatureSignatureError('The token is not yet valid (nbf)')
+    if 'exp' in claims and getTimeClaim(claims, 'exp') <= now - leeway:
+        raise jwt.ExpiredSignatureError('Signature has expired')
+    return installation, claims
+
+
+def getTimeClaim(claims, name):
+    try:
+        return int(claims[name])
+    except (TypeError, ValueError, OverflowError):
+        raise jwt.DecodeError('The {} claim must be an integer'.format(name))
+
+
 def getInstallationFromJWT(signed_request):
-    jwt_unverified = jwt.decode(signed_request,
-                                options={'verify_signature': False, 'verify_exp': False})
-    oauthId = jwt_unverified['iss']
-    installation = getInstallationFromOauthId(oauthId)
-    secret = installation.oauthSecret
-    jwt.decode(signed_request, secret, algorithms=['HS256'])
+    installation, claims = verifyJWT(signed_request)
     return installation
 
 
 def getLevenshteinDistance(item, keyword):
-    item = item.lower().replace(' ', '').replace('-', '').replace('_', '')
-    keyword = keyword.lower().replace(' ', '').replace('-', '').replace('_', '')
-    return Levenshtein.ratio(item, keyword)
+    return Levenshtein.ratio(normalizeName(item), normalizeName(keyword))
 
 
 def getMatchingCircle(circles, keyword):
-    closestDistance = 0
-    closestMatch = -999  # no match
-    for circle in circles:
-        for name in ['name', 'short_name']:
-            distance = getLevenshteinDistance(circle[name], keyword)
-            if distance > 0.5 and distance > closestDistance:
-                closestDistance = distance
-                closestMatch = circle['id']
-    return closestMatch
+    # circles: Circle records
+    def getEntries(circles):
+        for circle in circles:
+            yield circle.name, circle.id
+            yield circle.shortName, circle.id
+
+    return getNameIndex('circles', circles, getEntries).match(keyword)
 
 
 def getMatchingRole(roles, keyword):
-    closestDistance = 0
-    closestMatch = -999  # no match
-    for role in roles:
-        if not role['links']['supporting_circle']:
-            for name in ['name']:
-                distance = getLevenshteinDistance(role[name], keyword)
-                if distance > 0.5 and distance > closestDistance:
-                    closestDistance = distance
-                    closestMatch = role['id']
-                    matchfound = True
-    return closestMatch
+    # roles: Role records, or the roles of a GlassFrog payload
+    def getEntries(roles):
+        for role in roles:
+            if not isinstance(role, orgModels.Role):
+                role = orgModels.Role(role)
+            if not role.supportingCircleId:
+                yield role.name, role.id
+
+    return getNameIndex('roles', roles, getEntries).match(keyword)
 
 
 def makeMentionName(name):
@@ -0,0 +1,98 @@
+import Levenshtein
+
+from .caching import TTLCache
+
+MIN_RATIO = 0.5
+MIN_PREFIX_LENGTH = 3
+
+
+def normalizeName(name):
+    return name.lower().replace(' ', '').replace('-', '').replace('_', '')
+
+
+class NameIndex(object):
+    # Pre-normalized names for best-match lookups. match() returns the same id as
+    # scanning all entries in order with Levenshtein.ratio and keeping the first
+    # strictly better ratio above MIN_RATIO.
+    def __init__(self, entries):
+        # entries: iterable of (name, id) in scan order
+        self.names = []
+        self.ids = []
+        self.exact = {}  # normalized name -> first entry
+        self.prefixes = {}  # normalized prefix -> [entry]
+        self.byLength = {}  # normalized length -> [entry]
+
+        for entry, (name, itemId) in enumerate(entries):
+            name = normalizeName(name)
+            self.names += [name]
+            self.ids += [itemId]
+            self.exact.setdefault(name, entry)
+            self.byLength.setdefault(len(name), []).append(entry)
+            for length in range(MIN_PREFIX_LENGTH, len(name)):
+                self.prefixes.setdefault(name[:length], []).append(entry)
+
+    def match(self, keyword, noMatch=-999):
+        keyword = normalizeName(keyword)
+
+        # Identical names have the highest possible ratio, the first one wins
+        if keyword in self.exact:
+            return self.ids[self.exact[keyword]]
+
+        closestDistance = 0
+        closestEntry = None
+        evaluated = set()
+
+        def evaluate(entry):
+            nonlocal closestDistance, closestEntry
+            evaluated.add(entry)
+            distance = Levenshtein.ratio(self.names[entry], keyword)
+            if distance > MIN_RATIO and (distance > closestDistance or (
+                    distance == closestDistance and entry < closestEntry)):
+                closestDistance = distance
+                closestEntry = entry
+
+        # Names starting with the keyword are likely close and raise the bar early
+        for entry in self.prefixes.get(keyword, []):
+            evaluate(entry)
+
+        # The ratio can not exceed 2 * min(a, b) / (a + b) for lengths a and b,
+        # so visit lengths from the highest bound down and stop once it drops too low
+        keywordLength = len(keyword)
+
+        def relativeDifference(length):
+            total = length + keywordLength
+            if total == 0:
+                return 0
+            return abs(length - keywordLength) / total
+        lengths = sorted(self.byLength, key=relativeDifference)
+        for length in lengths:
+            if 4 * min(length, keywordLength) <= length + keywordLength:
+                break
+            bound = 2 * min(length, keywordLength) / (length + keywordLength)
+            if bound < closestDistance - 1e-9:
+                break
+            for entry in self.byLength[length]:
+                if entry not in evaluated:
+                    evaluate(entry)
+
+        if closestEntry is None:
+            return noMatch
+        return self.ids[closestEntry]
+
+
+# Indexes are reused for as long as the same payload list is served
+_nameIndexes = TTLCache(ttl=float('inf'), maxsize=128)
+
+
+def getNameIndex(kind, items, getEntries):
+    cacheKey = (kind, id(items))
+    cached = _nameIndexes.get(cacheKey)
+    if cached is not None and cached[0] is items:
+        return cached[1]
+    index = NameIndex(getEntries(items))
+    _nameIndexes.set(cacheKey, (items, index))
+    return index
+
+
+def clearNameIndexes():
+    _nameIndexes.clear()
@@ -0,0 +1,262 @@
+import collections
+import threading
+import time
+
+from flask import has_app_context
+import requests
+import sqlalchemy
+
+from glassfrog.models import OutboundMessage, db
+from . import apiCalls
+from . import messageFunctions
+
+# Between coalesced messages
+separators = {'html': '<br/>', 'text': '\n'}
+
+
+def getPercentile(values, fraction):
+    # values: sorted
+    if values == []:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class NotificationQueue(object):
+    # Room notifications stored in the database and sent by worker threads. Messages for a room
+    # arriving within the coalescing window go out as one notification, and a token HipChat
+    # rate limits waits for its Retry-After before it is used again.
+    def __init__(self, app):
+        self.app = app
+        self.blockedUntil = {}  # access_token -> time its rate limit is lifted
+        self.latencies = collections.deque(maxlen=1000)  # Seconds from enqueue to sent
+        self.counts = {'queued': 0, 'sent': 0, 'coalesced': 0, 'rateLimited': 0, 'retried': 0,
+                       'failed': 0}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def configure(self, config):
+        self.window = config['NOTIFICATION_COALESCE_WINDOW']
+        self.workers = config['NOTIFICATION_WORKERS']
+        self.maxAttempts = config['NOTIFICATION_MAX_ATTEMPTS']
+        self.retryDelay = config['NOTIFICATION_RETRY_DELAY']
+        self.pollInterval = config['NOTIFICATION_POLL_INTERVAL']
+        self.claimTimeout = config['NOTIFICATION_CLAIM_TIMEOUT']
+        self.messageLimit = config['HIPCHAT_MESSAGE_LIMIT']
+
+    def start(self):
+        self.configure(self.app.config)
+        self.stopped.clear()
+        self.threads = [threading.Thread(target=self.run, name='notifications-{}'.format(worker),
+                                         daemon=True)
+                        for worker in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def enqueue(self, installation, color, message, message_format='html', now=None):
+        if not has_app_context():
+            with self.app.app_context():
+                return self.enqueue(installation, color, message, message_format, now)
+        now = time.time() if now is None else now
+        db.session.add(OutboundMessage(oauthId=installation.oauthId, color=color, message=message,
+                                       message_format=message_format, createdAt=now,
+                                       nextAttemptAt=now + self.window, attempts=0))
+        db.session.commit()
+        with self.lock:
+            self.counts['queued'] += 1
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            with self.app.app_context():
+                try:
+                    nextRun = self.sendDue(time.time())
+                except sqlalchemy.exc.SQLAlchemyError:
+                    db.session.rollback()
+                    nextRun = time.time() + self.pollInterval
+            self.wakeup.wait(max(0, nextRun - time.time()))
+
+    def sendDue(self, now):
+        # Sends the rooms with due messages and returns when the next ones will be. Other
+        # processes may add messages, so it is never later than the poll interval.
+        started = time.monotonic()
+        while True:
+            claimed = self.claimRoom(now)
+            if claimed is None:
+                break
+            installation, messages = claimed
+            self.sendMessages(installation, messages, lambda: now + time.monotonic() - started)
+        nextAttemptAt = db.session.query(sqlalchemy.func.min(OutboundMessage.nextAttemptAt)).filter(
+            self.unclaimed(now)).scalar()
+        db.session.commit()
+        return min(nextAttemptAt or float('inf'), now + self.pollInterval)
+
+    def unclaimed(self, now):
+        return sqlalchemy.or_(OutboundMessage.claimedUntil.is_(None),
+                              OutboundMessage.claimedUntil < now)
+
+    def claimRoom(self, now):
+        # Claims the queued messages of the room whose oldest message is due. Returns the
+        # installation and the messages in order, or None when nothing is due.
+        while True:
+            first = OutboundMessage.query.filter(
+                self.unclaimed(now), OutboundMessage.nextAttemptAt <= now).order_by(
+                OutboundMessage.nextAttemptAt, OutboundMessage.id).first()
+            if first is None:
+                db.session.commit()
+                return None
+            oauthId = first.oauthId
+            roomMessages = OutboundMessage.query.filter(OutboundMessage.oauthId == oauthId,
+                                                        self.unclaimed(now))
+
+            installation = messageFunctions.getInstallationFromOauthId(oauthId)
+            if installation is None:
+                # Uninstalled, there is no room to send to any more
+                failed = roomMessages.delete(synchronize_session=False)
+                db.session.commit()
+                with self.lock:
+                    self.counts['failed'] += failed
+                continue
+            with self.lock:
+                blockedUntil = self.blockedUntil.get(installation.access_token, 0)
+            if blockedUntil > now:
+                roomMessages.filter(OutboundMessage.nextAttemptAt < blockedUntil).update(
+                    {'nextAttemptAt': blockedUntil}, synchronize_session=False)
+                db.session.commit()
+                continue
+
+            # Messages that arrived since the first one was due are coalesced with it
+            messages = db.session.query(
+                OutboundMessage.id, OutboundMessage.color, OutboundMessage.message,
+                OutboundMessage.message_format, OutboundMessage.createdAt,
+                OutboundMessage.attempts).filter(
+                OutboundMessage.oauthId == oauthId, self.unclaimed(now),
+                OutboundMessage.nextAttemptAt <= now + self.window).order_by(
+                OutboundMessage.id).all()
+            claimed = OutboundMessage.query.filter(
+                OutboundMessage.id.in_([message.id for message in messages]),
+                self.unclaimed(now)).update({'claimedUntil': now + self.claimTimeout},
+                                            synchronize_session=False)
+            if claimed != len(messages):
+                # Another worker claimed some of them first
+                db.session.rollback()
+                continue
+            db.session.commit()
+            return installation, messages
+
+    def coalesce(self, messages):
+        # Consecutive messages with the same color and format are joined, up to the message
+        # limit. Returns (color, message, message_format, messages) per notification.
+        notifications = []
+        for message in messages:
+            if notifications != []:
+                color, text, message_format, joined = notifications[-1]
+                separator = separators.get(message_format, '\n')
+                if (color, message_format) == (message.color, message.message_format) and \
+                        len(text) + len(separator) + len(message.message) <= self.messageLimit:
+                    notifications[-1] = (color, text + separator + message.message,
+                                         message_format, joined + [message])
+                    continue
+            notifications += [(message.color, message.message, message.message_format,
+                               [message])]
+        return notifications
+
+    def getRetryAfter(self, response, now):
+        # Seconds to wait, from Retry-After or HipChat's X-Ratelimit-Reset time
+        try:
+            if 'Retry-After' in response.headers:
+                return max(0, float(response.headers['Retry-After']))
+            if 'X-Ratelimit-Reset' in response.headers:
+                return max(0, float(response.headers['X-Ratelimit-Reset']) - now)
+        except ValueError:
+            pass
+        return self.retryDelay
+
+    def sendMessages(self, installation, messages, getTime):
+        hipchatApiHandler = apiCalls.HipchatApiHandler()
+        notifications = self.coalesce(messages)
+        for index, (color, message, message_format, joined) in enumerate(notifications):
+            try:
+                response = hipchatApiHandler.sendMessage(color=color, message=message,
+                                                         installation=installation,
+                                                         message_format=message_format)
+                status = response.status_code
+            except requests.RequestException:
+                response = None
+                status = None
+            now = getTime()
+
+            if status is not None and status < 300:
+                self.settle(joined, delete=True)
+                with self.lock:
+                    self.counts['sent'] += 1
+                    self.counts['coalesced'] += len(joined) - 1
+                    self.latencies.extend(now - sent.createdAt for sent in joined)
+                continue
+            if status is not None and status < 500 and status != 429:
+                # Rejected, sending it again would not help
+                self.settle(joined, delete=True)
+                with self.lock:
+                    self.counts['failed'] += len(joined)
+                continue
+
+            # The rest of the room waits, so that its messages stay in order
+            remaining = [waiting for notification in notifications[index + 1:]
+                         for waiting in notification[3]]
+            if status == 429:
+                retryAt = now + self.getRetryAfter(response, now)
+                with self.lock:
+                    self.blockedUntil[installation.access_token] = retryAt
+                    self.counts['rateLimited'] += 1
+                self.settle(joined + remaining, nextAttemptAt=retryAt)
+                return
+            attempts = max(failed.attempts for failed in joined) + 1
+            if attempts >= self.maxAttempts:
+                self.settle(joined, delete=True)
+                with self.lock:
+                    self.counts['failed'] += len(joined)
+                continue
+            retryAt = now + self.retryDelay * 2 ** (attempts - 1)
+            with self.lock:
+                self.counts['retried'] += 1
+            self.settle(joined, nextAttemptAt=retryAt, attempts=attempts)
+            self.settle(remaining, nextAttemptAt=retryAt)
+            return
+
+    def settle(self, messages, delete=False, nextAttemptAt=None, attempts=None):
+        # Deletes sent messages, or releases the claim on messages to retry at nextAttemptAt
+        if messages == []:
+            return
+        query = OutboundMessage.query.filter(
+            OutboundMessage.id.in_([message.id for message in messages]))
+        if delete:
+            query.delete(synchronize_session=False)
+        else:
+            values = {'claimedUntil': None, 'nextAttemptAt': nextAttemptAt}
+            if attempts is not None:
+                values['attempts'] = attempts
+            query.update(values, synchronize_session=False)
+        db.session.commit()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            latencies = sorted(self.latencies)
+            now = time.time()
+            stats['rateLimitedTokens'] = len([blockedUntil for blockedUntil
+                                              in self.blockedUntil.values() if blockedUntil > now])
+        stats['depth'] = OutboundMessage.query.count() if has_app_context() else None
+        stats['latency'] = {'p50': getPercentile(latencies, 0.5),
+                            'p95': getPercentile(latencies, 0.95),
+                            'max': latencies[-1] if latencies != [] else None}
+        return stats
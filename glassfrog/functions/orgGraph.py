@@ -0,0 +1,47 @@
+import threading
+
+
+class OrgGraph(object):
+    # Index over the OrgSnapshot of a GlassFrog /circles response, built in a single pass
+    def __init__(self, snapshot):
+        self.circleList = snapshot.circles
+        self.circles = {}  # circleId -> Circle
+        self.children = {}  # parent circleId -> [circleId], None holds the anchor circles
+
+        for circle in self.circleList:
+            self.circles[circle.id] = circle
+
+        for supportedRole in snapshot.roles:
+            siblings = self.children.setdefault(supportedRole.circleId, [])
+            if supportedRole.supportingCircleId not in siblings:
+                siblings += [supportedRole.supportingCircleId]
+
+    def getCircle(self, circleId):
+        return self.circles.get(circleId)
+
+    def getChildren(self, circleId):
+        return self.children.get(circleId, [])
+
+    def getAnchorCircles(self):
+        return self.getChildren(None)
+
+
+_orgGraphs = {}
+_orgGraphsLock = threading.Lock()
+
+
+def getOrgGraph(glassfrogToken, responsebody):
+    # Built once per token and reused for as long as the same /circles snapshot is served
+    with _orgGraphsLock:
+        cached = _orgGraphs.get(glassfrogToken)
+        if cached is not None and cached[0] is responsebody:
+            return cached[1]
+    orgGraph = OrgGraph(responsebody)
+    with _orgGraphsLock:
+        _orgGraphs[glassfrogToken] = (responsebody, orgGraph)
+    return orgGraph
+
+
+def clearOrgGraphs():
+    with _orgGraphsLock:
+        _orgGraphs.clear()
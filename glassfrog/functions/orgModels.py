@@ -0,0 +1,82 @@
+import sys
+
+# The organization-wide endpoints, whose responses the cache holds as an OrgSnapshot
+snapshotEndpoints = ('circles', 'roles', 'people')
+
+
+def internName(name):
+    return sys.intern(name) if name is not None else None
+
+
+class Circle(object):
+    __slots__ = ('id', 'name', 'shortName')
+
+    def __init__(self, circle):
+        self.id = circle['id']
+        self.name = internName(circle['name'])
+        self.shortName = internName(circle.get('short_name'))
+
+    def toItem(self):
+        return {'id': self.id, 'name': self.name, 'short_name': self.shortName, 'links': {}}
+
+
+class Role(object):
+    __slots__ = ('id', 'name', 'circleId', 'supportingCircleId')
+
+    def __init__(self, role):
+        links = role['links']
+        self.id = role['id']
+        self.name = internName(role['name'])
+        self.circleId = links.get('circle')
+        self.supportingCircleId = links.get('supporting_circle')
+
+    def toItem(self):
+        return {'id': self.id, 'name': self.name,
+                'links': {'circle': self.circleId, 'supporting_circle': self.supportingCircleId}}
+
+
+class Person(object):
+    __slots__ = ('id', 'name', 'email')
+
+    def __init__(self, person):
+        self.id = person['id']
+        self.name = internName(person['name'])
+        self.email = person.get('email')
+
+    def toItem(self):
+        return {'id': self.id, 'name': self.name, 'email': self.email}
+
+
+class OrgSnapshot(object):
+    # Compact copy of a /circles, /roles or /people payload, with only what the handlers
+    # read. Records refer to each other by id, repeated names like 'Secretary' are stored once.
+    __slots__ = ('apiEndpoint', 'circles', 'roles', 'people')
+
+    def __init__(self, apiEndpoint, responsebody):
+        self.apiEndpoint = apiEndpoint
+        self.circles = []
+        self.roles = []  # For /circles the roles its circles fulfill in their parent
+        self.people = []
+        if apiEndpoint == 'circles':
+            self.circles = [Circle(circle) for circle in responsebody['circles']]
+            self.roles = [Role(role) for role
+                          in responsebody.get('linked', {}).get('supported_roles', [])]
+        elif apiEndpoint == 'roles':
+            self.roles = [Role(role) for role in responsebody['roles']]
+        elif apiEndpoint == 'people':
+            self.people = [Person(person) for person in responsebody['people']]
+        else:
+            raise ValueError('No snapshot of {!r}'.format(apiEndpoint))
+
+    def __eq__(self, other):
+        return (isinstance(other, OrgSnapshot) and self.apiEndpoint == other.apiEndpoint and
+                self.toResponse() == other.toResponse())
+
+    def toResponse(self):
+        # Payload shaped like GlassFrog's that builds the same snapshot again
+        if self.apiEndpoint == 'circles':
+            return {'circles': [circle.toItem() for circle in self.circles],
+                    'linked': {'supported_roles': [role.toItem() for role in self.roles]}}
+        if self.apiEndpoint == 'roles':
+            return {'roles': [role.toItem() for role in self.roles]}
+        return {'people': [person.toItem() for person in self.people]}
@@ -0,0 +1,139 @@
+import random
+import threading
+import time
+
+import sqlalchemy
+
+from glassfrog.models import Installation, db
+from . import apiCalls
+from . import snapshotStore
+from .orgGraph import getOrgGraph
+
+
+def getGlassfrogTokens():
+    # Each token once, however many installations share it
+    query = db.session.query(Installation.glassfrogToken).filter(
+        Installation.glassfrogToken.isnot(None)).distinct()
+    return [glassfrogToken for glassfrogToken, in query]
+
+
+def refreshSnapshots(glassfrogToken, endpoints, store=False):
+    # store: also write the responses to the database snapshot
+    glassfrogApiHandler = apiCalls.GlassfrogApiHandler()
+    for apiEndpoint in endpoints:
+        code, responsebody = glassfrogApiHandler.glassfrogApiCall(
+            apiEndpoint, glassfrogToken, refresh=True)
+        if code != 200:
+            return False
+        if apiEndpoint == 'circles':
+            getOrgGraph(glassfrogToken, responsebody)
+        if store:
+            try:
+                snapshotStore.storeResponse(glassfrogToken, apiEndpoint, responsebody)
+            except sqlalchemy.exc.SQLAlchemyError:
+                # The snapshot catches up on a later refresh
+                db.session.rollback()
+    return True
+
+
+class SnapshotPrefetcher(object):
+    # Keeps the GlassFrog responses of every configured token warm in the response cache,
+    # so requests only fetch live when a snapshot is missing
+    def __init__(self, app):
+        self.app = app
+        self.schedule = {}  # glassfrogToken -> (next refresh, consecutive failures)
+        self.refreshes = 0
+        self.failures = 0
+        self.warmed = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.random = random.Random()
+
+    def configure(self, config):
+        self.endpoints = config['PREFETCH_ENDPOINTS']
+        self.interval = config['PREFETCH_INTERVAL']
+        self.jitter = config['PREFETCH_JITTER']
+        self.maxBackoff = config['PREFETCH_MAX_BACKOFF']
+        self.storeSnapshots = config['SNAPSHOT_STORE_ENABLED']
+
+    def getDelay(self, failures):
+        delay = min(self.interval * 2 ** failures, max(self.interval, self.maxBackoff))
+        return delay * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def start(self):
+        self.configure(self.app.config)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='prefetcher', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        if self.storeSnapshots:
+            with self.app.app_context():
+                try:
+                    self.warmStart(time.monotonic())
+                except sqlalchemy.exc.SQLAlchemyError:
+                    pass
+        while not self.stopped.is_set():
+            with self.app.app_context():
+                try:
+                    nextRun = self.runDue(time.monotonic())
+                except sqlalchemy.exc.SQLAlchemyError:
+                    nextRun = time.monotonic() + self.interval
+            self.stopped.wait(max(0, nextRun - time.monotonic()))
+
+    def warmStart(self, now):
+        # Serves the stored snapshots right away. Their refreshes are spread over the first
+        # interval instead of all tokens hitting GlassFrog at startup.
+        responses = snapshotStore.warmCache(apiCalls.glassfrogResponseCache)
+        for (glassfrogToken, apiEndpoint), responsebody in responses.items():
+            if apiEndpoint == 'circles':
+                getOrgGraph(glassfrogToken, responsebody)
+            if glassfrogToken not in self.schedule:
+                self.schedule[glassfrogToken] = (now + self.interval * self.random.random(), 0)
+                self.warmed += 1
+        return self.warmed
+
+    def runDue(self, now):
+        # Refreshes the tokens that are due and returns when the next one will be
+        tokens = getGlassfrogTokens()
+        for glassfrogToken in list(self.schedule):
+            if glassfrogToken not in tokens:
+                del self.schedule[glassfrogToken]
+        for glassfrogToken in tokens:
+            refreshAt, failures = self.schedule.get(glassfrogToken, (now, 0))
+            if refreshAt > now:
+                continue
+            try:
+                refreshed = refreshSnapshots(glassfrogToken, self.endpoints,
+                                             store=self.storeSnapshots)
+            except Exception:
+                # An unexpected payload of one token must not stop the others
+                db.session.rollback()
+                self.app.logger.exception('Prefetching GlassFrog responses failed')
+                refreshed = False
+            if refreshed:
+                self.refreshes += 1
+                failures = 0
+            else:
+                self.failures += 1
+                failures += 1
+            self.schedule[glassfrogToken] = (now + self.getDelay(failures), failures)
+        # New tokens are picked up within an interval
+        return min([refreshAt for refreshAt, failures in self.schedule.values()] +
+                   [now + self.interval])
+
+    def stats(self):
+        return {'tokens': len(self.schedule),
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'warmed': self.warmed,
+                'stored': dict(snapshotStore.storeStats),
+                'backingOff': len([failures for refreshAt, failures in self.schedule.values()
+                                   if failures > 0])}
@@ -0,0 +1,43 @@
+import re
+
+# Tags that are never closed
+voidTags = {'br', 'hr', 'img'}
+tagPattern = re.compile(r'<(/?)([a-zA-Z]+)[^>]*?(/?)>')
+
+
+def getClosingTags(html):
+    openTags = []
+    for match in tagPattern.finditer(html):
+        closing, tag, selfClosing = match.groups()
+        tag = tag.lower()
+        if selfClosing or tag in voidTags:
+            continue
+        if not closing:
+            openTags += [tag]
+        elif tag in openTags:
+            while openTags.pop() != tag:
+                pass
+    return ''.join('</{}>'.format(tag) for tag in reversed(openTags))
+
+
+def joinFragments(fragments, maxLength=None, suffix='', truncatedMessage=''):
+    # Joins the fragments yielded by a renderer once. When the next fragment would exceed
+    # maxLength the renderer is not resumed, the tags it left open are closed and
+    # truncatedMessage is added. The suffix is always kept.
+    accepted = []
+    length = len(suffix)
+    for fragment in fragments:
+        if maxLength is not None and length + len(fragment) > maxLength:
+            return truncateFragments(accepted, maxLength, suffix, truncatedMessage)
+        accepted += [fragment]
+        length += len(fragment)
+    return ''.join(accepted) + suffix
+
+
+def truncateFragments(accepted, maxLength, suffix, truncatedMessage):
+    while True:
+        html = ''.join(accepted)
+        ending = getClosingTags(html) + truncatedMessage + suffix
+        if len(html) + len(ending) <= maxLength or accepted == []:
+            return html + ending
+        accepted.pop()
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import time
+
+from glassfrog.models import Installation, SnapshotCircle, SnapshotRole, SnapshotPerson, db
+from . import jsonCodec
+from .orgModels import OrgSnapshot
+
+snapshotModels = {'circles': SnapshotCircle, 'roles': SnapshotRole, 'people': SnapshotPerson}
+
+# (glassfrogToken, apiEndpoint) -> OrgSnapshot last written. An unchanged GlassFrog response
+# keeps its snapshot, so it is recognized without diffing a single item.
+lastStored = {}
+storeStats = {'inserted': 0, 'updated': 0, 'deleted': 0}
+
+
+def serialize(item):
+    # Equal items always give the same text, and so the same hash
+    if item is None:
+        return None
+    return json.dumps(item, sort_keys=True, separators=(',', ':'))
+
+
+def getRows(apiEndpoint, snapshot):
+    # itemId -> column values of the item's row
+    rows = {}
+    if apiEndpoint == 'circles':
+        supportedRoles = {role.supportingCircleId: role for role in snapshot.roles}
+        for position, circle in enumerate(snapshot.circles):
+            supportedRole = supportedRoles.get(circle.id)
+            rows[circle.id] = {'position': position, 'name': circle.name,
+                               'data': serialize(circle.toItem()),
+                               'supportedRole': serialize(supportedRole.toItem())
+                               if supportedRole is not None else None}
+    elif apiEndpoint == 'roles':
+        for position, role in enumerate(snapshot.roles):
+            rows[role.id] = {'position': position, 'name': role.name, 'circleId': role.circleId,
+                             'data': serialize(role.toItem())}
+    elif apiEndpoint == 'people':
+        for position, person in enumerate(snapshot.people):
+            rows[person.id] = {'position': position, 'name': person.name,
+                               'email': person.email, 'data': serialize(person.toItem())}
+    for row in rows.values():
+        row['contentHash'] = hashlib.sha1(serialize(row).encode('utf-8')).hexdigest()
+    return rows
+
+
+def storeResponse(glassfrogToken, apiEndpoint, snapshot, fetchedAt=None):
+    # Applies the difference with the stored snapshot, returns (inserted, updated, deleted)
+    model = snapshotModels.get(apiEndpoint)
+    if model is None:
+        return 0, 0, 0
+    fetchedAt = time.time() if fetchedAt is None else fetchedAt
+    storeKey = (glassfrogToken, apiEndpoint)
+    inserts, updates, deletes = [], [], []
+    if lastStored.get(storeKey) is not snapshot:
+        rows = getRows(apiEndpoint, snapshot)
+        stored = dict(db.session.query(model.id, model.contentHash).filter(
+            model.glassfrogToken == glassfrogToken))
+
+        inserts = [dict(row, glassfrogToken=glassfrogToken, id=itemId)
+                   for itemId, row in rows.items() if itemId not in stored]
+        updates = [dict(row, glassfrogToken=glassfrogToken, id=itemId)
+                   for itemId, row in rows.items()
+                   if itemId in stored and stored[itemId] != row['contentHash']]
+        deletes = [itemId for itemId in stored if itemId not in rows]
+        if inserts:
+            db.session.bulk_insert_mappings(model, inserts)
+        if updates:
+            db.session.bulk_update_mappings(model, updates)
+        if deletes:
+            db.session.query(model).filter(model.glassfrogToken == glassfrogToken,
+                                           model.id.in_(deletes)).delete(
+                                               synchronize_session=False)
+    # Unchanged rows were fetched again as well
+    db.session.query(model).filter(model.glassfrogToken == glassfrogToken).update(
+        {'fetchedAt': fetchedAt}, synchronize_session=False)
+    db.session.commit()
+
+    lastStored[storeKey] = snapshot
+    storeStats['inserted'] += len(inserts)
+    storeStats['updated'] += len(updates)
+    storeStats['deleted'] += len(deletes)
+    return len(inserts), len(updates), len(deletes)
+
+
+def deleteSnapshots(glassfrogToken):
+    # Once no installation uses the token any more
+    if glassfrogToken is None or Installation.query.filter_by(
+            glassfrogToken=glassfrogToken).first() is not None:
+        return
+    for apiEndpoint, model in snapshotModels.items():
+        db.session.query(model).filter(model.glassfrogToken == glassfrogToken).delete(
+            synchronize_session=False)
+        lastStored.pop((glassfrogToken, apiEndpoint), None)
+    db.session.commit()
+
+
+def buildSnapshot(apiEndpoint, rows):
+    if apiEndpoint == 'circles':
+        responsebody = {'circles': [jsonCodec.loads(data) for data, supportedRole in rows],
+                        'linked': {'supported_roles': [jsonCodec.loads(supportedRole)
+                                                       for data, supportedRole in rows
+                                                       if supportedRole is not None]}}
+    else:
+        responsebody = {apiEndpoint: [jsonCodec.loads(data) for data, in rows]}
+    return OrgSnapshot(apiEndpoint, responsebody)
+
+
+def loadResponses():
+    # (glassfrogToken, apiEndpoint) -> (OrgSnapshot rebuilt from the stored rows, fetchedAt)
+    responses = {}
+    for apiEndpoint, model in snapshotModels.items():
+        columns = [model.data]
+        if apiEndpoint == 'circles':
+            columns += [model.supportedRole]
+        tokenRows = {}
+        fetchedAt = {}
+        query = db.session.query(model.glassfrogToken, model.fetchedAt, *columns).order_by(
+            model.glassfrogToken, model.position)
+        for glassfrogToken, rowFetchedAt, *row in query:
+            tokenRows.setdefault(glassfrogToken, []).append(row)
+            # Rows stored before fetchedAt existed count as fetched long ago
+            fetchedAt[glassfrogToken] = min(fetchedAt.get(glassfrogToken, float('inf')),
+                                            rowFetchedAt or 0)
+        for glassfrogToken, rows in tokenRows.items():
+            responses[(glassfrogToken, apiEndpoint)] = (buildSnapshot(apiEndpoint, rows),
+                                                        fetchedAt[glassfrogToken])
+    return responses
+
+
+def warmCache(cache, now=None):
+    # Seeds the response cache from the database, returns the snapshots it loaded. Snapshots
+    # older than the cache's TTL are loaded as stale, so the first request revalidates them,
+    # and those past its stale TTL are left out.
+    now = time.time() if now is None else now
+    loaded = {}
+    for cacheKey, (snapshot, fetchedAt) in loadResponses().items():
+        age = max(0, now - fetchedAt)
+        if age >= cache.ttl + cache.stale:
+            continue
+        # A response another worker already fetched is newer than the stored one
+        if cache.peek(cacheKey) is None:
+            validators = {'etag': None, 'lastModified': None, 'contentHash': None}
+            cache.set(cacheKey, (200, snapshot, validators), age=age)
+        lastStored[cacheKey] = snapshot
+        loaded[cacheKey] = snapshot
+    return loaded
+
+
+def clear():
+    lastStored.clear()
+    for name in storeStats:
+        storeStats[name] = 0
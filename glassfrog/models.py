@@ -56,3 +56,55 @@ class Installation(db.Model):
 
     def __repr__(self):
         return '<Installation {} with oauthId {}>'.format(self.id, self.oauthId)
+
+
+# Last GlassFrog /circles, /roles and /people payloads of every token, one row per item. data
+# holds the item as GlassFrog sent it, contentHash tells an update from an unchanged item.
+class SnapshotCircle(db.Model):
+    __tablename__ = 'snapshot_circles'
+    glassfrogToken = db.Column(db.String(50), primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    position = db.Column(db.Integer)
+    name = db.Column(db.String)
+    contentHash = db.Column(db.String(40))
+    data = db.Column(db.Text)
+    supportedRole = db.Column(db.Text)  # The circle's entry in linked.supported_roles
+    fetchedAt = db.Column(db.Float)  # Seconds since the epoch GlassFrog last returned it
+
+
+class SnapshotRole(db.Model):
+    __tablename__ = 'snapshot_roles'
+    glassfrogToken = db.Column(db.String(50), primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    position = db.Column(db.Integer)
+    name = db.Column(db.String)
+    circleId = db.Column(db.Integer)
+    contentHash = db.Column(db.String(40))
+    data = db.Column(db.Text)
+    fetchedAt = db.Column(db.Float)
+
+
+class SnapshotPerson(db.Model):
+    __tablename__ = 'snapshot_people'
+    glassfrogToken = db.Column(db.String(50), primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    position = db.Column(db.Integer)
+    name = db.Column(db.String)
+    email = db.Column(db.String)
+    contentHash = db.Column(db.String(40))
+    data = db.Column(db.Text)
+    fetchedAt = db.Column(db.Float)
+
+
+class OutboundMessage(db.Model):
+    # Room notification waiting in the notification queue. Times are seconds since the epoch.
+    __tablename__ = 'outbound_messages'
+    id = db.Column(db.Integer, primary_key=True)
+    oauthId = db.Column(db.String(50), index=True)
+    color = db.Column(db.String(20))
+    message = db.Column(db.Text)
+    message_format = db.Column(db.String(10))
+    createdAt = db.Column(db.Float)
+    nextAttemptAt = db.Column(db.Float, index=True)
+    claimedUntil = db.Column(db.Float)  # Set while a worker sends the message
+    attempts = db.Column(db.Integer)
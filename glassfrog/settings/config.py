@@ -2,3 +2,44 @@ SECRET_KEY = 'not_so_secret'
 SQLALCHEMY_DATABASE_URI = 'postgresql:///glassfrog_hipchat'
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 PUBLIC_URL = "http://my-public-url.com"
+GLASSFROG_API_URL = 'https://glassfrog.holacracy.org/api/v3/'
+CACHE_BACKEND = 'memory'  # 'memory' per process, or 'sqlite' to share caches between workers
+CACHE_SQLITE_PATH = None  # File shared by the workers on this host, None for the instance folder
+CACHE_MAX_BYTES = 64 * 1024 * 1024  # Total size of the serialized entries in the shared cache
+GLASSFROG_CACHE_TTL = 60  # Seconds a successful GlassFrog response is reused
+GLASSFROG_CACHE_SIZE = 256  # Maximum number of cached GlassFrog responses
+GLASSFROG_STALE_TTL = 3600  # Seconds an expired response is still served while it is refreshed
+CIRCUIT_BREAKER_THRESHOLD = 5  # Consecutive GlassFrog failures before a token's calls are paused
+CIRCUIT_BREAKER_RESET = 30  # Seconds before a paused token is tried again
+JSON_CODEC = 'auto'  # 'orjson', 'ujson' or 'stdlib', 'auto' picks the fastest one installed
+HTTP_POOL_SIZE = 10  # Keep-alive connections per upstream host
+HTTP_CONNECT_TIMEOUT = 3.05  # Seconds
+HTTP_READ_TIMEOUT = 10  # Seconds
+ASYNC_WEBHOOK_ROUTES = []  # Webhook routes, like 'atrole', that may answer later in the room
+ASYNC_WEBHOOK_BUDGET = 5  # Seconds before such a route answers the webhook with an empty response
+ASYNC_WEBHOOK_WORKERS = 4
+CONSOLIDATED_WEBHOOK = False  # One webhook for all commands, applies when the add-on is installed
+UPSTREAM_WORKERS = 16  # Threads for concurrent GlassFrog and HipChat calls within a request
+ROOM_ROSTER_TTL = 30  # Seconds a room's member list is reused for mentions
+ROOM_PRIVACY_TTL = 300  # Seconds a room's privacy setting is reused
+ROOM_CACHE_SIZE = 1024
+INSTALLATION_CACHE_TTL = 10  # Seconds other processes may serve a changed installation
+INSTALLATION_CACHE_SIZE = 1024
+PREFETCH_ENABLED = False  # Refresh the GlassFrog responses of every installation in the background
+PREFETCH_ENDPOINTS = ['circles', 'roles']  # The endpoints commands read without an id
+PREFETCH_INTERVAL = 45  # Seconds between refreshes, keep it below GLASSFROG_CACHE_TTL
+PREFETCH_JITTER = 0.1  # Fraction of the interval by which refreshes are randomly spread
+PREFETCH_MAX_BACKOFF = 600  # Seconds between refreshes of a token that keeps failing
+SNAPSHOT_STORE_ENABLED = False  # Keep prefetched responses in the database and load them at start
+HIPCHAT_MESSAGE_LIMIT = 10000  # Characters HipChat accepts in a single message
+NOTIFICATION_QUEUE_ENABLED = False  # Send room notifications from a queue in the database
+NOTIFICATION_WORKERS = 2
+NOTIFICATION_COALESCE_WINDOW = 1  # Seconds a room's notifications wait to be sent as one
+NOTIFICATION_MAX_ATTEMPTS = 5  # Sends of a notification before it is dropped
+NOTIFICATION_RETRY_DELAY = 5  # Seconds before the first retry, doubled on every next one
+NOTIFICATION_POLL_INTERVAL = 5  # Seconds between checks for notifications queued by other processes
+NOTIFICATION_CLAIM_TIMEOUT = 60  # Seconds before notifications a stopped worker claimed are resent
+CIRCLE_TREE_MAX_DEPTH = 10  # Levels of subcircles listed by /circle
+CACHE_STATS_ENABLED = False  # Serve cache statistics of this process at /cachestats
+VERIFY_WEBHOOK_JWT = True  # Reject webhooks without a valid JWT from the installation
+JWT_LEEWAY = 30  # Seconds of clock skew allowed on JWT expiry
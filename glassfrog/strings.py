@@ -16,6 +16,16 @@ help_hipfrog = '''Use one of the following commands to learn more:
  - Mention the people in the current room in the specified circle</li>
 </ul>'''
 
+help_hipfrog_role = '''Use one of the following commands to learn more about roles:
+<ul>
+<li><code>/role [circle-name:]role-name</code>
+ - Get the details for a role</li>
+<li><code>/circle circle-name roles</code>
+ - List the roles in a circle</li>
+<li><code>@role [circle-name:]role-name</code>
+ - Mention the people in the current room fullfilling the specified role</li>
+</ul>'''
+
 help_hipfrog_circle = '''<strong>More</strong>:
 <ul>
 <li><code>/circle circle-name [members/roles]</code>
@@ -24,6 +34,17 @@ help_hipfrog_circle = '''<strong>More</strong>:
  - Mention the people in the current room in the specified circle</li>
 </ul>'''
 
+glassfrog_unavailable = 'GlassFrog can not be reached right now, please try again later.'
+
+glassfrog_invalid_response = ('GlassFrog sent an unexpected response (status {}), '
+                              'please try again later.')
+
+stale_response = ' (GlassFrog could not be reached, this may be outdated)'
+
+subcircles_not_listed = ' ({} subcircles not listed)'
+
+message_truncated = '<br />This message was shortened to fit in HipChat.<br />'
+
 help_hipfrog_circle_circleid = '''<strong>More:</strong>
 <ul>
 <li><code>/circle {0} members</code>
@@ -64,6 +85,8 @@ configured_successfully = "Configured successfully. Type <code>/hipfrog</code> t
 missing_functionality = ("Sorry, the feature \'{}\' does not exist (yet)."
                          " Type <code>/hipfrog</code> to get a list of the available commands.")
 
+deferred_response_failed = "Sorry, something went wrong while looking that up."
+
 circles_missing_functionality = ("Sorry, the feature \'{0}\' does not exist (yet)."
                                  " Type <code>/circle {1}</code> to get a list of"
                                  " the available commands.")
@@ -74,10 +97,17 @@ regex_slash_role = "\\A\\/[rR][oO][lL][eE][sS]?\\b"
 regex_slash_circle = "\\A\\/[cC][iI][rR][cC][lL][eE][sS]?\\b"
 regex_at_role = "@[rR][oO][lL][eE][sS]?\\b"
 regex_at_circle = "@[cC][iI][rR][cC][lL][eE][sS]?\\b"
+# Any of the above, for the single webhook of CONSOLIDATED_WEBHOOK
+regex_any_command = "|".join([regex_hipfrog, regex_slash_role, regex_slash_circle,
+                              regex_at_role, regex_at_circle])
 
 # Regex patterns for Python code
-regex_at_role_roleId = "@[rR][oO][lL][eE][sS]? ([\w\-\:]+)"
-regex_at_circle_circleId = "@[cC][iI][rR][cC][lL][eE][sS]? ([\w\-]+)"
+regex_at_role_roleId = r"@[rR][oO][lL][eE][sS]? ([\w\-\:]+)"
+regex_at_circle_circleId = r"@[cC][iI][rR][cC][lL][eE][sS]? ([\w\-]+)"
+# Every command in a message: a slash command at the start, any number of mentions
+regex_command_slash = (r"/([hH][iI][pP][fF][rR][oO][gG]|[rR][oO][lL][eE][sS]?"
+                       r"|[cC][iI][rR][cC][lL][eE][sS]?)\b")
+regex_command_mention = r"@([rR][oO][lL][eE][sS]?|[cC][iI][rR][cC][lL][eE][sS]?)\b(?: ([\w\-\:]+))?"
 
 no_circle_matched = 'No circle name matched {}'
 no_role_matched = 'No role name matched {}'
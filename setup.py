@@ -17,5 +17,6 @@ setup(
     zip_safe=False,
     install_requires=['requests', 'Flask-Migrate', 'psycopg2', 'Flask-SQLAlchemy', 'PyJWT',
                       'Flask', 'python-Levenshtein'],
+    extras_require={'fastjson': ['orjson']},
     scripts=[mainscript],
 )
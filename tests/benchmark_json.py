@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Decode time and peak memory for a large /roles payload: the previous flask.json.loads of
+# the decoded response text against each available jsonCodec on the raw bytes.
+# Run: python3 tests/benchmark_json.py [--depth 4] [--fanout 6] [--number 20]
+import argparse
+import timeit
+import tracemalloc
+
+from flask import json
+
+from glassfrog.functions import jsonCodec
+
+import org_generator
+
+
+def peakMemory(function):
+    tracemalloc.start()
+    try:
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark JSON decoding of GlassFrog payloads')
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--fanout', type=int, default=6)
+    parser.add_argument('--number', type=int, default=20, help='Decodes per measurement')
+    args = parser.parse_args(argv)
+
+    org = org_generator.SyntheticOrg(depth=args.depth, fanout=args.fanout)
+    code, responsebody = org.response('roles')
+    content = json.dumps(responsebody).encode('utf-8')
+    print('/roles payload: {} roles, {:.1f} KB'.format(len(org.roles), len(content) / 1024))
+
+    decoders = [('flask.json text', lambda: json.loads(content.decode('utf-8')))]
+    decoders += [('{} bytes'.format(name), lambda codec=codec: codec.loads(content))
+                 for name, codec in jsonCodec.codecs.items()]
+    print('{:<20} {:>12} {:>14}'.format('decoder', 'ms/decode', 'peak MB'))
+    for name, decode in decoders:
+        seconds = min(timeit.repeat(decode, number=args.number, repeat=3))
+        print('{:<20} {:>12.2f} {:>14.2f}'.format(
+            name, seconds / args.number * 1000, peakMemory(decode) / 1024 / 1024))
+
+    message_dict = {'color': 'green', 'message': content.decode('utf-8')[:10000],
+                    'notify': False, 'message_format': 'html'}
+    print('{:<20} {:>12}'.format('encoder', 'us/encode'))
+    encoders = [('flask.json', lambda: json.dumps(message_dict))]
+    encoders += [(name, lambda codec=codec: codec.dumps(message_dict))
+                 for name, codec in jsonCodec.codecs.items()]
+    for name, encode in encoders:
+        seconds = min(timeit.repeat(encode, number=args.number * 50, repeat=3))
+        print('{:<20} {:>12.2f}'.format(name, seconds / (args.number * 50) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
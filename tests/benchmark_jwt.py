@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# Per-request cost of verifying a webhook JWT: the previous double decode through PyJWT
+# against messageFunctions.verifyJWT with a cached installation.
+# Run: python3 tests/benchmark_jwt.py
+import time
+import timeit
+
+import jwt
+
+from glassfrog.functions import messageFunctions
+from glassfrog.models import Installation
+
+import test_values
+
+
+def main(number=20000):
+    installation = Installation(oauthId=test_values.mock_installdata['oauthId'],
+                                capabilitiesUrl=test_values.mock_installdata['capabilitiesUrl'],
+                                roomId=test_values.mock_installdata['roomId'],
+                                groupId=test_values.mock_installdata['groupId'],
+                                oauthSecret=test_values.mock_installdata['oauthSecret'])
+    signed_request = test_values.mock_jwt_encoded(int(time.time())+3600)
+    messageFunctions.installationCache.set(installation.oauthId, installation)
+
+    def doubleDecode():
+        jwt_unverified = jwt.decode(signed_request,
+                                    options={'verify_signature': False, 'verify_exp': False})
+        installation = messageFunctions.getInstallationFromOauthId(jwt_unverified['iss'])
+        jwt.decode(signed_request, installation.oauthSecret, algorithms=['HS256'])
+
+    def singleDecode():
+        messageFunctions.verifyJWT(signed_request)
+
+    for name, function in [('PyJWT decode twice', doubleDecode),
+                           ('verifyJWT', singleDecode)]:
+        seconds = min(timeit.repeat(function, number=number, repeat=3))
+        print('{:<20} {:8.2f} us/request'.format(name, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Memory held by the response cache for many synthetic organizations: their /circles, /roles
+# and /people responses as parsed JSON, against the orgModels.OrgSnapshot records the cache
+# now keeps in their place.
+# Run: python3 tests/benchmark_memory.py [--orgs 100] [--depth 2] [--fanout 4]
+import argparse
+import gc
+import tracemalloc
+
+from glassfrog.functions import jsonCodec
+from glassfrog.functions import orgModels
+
+import org_generator
+
+
+def heldMemory(build):
+    # Bytes still allocated by what build() returns
+    gc.collect()
+    tracemalloc.start()
+    held = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, held
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Memory per cached organization')
+    parser.add_argument('--orgs', type=int, default=100)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--fanout', type=int, default=4)
+    args = parser.parse_args(argv)
+
+    # Payloads as they arrive from GlassFrog, serialized so that no objects are shared
+    payloads = []
+    roleCount = 0
+    for seed in range(args.orgs):
+        org = org_generator.SyntheticOrg(depth=args.depth, fanout=args.fanout, seed=seed)
+        payloads += [[(apiEndpoint, jsonCodec.dumps(org.response(apiEndpoint)[1]).encode('utf-8'))
+                      for apiEndpoint in orgModels.snapshotEndpoints]]
+        roleCount += len(org.roles)
+
+    def parsePayloads():
+        return [[jsonCodec.loads(content) for apiEndpoint, content in contents]
+                for contents in payloads]
+
+    def buildSnapshots():
+        # As GlassfrogApiHandler.requestGlassfrog caches them
+        return [[orgModels.OrgSnapshot(apiEndpoint, jsonCodec.loads(content))
+                 for apiEndpoint, content in contents]
+                for contents in payloads]
+
+    print('{} organizations, {} roles'.format(args.orgs, roleCount))
+    print('{:<16} {:>10} {:>14}'.format('cached as', 'MB', 'bytes/role'))
+    for name, build in [('parsed JSON', parsePayloads), ('OrgSnapshot', buildSnapshots)]:
+        size, held = heldMemory(build)
+        print('{:<16} {:>10.2f} {:>14.0f}'.format(name, size / 1024 / 1024, size / roleCount))
+        del held
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# Parse time per chat message: the previous per-route parsing, a .lower().split() or an
+# re.search with a pattern string from strings.py, against commandRouter.getCommand. The
+# router answers a bare slash command with one lookup, other messages also pay for building
+# their Command.
+# Run: python3 tests/benchmark_parsing.py [--number 20000]
+import argparse
+import re
+import timeit
+
+from glassfrog import strings
+from glassfrog.functions import commandRouter
+
+messages = [('/circle', 'slashcircle'),
+            ('/circle sales members', 'slashcircle'),
+            ('/role secretary', 'slashrole'),
+            ('/hipfrog', 'hipfrog'),
+            ('Hi @role sales:secretary, could you schedule a meeting?', 'atrole'),
+            ('Hi @circle sales, the numbers are in', 'atcircle')]
+
+
+def previousParse(message, route):
+    if route == 'atrole':
+        match = re.search(strings.regex_at_role_roleId, message)
+        return match.group(1) if match is not None else None
+    if route == 'atcircle':
+        match = re.search(strings.regex_at_circle_circleId, message)
+        return match.group(1) if match is not None else None
+    return message.lower().split()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark chat message parsing')
+    parser.add_argument('--number', type=int, default=20000, help='Parses per measurement')
+    args = parser.parse_args(argv)
+
+    print('{:<60} {:>12} {:>12}'.format('message', 'previous us', 'router us'))
+    for message, route in messages:
+        timings = []
+        for parse in [lambda: previousParse(message, route),
+                      lambda: commandRouter.getCommand(message, route)]:
+            seconds = min(timeit.repeat(parse, number=args.number, repeat=3))
+            timings += [seconds / args.number * 1e6]
+        print('{:<60} {:>12.2f} {:>12.2f}'.format(message, *timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Scaling curves per command: serves synthetic organizations of growing size from a local
+# GlassFrog stand-in and reports cold (empty caches) and warm milliseconds per command.
+# Run: python3 tests/benchmark_scaling.py [--fanout 4] [--max-depth 4] [--roles 6]
+import argparse
+import time
+
+import glassfrog
+from glassfrog.functions import apiCalls
+from glassfrog.functions import messageFunctions
+
+import benchmark_webhooks
+import org_generator
+import stub_servers
+
+
+def timeCommand(function, repeat, cold):
+    timings = []
+    for i in range(repeat):
+        if cold:
+            benchmark_webhooks.clearCaches()
+        startTime = time.perf_counter()
+        function()
+        timings += [time.perf_counter() - startTime]
+    return min(timings) * 1000
+
+
+def commands(org, glassfrogToken):
+    circle = org.circles[min(1, len(org.circles) - 1)]
+    role = [role for role in org.circleRoles(circle['id'])
+            if role['links']['supporting_circle'] is None][-1]
+    return [
+        ('getCircles', lambda: glassfrog.getCircles(glassfrogToken)),
+        ('getCircleRoles', lambda: glassfrog.getCircleRoles(glassfrogToken, org.circles[0]['id'])),
+        ('getRoleRoleId', lambda: glassfrog.getRoleRoleId(glassfrogToken, role['id'])),
+        ('getIdForRoleIdentifier',
+         lambda: glassfrog.getIdForRoleIdentifier(glassfrogToken, role['name'][:-1])),
+        ('getMatchingRole', lambda: messageFunctions.getMatchingRole(
+            org.roles, role['name'][:-1])),
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scaling curves for the HipFrog commands')
+    parser.add_argument('--fanout', type=int, default=4, help='Subcircles per circle')
+    parser.add_argument('--max-depth', type=int, default=4, help='Deepest organization measured')
+    parser.add_argument('--roles', type=int, default=6, help='Custom roles per circle')
+    parser.add_argument('--people-per-role', type=int, default=2)
+    parser.add_argument('--collisions', type=float, default=0.2)
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per command, best is reported')
+    args = parser.parse_args(argv)
+
+    glassfrogToken = 'benchmark-token'
+    print('{:<7} {:>7} {:>7}  {:<24} {:>9} {:>9}'.format(
+        'depth', 'circles', 'roles', 'command', 'cold ms', 'warm ms'))
+    for depth in range(args.max_depth + 1):
+        org = org_generator.SyntheticOrg(depth=depth, fanout=args.fanout,
+                                         rolesPerCircle=args.roles,
+                                         peoplePerRole=args.people_per_role,
+                                         nameCollisions=args.collisions)
+        glassfrogServer = stub_servers.StubServer(org.routes()).start()
+        glassfrog.app.config['GLASSFROG_API_URL'] = glassfrogServer.url + '/api/v3/'
+        apiCalls.configure(glassfrog.app.config)
+        try:
+            for name, function in commands(org, glassfrogToken):
+                cold = timeCommand(function, args.repeat, cold=True)
+                warm = timeCommand(function, args.repeat, cold=False)
+                print('{:<7} {:>7} {:>7}  {:<24} {:>9.2f} {:>9.2f}'.format(
+                    depth, len(org.circles), len(org.roles), name, cold, warm))
+        finally:
+            glassfrogServer.stop()
+
+
+if __name__ == '__main__':
+    main()
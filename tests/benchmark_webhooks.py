@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Replays the webhook payloads from test_values through the Flask test client, against local
+# GlassFrog and HipChat stand-ins with configurable latency, and reports latency percentiles
+# and throughput per route.
+# Run: python3 tests/benchmark_webhooks.py [--requests 200] [--latency 0.05] [--cold]
+#      [--org-depth 3 --org-fanout 6] to run against a synthetic organization
+import argparse
+import time
+
+from flask import json
+
+import glassfrog
+from glassfrog import db
+from glassfrog.functions import apiCalls
+from glassfrog.functions import messageFunctions
+from glassfrog.functions import nameIndex
+from glassfrog.functions import orgGraph
+from glassfrog.models import Installation
+
+import org_generator
+import stub_servers
+import test_values
+
+# (route, message) pairs exercised by the benchmark
+scenarios = [
+    ('/hipfrog', '/hipfrog'),
+    ('/slashcircle', '/circle'),
+    ('/slashcircle', '/circle delivery'),
+    ('/slashcircle', '/circle delivery members'),
+    ('/slashcircle', '/circle delivery roles'),
+    ('/slashrole', '/role fulfillment'),
+    ('/atrole', 'Hi @role fulfillment, how are you?'),
+    ('/atcircle', 'Hi @circle delivery, how are you?'),
+]
+
+
+def percentile(sortedValues, fraction):
+    index = min(len(sortedValues) - 1, int(round(fraction * (len(sortedValues) - 1))))
+    return sortedValues[index]
+
+
+def clearCaches():
+    apiCalls.glassfrogResponseCache.clear()
+    apiCalls.glassfrogCircuitBreaker.clear()
+    apiCalls.roomPrivacyCache.clear()
+    apiCalls.roomRosterCache.clear()
+    messageFunctions.installationCache.clear()
+    orgGraph.clearOrgGraphs()
+    nameIndex.clearNameIndexes()
+
+
+def addInstallation(hipchatUrl, glassfrogToken):
+    installation = Installation(
+        oauthId=test_values.mock_installdata['oauthId'],
+        capabilitiesUrl=test_values.mock_installdata['capabilitiesUrl'],
+        roomId=test_values.mock_installdata['roomId'],
+        groupId=test_values.mock_installdata['groupId'],
+        oauthSecret=test_values.mock_installdata['oauthSecret'])
+    installation.access_token = test_values.mock_tokenData['access_token']
+    installation.hipchatApiProvider_url = hipchatUrl
+    installation.glassfrogToken = glassfrogToken
+    db.session.add(installation)
+    db.session.commit()
+
+
+def runScenario(client, route, message, requests, cold):
+    messagedata = json.dumps(test_values.mock_messagedata(message))
+    headers = test_values.mock_authorization_headers()
+    timings = []
+    startTime = time.perf_counter()
+    for i in range(requests):
+        if cold:
+            clearCaches()
+        requestStart = time.perf_counter()
+        rv = client.post(route, data=messagedata, headers=headers)
+        timings += [time.perf_counter() - requestStart]
+        if rv.status_code not in (200, 204):
+            raise RuntimeError('{} {!r} returned {}'.format(route, message, rv.status_code))
+    elapsed = time.perf_counter() - startTime
+    return sorted(timings), elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the HipFrog webhook endpoints')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds of latency added by the stub servers per request')
+    parser.add_argument('--cold', action='store_true', help='Clear all caches before each request')
+    parser.add_argument('--database', default='postgresql:///glassfrog_hipchat_test')
+    parser.add_argument('--org-depth', type=int,
+                        help='Serve a synthetic organization with this many levels of subcircles')
+    parser.add_argument('--org-fanout', type=int, default=4, help='Subcircles per circle')
+    parser.add_argument('--org-roles', type=int, default=6, help='Custom roles per circle')
+    parser.add_argument('--org-people-per-role', type=int, default=2)
+    parser.add_argument('--org-collisions', type=float, default=0.2,
+                        help='Chance that a role reuses a name from elsewhere in the organization')
+    args = parser.parse_args(argv)
+
+    if args.org_depth is not None:
+        org = org_generator.SyntheticOrg(depth=args.org_depth, fanout=args.org_fanout,
+                                         rolesPerCircle=args.org_roles,
+                                         peoplePerRole=args.org_people_per_role,
+                                         nameCollisions=args.org_collisions)
+        glassfrogRoutes = org.routes()
+        scenarioList = org.scenarios()
+        print('Synthetic organization: {} circles, {} roles, {} people'.format(
+            len(org.circles), len(org.roles), len(org.people)))
+    else:
+        glassfrogRoutes = stub_servers.glassfrogRoutes()
+        scenarioList = scenarios
+
+    glassfrogServer = stub_servers.StubServer(glassfrogRoutes, latency=args.latency).start()
+    hipchatServer = stub_servers.StubServer(stub_servers.hipchatRoutes(),
+                                            latency=args.latency).start()
+
+    app = glassfrog.app
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    app.config['GLASSFROG_API_URL'] = glassfrogServer.url + '/api/v3/'
+    apiCalls.configure(app.config)
+    db.init_app(app)
+    client = app.test_client()
+
+    print('{:<12} {:<40} {:>9} {:>9} {:>9} {:>9}'.format(
+        'route', 'message', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+    with app.app_context():
+        db.create_all()
+        try:
+            addInstallation(hipchatServer.url, test_values.mock_glassfrogToken)
+            for route, message in scenarioList:
+                clearCaches()
+                timings, elapsed = runScenario(client, route, message, args.requests, args.cold)
+                print('{:<12} {:<40} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f}'.format(
+                    route, message[:40],
+                    percentile(timings, 0.50) * 1000,
+                    percentile(timings, 0.95) * 1000,
+                    percentile(timings, 0.99) * 1000,
+                    len(timings) / elapsed))
+        finally:
+            db.session.remove()
+            db.drop_all()
+            glassfrogServer.stop()
+            hipchatServer.stop()
+
+
+if __name__ == '__main__':
+    main()
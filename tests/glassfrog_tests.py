@@ -1,19 +1,41 @@
 #!/usr/bin/env python3
 import os
+import re
+import io
 import unittest
 import time
+import random
+import shutil
+import tempfile
+import threading
+import concurrent.futures
 import jwt
+import Levenshtein
 from unittest import mock
 from flask import url_for, request, json, jsonify, escape
 
 import glassfrog
 from glassfrog.functions import apiCalls
 from glassfrog.functions import messageFunctions as messageFunctions
+from glassfrog.functions import orgGraph
+from glassfrog.functions import orgModels
+from glassfrog.functions import nameIndex
+from glassfrog.functions import rendering
+from glassfrog.functions import prefetcher
+from glassfrog.functions import snapshotStore
+from glassfrog.functions import caching
+from glassfrog.functions import jsonCodec
+from glassfrog.functions import commandRouter
+from glassfrog.functions import notificationQueue
+from glassfrog.functions.circuitBreaker import CircuitBreaker
 from glassfrog import strings
 from glassfrog.models import *
 from glassfrog import db
 
 import test_values
+import stub_servers
+import org_generator
+import benchmark_webhooks
 
 
 class GlassfrogTestCase(unittest.TestCase):
@@ -23,6 +45,15 @@ class GlassfrogTestCase(unittest.TestCase):
         glassfrog.app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///glassfrog_hipchat_test'
 
         self.app = glassfrog.app.test_client()
+        apiCalls.configure(glassfrog.app.config)
+        apiCalls.glassfrogResponseCache.clear()
+        apiCalls.glassfrogCircuitBreaker.clear()
+        apiCalls.roomPrivacyCache.clear()
+        apiCalls.roomRosterCache.clear()
+        messageFunctions.installationCache.clear()
+        orgGraph.clearOrgGraphs()
+        nameIndex.clearNameIndexes()
+        snapshotStore.clear()
         db.init_app(glassfrog.app)
         with glassfrog.app.app_context():
             db.create_all()
@@ -107,7 +138,7 @@ class GlassfrogTestCase(unittest.TestCase):
         assert db_installation is None
         assert rv.status_code == 200
 
-    @mock.patch('glassfrog.apiCalls.requests.get')
+    @mock.patch('glassfrog.apiCalls.requests.Session.get')
     def test_getRoomMembers(self, mock_requests_get):
         mock_installation = self.defaultInstallation()
         mock_color = strings.succes_color
@@ -116,11 +147,12 @@ class GlassfrogTestCase(unittest.TestCase):
 
         mock_response_room = mock.Mock()
         mock_response_room.status_code = 200
-        mock_response_room.text = json.dumps(test_values.mock_room_response)
+        mock_response_room.content = json.dumps(test_values.mock_room_response).encode('utf-8')
 
         mock_response_members = mock.Mock()
         mock_response_members.status_code = 200
-        mock_response_members.text = json.dumps(test_values.mock_room_members_response)
+        mock_response_members.content = json.dumps(
+            test_values.mock_room_members_response).encode('utf-8')
 
         mock_requests_get.side_effect = [mock_response_room, mock_response_members]
 
@@ -138,14 +170,216 @@ class GlassfrogTestCase(unittest.TestCase):
                 mock_installation.hipchatApiProvider_url, mock_installation.roomId)
         mock_token_header = {"Authorization": "Bearer "+mock_installation.access_token}
 
+        mock_timeout = apiCalls.httpSessions.timeout
         mock_requests_get.assert_has_calls([
-            mock.call(mock_room_requestUrl, headers=mock_token_header),
-            mock.call(mock_members_requestUrl, headers=mock_token_header)])
+            mock.call(mock_room_requestUrl, headers=mock_token_header, timeout=mock_timeout),
+            mock.call(mock_members_requestUrl, headers=mock_token_header, timeout=mock_timeout)])
 
         assert rv == (mock_response_members.status_code, test_values.mock_room_members_response)
 
-    @mock.patch('glassfrog.apiCalls.requests')
-    def test_sendMessage(self, mock_requests):
+    def test_getRoomMentionNames(self):
+        hipchatServer = stub_servers.StubServer(stub_servers.hipchatRoutes()).start()
+        self.addCleanup(hipchatServer.stop)
+        mock_installation = self.defaultInstallation()
+        mock_installation.hipchatApiProvider_url = hipchatServer.url
+        hipchatApiHandler = apiCalls.HipchatApiHandler()
+
+        # The roster is fetched once and served from the cache afterwards
+        for i in range(3):
+            rv = hipchatApiHandler.getRoomMentionNames(installation=mock_installation)
+            assert rv == (200, test_values.mock_room_mention_names)
+        assert len(hipchatServer.requests) == 2
+
+        # Room events drop the cached room details
+        mock_roomevent = {'event': 'room_enter',
+                          'oauth_client_id': mock_installation.oauthId}
+        with mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId',
+                        return_value=mock_installation):
+            rv = self.app.post('/roomchanged', data=json.dumps(mock_roomevent),
+                               headers=test_values.mock_authorization_headers())
+        assert rv.status_code == 204
+        hipchatApiHandler.getRoomMentionNames(installation=mock_installation)
+        assert len(hipchatServer.requests) == 4
+        assert hipchatServer.requests[-1]['path'] == '/room/{}/member'.format(
+            mock_installation.roomId)
+
+    def test_snapshotPrefetcher(self):
+        def respond(match, request):
+            if request['headers']['X-Auth-Token'] == 'broken':
+                return 200, {}
+            if request['headers']['X-Auth-Token'] != test_values.mock_glassfrogToken:
+                return 401, test_values.mock_401_responsebody
+            return 200, {'circles': test_values.mock_circles_response['circles'],
+                         'roles': [], 'people': [],
+                         'linked': test_values.mock_circles_response['linked']}
+        glassfrogServer = stub_servers.StubServer({('GET', r'/api/v3/(\w+)'): respond}).start()
+        self.addCleanup(glassfrogServer.stop)
+        config = dict(glassfrog.app.config, GLASSFROG_API_URL=glassfrogServer.url + '/api/v3/',
+                      PREFETCH_JITTER=0)
+        apiCalls.configure(config)
+
+        # Two installations share a token, two have other tokens and one has none yet
+        for oauthId, glassfrogToken in [('a', test_values.mock_glassfrogToken),
+                                        ('b', test_values.mock_glassfrogToken),
+                                        ('c', 'revoked'), ('d', None), ('e', 'broken')]:
+            installation = self.defaultInstallation()
+            installation.oauthId = oauthId
+            installation.glassfrogToken = glassfrogToken
+            self.addInstallation(installation)
+
+        snapshotPrefetcher = prefetcher.SnapshotPrefetcher(glassfrog.app)
+        snapshotPrefetcher.configure(config)
+        with glassfrog.app.app_context(), mock.patch.object(glassfrog.app.logger, 'exception'):
+            nextRun = snapshotPrefetcher.runDue(1000)
+        paths = sorted((request['headers']['X-Auth-Token'], request['path'])
+                       for request in glassfrogServer.requests)
+        assert paths == sorted([('revoked', '/api/v3/circles'),
+                                ('broken', '/api/v3/circles'),
+                                (test_values.mock_glassfrogToken, '/api/v3/circles'),
+                                (test_values.mock_glassfrogToken, '/api/v3/roles')])
+        assert nextRun == 1000 + config['PREFETCH_INTERVAL']
+
+        # Requests are served from the snapshot
+        code, message = glassfrog.getCircles(test_values.mock_glassfrogToken)
+        assert code == 200
+        assert len(glassfrogServer.requests) == 4
+
+        # Nothing is due before the interval, failing tokens back off
+        with glassfrog.app.app_context(), mock.patch.object(glassfrog.app.logger, 'exception'):
+            snapshotPrefetcher.runDue(1010)
+            assert len(glassfrogServer.requests) == 4
+            snapshotPrefetcher.runDue(1000 + 2 * config['PREFETCH_INTERVAL'])
+        assert len(glassfrogServer.requests) == 4 + 2 + 1 + 1
+        for glassfrogToken in ['revoked', 'broken']:
+            assert snapshotPrefetcher.schedule[glassfrogToken] == (
+                1000 + 2 * config['PREFETCH_INTERVAL'] + 4 * config['PREFETCH_INTERVAL'], 2)
+        assert snapshotPrefetcher.stats() == {'tokens': 3, 'refreshes': 2, 'failures': 4,
+                                              'warmed': 0, 'backingOff': 2,
+                                              'stored': snapshotStore.storeStats}
+
+    def test_snapshotStore(self):
+        org = org_generator.SyntheticOrg(depth=2, fanout=3, seed=4)
+        glassfrogServer = stub_servers.StubServer(org.routes()).start()
+        self.addCleanup(glassfrogServer.stop)
+        config = dict(glassfrog.app.config, GLASSFROG_API_URL=glassfrogServer.url + '/api/v3/',
+                      SNAPSHOT_STORE_ENABLED=True,
+                      PREFETCH_ENDPOINTS=['circles', 'roles', 'people'])
+        apiCalls.configure(config)
+        installation = self.defaultInstallation()
+        self.addInstallation(installation)
+
+        snapshotPrefetcher = prefetcher.SnapshotPrefetcher(glassfrog.app)
+        snapshotPrefetcher.configure(config)
+        with glassfrog.app.app_context():
+            snapshotPrefetcher.runDue(1000)
+            assert SnapshotRole.query.count() == len(org.roles)
+            assert SnapshotPerson.query.count() == len(org.people)
+            assert SnapshotCircle.query.count() == len(org.circles)
+        inserted = len(org.circles) + len(org.roles) + len(org.people)
+        assert snapshotStore.storeStats == {'inserted': inserted, 'updated': 0, 'deleted': 0}
+
+        # An unchanged refresh writes nothing, a changed one only the difference
+        removedRole = org.roles.pop()
+        org.roles[0] = dict(org.roles[0], name='Renamed role')
+        org.people += [{'id': 999999, 'name': 'New Person', 'email': 'new@example.com',
+                        'external_id': None, 'links': {'circles': []}}]
+        with glassfrog.app.app_context():
+            for apiEndpoint, changes in [('roles', (0, 1, 1)), ('people', (1, 0, 0)),
+                                         ('circles', (0, 0, 0))]:
+                snapshot = orgModels.OrgSnapshot(apiEndpoint, org.response(apiEndpoint)[1])
+                assert snapshotStore.storeResponse(
+                    test_values.mock_glassfrogToken, apiEndpoint, snapshot) == changes
+            assert SnapshotRole.query.filter_by(glassfrogToken=test_values.mock_glassfrogToken,
+                                                id=removedRole['id']).first() is None
+
+        # A restarted process serves the stored snapshot without calling GlassFrog
+        requestCount = len(glassfrogServer.requests)
+        apiCalls.glassfrogResponseCache.clear()
+        orgGraph.clearOrgGraphs()
+        snapshotStore.clear()
+        snapshotPrefetcher = prefetcher.SnapshotPrefetcher(glassfrog.app)
+        snapshotPrefetcher.configure(config)
+        with glassfrog.app.app_context():
+            assert snapshotPrefetcher.warmStart(2000) == 1
+        refreshAt, failures = snapshotPrefetcher.schedule[test_values.mock_glassfrogToken]
+        assert 2000 <= refreshAt <= 2000 + config['PREFETCH_INTERVAL']
+        for apiEndpoint in ['circles', 'roles', 'people']:
+            code, snapshot = apiCalls.GlassfrogApiHandler().glassfrogApiCall(
+                apiEndpoint, test_values.mock_glassfrogToken)
+            assert code == 200
+            assert snapshot.toResponse() == orgModels.OrgSnapshot(
+                apiEndpoint, org.response(apiEndpoint)[1]).toResponse()
+        code, message = glassfrog.getCircles(test_values.mock_glassfrogToken)
+        assert code == 200
+        assert len(glassfrogServer.requests) == requestCount
+
+    def test_snapshotStore_fetchedAt(self):
+        org = org_generator.SyntheticOrg(depth=1, fanout=2)
+        cache = apiCalls.glassfrogResponseCache
+        snapshots = {apiEndpoint: orgModels.OrgSnapshot(apiEndpoint, org.response(apiEndpoint)[1])
+                     for apiEndpoint in ['circles', 'roles', 'people']}
+        now = time.time()
+        fetchedAt = {'circles': now - 10, 'roles': now - cache.ttl - 10,
+                     'people': now - cache.ttl - cache.stale - 10}
+        with glassfrog.app.app_context():
+            for apiEndpoint, snapshot in snapshots.items():
+                snapshotStore.storeResponse(test_values.mock_glassfrogToken, apiEndpoint,
+                                            snapshot, fetchedAt=now - 1000)
+                # Storing the same snapshot again only marks it as fetched again
+                assert snapshotStore.storeResponse(test_values.mock_glassfrogToken, apiEndpoint,
+                                                   snapshot,
+                                                   fetchedAt=fetchedAt[apiEndpoint]) == (0, 0, 0)
+            assert {fetched for fetched, in db.session.query(SnapshotRole.fetchedAt)} == {
+                fetchedAt['roles']}
+
+            snapshotStore.clear()
+            loaded = snapshotStore.warmCache(cache, now=now)
+
+        # Fresh snapshots are served, older ones as stale until revalidated, expired ones not
+        assert sorted(loaded) == [(test_values.mock_glassfrogToken, 'circles'),
+                                  (test_values.mock_glassfrogToken, 'roles')]
+        code, snapshot, validators = cache.get((test_values.mock_glassfrogToken, 'circles'))
+        assert snapshot == snapshots['circles']
+        assert cache.get((test_values.mock_glassfrogToken, 'roles')) is None
+        code, snapshot, validators = cache.getStale((test_values.mock_glassfrogToken, 'roles'))
+        assert snapshot == snapshots['roles']
+        assert cache.getStale((test_values.mock_glassfrogToken, 'people')) is None
+
+    def test_snapshotStore_deleted(self):
+        snapshot = orgModels.OrgSnapshot('roles', test_values.mock_roles_response)
+        installation = self.addInstallation(self.defaultInstallation())
+        other = self.defaultInstallation()
+        other.oauthId = 'other-installation'
+        self.addInstallation(other)
+        with glassfrog.app.app_context():
+            for glassfrogToken in [test_values.mock_glassfrogToken, 'other-token']:
+                snapshotStore.storeResponse(glassfrogToken, 'roles', snapshot)
+
+        def storedTokens():
+            with glassfrog.app.app_context():
+                return {glassfrogToken for glassfrogToken,
+                        in db.session.query(SnapshotRole.glassfrogToken)}
+
+        # Kept while another installation still uses the token
+        self.app.delete('/installed/{}'.format(installation.oauthId))
+        assert storedTokens() == {test_values.mock_glassfrogToken, 'other-token'}
+        self.app.delete('/installed/{}'.format(other.oauthId))
+        assert storedTokens() == {'other-token'}
+        assert (test_values.mock_glassfrogToken, 'roles') not in snapshotStore.lastStored
+
+        # Replaced when configure sets another token
+        installation = self.defaultInstallation()
+        installation.glassfrogToken = 'other-token'
+        self.addInstallation(installation)
+        with mock.patch('glassfrog.getCircles', return_value=(401, 'Invalid token')), \
+                mock.patch('glassfrog.messageFunctions.getInstallationFromJWT',
+                           return_value=installation):
+            self.app.post('/configure.html', data=dict(glassfrogtoken='new-token'),
+                          query_string=test_values.mock_jwt_data('bogus'))
+        assert storedTokens() == set()
+
+    @mock.patch('glassfrog.apiCalls.requests.Session.post')
+    def test_sendMessage(self, mock_requests_post):
         mock_installation = self.defaultInstallation()
         mock_color = strings.succes_color
         mock_message = 'Test!'
@@ -160,18 +394,20 @@ class GlassfrogTestCase(unittest.TestCase):
         mock_token_header = {"Authorization": "Bearer "+mock_installation.access_token}
         mock_data = messageFunctions.createMessageDict(mock_color, mock_message)
 
-        mock_requests.post.assert_called_with(mock_messageUrl,
+        mock_requests_post.assert_called_with(mock_messageUrl,
                                               headers=mock_token_header,
-                                              data=mock_data)
+                                              data=mock_data,
+                                              timeout=apiCalls.httpSessions.timeout)
 
-    @mock.patch('glassfrog.apiCalls.requests.get')
+    @mock.patch('glassfrog.apiCalls.requests.Session.get')
     def test_glassfrogApiCall(self, mock_requests_get):
         glassfrogApiHandler = apiCalls.GlassfrogApiHandler()
         mock_apiEndpoint = 'circles'
 
         mock_response = mock.Mock()
         mock_response.status_code = 200
-        mock_response.text = json.dumps(test_values.mock_circles_response)
+        mock_response.content = json.dumps(test_values.mock_circles_response).encode('utf-8')
+        mock_response.headers = {}
         mock_requests_get.return_value = mock_response
 
         code, responsebody = glassfrogApiHandler.glassfrogApiCall(mock_apiEndpoint,
@@ -179,7 +415,475 @@ class GlassfrogTestCase(unittest.TestCase):
 
         mock_headers = {'X-Auth-Token': test_values.mock_glassfrogToken}
         mock_apiUrl = 'https://glassfrog.holacracy.org/api/v3/'+mock_apiEndpoint
-        mock_requests_get.assert_called_with(mock_apiUrl, headers=mock_headers)
+        mock_requests_get.assert_called_with(mock_apiUrl, headers=mock_headers,
+                                             timeout=apiCalls.httpSessions.timeout)
+
+    @mock.patch('glassfrog.apiCalls.requests.Session.get')
+    def test_glassfrogApiCall_cache(self, mock_requests_get):
+        glassfrogApiHandler = apiCalls.GlassfrogApiHandler()
+
+        mock_response = mock.Mock()
+        mock_response.status_code = 200
+        mock_response.content = json.dumps(test_values.mock_circles_response).encode('utf-8')
+        mock_response.headers = {}
+        mock_requests_get.return_value = mock_response
+
+        # Second identical call is served from the cache
+        rv1 = glassfrogApiHandler.glassfrogApiCall('circles', test_values.mock_glassfrogToken)
+        rv2 = glassfrogApiHandler.glassfrogApiCall('circles', test_values.mock_glassfrogToken)
+        assert rv1 == rv2 == (200, orgModels.OrgSnapshot('circles',
+                                                         test_values.mock_circles_response))
+        assert mock_requests_get.call_count == 1
+        stats = apiCalls.glassfrogResponseCache.stats()
+        assert stats['hits'] == 1 and stats['misses'] == 1
+
+        # Other tokens have their own entries
+        glassfrogApiHandler.glassfrogApiCall('circles', 'other-token')
+        assert mock_requests_get.call_count == 2
+
+        # Errors are not cached
+        mock_response.status_code = 401
+        mock_response.content = json.dumps(test_values.mock_401_responsebody).encode('utf-8')
+        glassfrogApiHandler.glassfrogApiCall('roles', test_values.mock_glassfrogToken)
+        glassfrogApiHandler.glassfrogApiCall('roles', test_values.mock_glassfrogToken)
+        assert mock_requests_get.call_count == 4
+
+        # Nor are organization-wide responses missing the fields of a snapshot
+        mock_response.status_code = 200
+        mock_response.content = json.dumps({'people': [{'name': 'No id'}]}).encode('utf-8')
+        rv = glassfrogApiHandler.glassfrogApiCall('people', test_values.mock_glassfrogToken)
+        assert rv == (502, {'message': strings.glassfrog_invalid_response.format(200)})
+        glassfrogApiHandler.glassfrogApiCall('people', test_values.mock_glassfrogToken)
+        assert mock_requests_get.call_count == 6
+
+    def test_glassfrogApiCall_conditional(self):
+        upstream = {'roles': test_values.mock_roles_response}
+
+        def respond(match, request):
+            if match.group(1) == 'circles':
+                # GlassFrog with an ETag
+                if request['headers'].get('If-None-Match') == '"circles-1"':
+                    return 304, None, {'ETag': '"circles-1"'}
+                return 200, test_values.mock_circles_response, {'ETag': '"circles-1"'}
+            if match.group(1) == 'people':
+                return 200, test_values.mock_circle_members_response, {
+                    'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+            # No validators at all
+            return 200, upstream['roles']
+        glassfrogServer = stub_servers.StubServer({('GET', r'/api/v3/(\w+)'): respond}).start()
+        self.addCleanup(glassfrogServer.stop)
+        apiCalls.configure(dict(glassfrog.app.config,
+                                GLASSFROG_API_URL=glassfrogServer.url + '/api/v3/'))
+        glassfrogApiHandler = apiCalls.GlassfrogApiHandler()
+        conditionalStats = dict(apiCalls.conditionalStats)
+
+        def refresh(apiEndpoint):
+            return glassfrogApiHandler.glassfrogApiCall(apiEndpoint,
+                                                        test_values.mock_glassfrogToken,
+                                                        refresh=True)
+
+        # 304 keeps the cached response
+        code, circles = refresh('circles')
+        assert 'If-None-Match' not in glassfrogServer.requests[-1]['headers']
+        assert refresh('circles') == (200, circles)
+        assert refresh('circles')[1] is circles
+        assert glassfrogServer.requests[-1]['headers']['If-None-Match'] == '"circles-1"'
+        assert apiCalls.conditionalStats['notModified'] == conditionalStats['notModified'] + 2
+
+        # This GlassFrog ignores If-Modified-Since, the unchanged body is reused
+        code, people = refresh('people')
+        assert refresh('people')[1] is people
+        assert glassfrogServer.requests[-1]['headers']['If-Modified-Since'] == (
+            'Wed, 21 Oct 2015 07:28:00 GMT')
+
+        # Unchanged bodies are not parsed again, changed ones are
+        code, roles = refresh('roles')
+        assert refresh('roles')[1] is roles
+        assert apiCalls.conditionalStats['unchanged'] == conditionalStats['unchanged'] + 2
+        upstream['roles'] = {'roles': []}
+        assert refresh('roles') == (200, orgModels.OrgSnapshot('roles', {'roles': []}))
+        assert apiCalls.glassfrogResponseCache.get(
+            (test_values.mock_glassfrogToken, 'roles'))[1].roles == []
+
+    def test_glassfrogApiCall_stale(self):
+        upstream = {'status': 200, 'body': test_values.mock_circles_response}
+        glassfrogServer = stub_servers.StubServer({
+            ('GET', r'/api/v3/\w+'): lambda match, request: (upstream['status'], upstream['body'])
+        }).start()
+        self.addCleanup(glassfrogServer.stop)
+        apiCalls.configure(dict(glassfrog.app.config,
+                                GLASSFROG_API_URL=glassfrogServer.url + '/api/v3/',
+                                GLASSFROG_CACHE_TTL=0.1, CIRCUIT_BREAKER_THRESHOLD=2))
+        glassfrogApiHandler = apiCalls.GlassfrogApiHandler()
+
+        def waitForRevalidation(requestCount):
+            deadline = time.monotonic() + 5
+            while (apiCalls.glassfrogCircuitBreaker.stats()['failing'] == 0 or
+                   apiCalls._revalidating) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert len(glassfrogServer.requests) == requestCount
+
+        mock_circles_snapshot = orgModels.OrgSnapshot('circles', test_values.mock_circles_response)
+        rv = glassfrogApiHandler.glassfrogApiCall('circles', test_values.mock_glassfrogToken)
+        assert rv == (200, mock_circles_snapshot)
+
+        # GlassFrog breaks: the expired response is served at once and refreshed afterwards
+        upstream.update(status=500, body=b'<html>Internal Server Error</html>')
+        time.sleep(0.15)
+        with glassfrog.app.test_request_context():
+            rv = glassfrogApiHandler.glassfrogApiCall('circles', test_values.mock_glassfrogToken)
+            assert rv == (200, mock_circles_snapshot)
+            message_dict = messageFunctions.createMessageDict(strings.succes_color, 'Circles')
+            assert message_dict['message'] == 'Circles'
+        waitForRevalidation(2)
+
+        # Once the token is failing, answers say they may be outdated, also when the response
+        # was read on an upstream thread of the request
+        with glassfrog.app.test_request_context():
+            rv = glassfrog.submitUpstream(glassfrogApiHandler.glassfrogApiCall, 'circles',
+                                          test_values.mock_glassfrogToken).result()
+            assert rv == (200, mock_circles_snapshot)
+            message_dict = messageFunctions.createMessageDict(strings.succes_color, 'Circles')
+            assert message_dict['message'] == 'Circles' + strings.stale_response
+        waitForRevalidation(3)
+
+        # The open circuit keeps calls away from GlassFrog
+        assert apiCalls.glassfrogCircuitBreaker.stats()['open'] == 1
+        startTime = time.perf_counter()
+        rv = glassfrogApiHandler.glassfrogApiCall('circles', test_values.mock_glassfrogToken)
+        assert rv == (200, mock_circles_snapshot)
+        rv = glassfrogApiHandler.glassfrogApiCall('roles', test_values.mock_glassfrogToken)
+        assert rv == (503, {'message': strings.glassfrog_unavailable})
+        assert time.perf_counter() - startTime < 0.05
+        waitForRevalidation(3)
+
+        # Responses that are not JSON do not raise
+        rv = glassfrogApiHandler.glassfrogApiCall('circles', 'other-token')
+        assert rv == (502, {'message': strings.glassfrog_invalid_response.format(500)})
+
+    def test_glassfrogApiCall_coalesced(self):
+        glassfrogServer = stub_servers.StubServer(stub_servers.glassfrogRoutes(),
+                                                  latency=0.2).start()
+        self.addCleanup(glassfrogServer.stop)
+        apiCalls.configure(dict(glassfrog.app.config,
+                                GLASSFROG_API_URL=glassfrogServer.url + '/api/v3/'))
+        coalesced = apiCalls.glassfrogFlights.stats()['coalesced']
+
+        # Callers arriving while the first request is in flight share its response, only the
+        # request that made the call counts it as upstream
+        memos = [caching.RequestMemo() for i in range(8)]
+
+        def glassfrogApiCall(memo, apiEndpoint):
+            return apiCalls.runWithMemo(memo, apiCalls.GlassfrogApiHandler().glassfrogApiCall,
+                                        apiEndpoint, test_values.mock_glassfrogToken)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(glassfrogApiCall, memos,
+                                          ['circles'] * 6 + ['roles'] * 2))
+        assert len(glassfrogServer.requests) == 2
+        assert sum(memo.stats()['upstreamCalls'] for memo in memos) == 2
+        assert all(response[1] is responses[0][1] for response in responses[:6])
+        assert responses[-1] == (200, orgModels.OrgSnapshot('roles',
+                                                            test_values.mock_roles_response))
+        assert apiCalls.glassfrogFlights.stats() == {'inFlight': 0,
+                                                     'coalesced': coalesced + 6}
+
+    @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId')
+    def test_requestMemo(self, mock_getInstallationFromOauthId):
+        org = org_generator.SyntheticOrg(depth=1, fanout=2, seed=3)
+        glassfrogServer = stub_servers.StubServer(org.routes()).start()
+        self.addCleanup(glassfrogServer.stop)
+        hipchatServer = stub_servers.StubServer(stub_servers.hipchatRoutes()).start()
+        self.addCleanup(hipchatServer.stop)
+        # Without a response cache only the memo keeps a request from refetching
+        apiCalls.configure(dict(glassfrog.app.config, CACHE_BACKEND='memory',
+                                GLASSFROG_API_URL=glassfrogServer.url + '/api/v3/',
+                                GLASSFROG_CACHE_TTL=0, GLASSFROG_STALE_TTL=0))
+        mock_installation = self.defaultInstallation()
+        mock_installation.hipchatApiProvider_url = hipchatServer.url
+        mock_getInstallationFromOauthId.return_value = mock_installation
+
+        circle = org.circles[1]
+        roles = [role for role in org.circleRoles(circle['id'])
+                 if role['links']['supporting_circle'] is None]
+        circleName = circle['name'].lower().replace(' ', '-')
+        mock_command = ' '.join('@role {}:{}'.format(circleName,
+                                                     role['name'].lower().replace(' ', '-'))
+                                for role in roles[:2])
+        requestsBefore = dict(apiCalls.requestMemoStats)
+        with mock.patch.dict(glassfrog.app.config, {'CACHE_STATS_ENABLED': True}):
+            rv = self.app.post('/atrole', headers=test_values.mock_authorization_headers(),
+                               data=json.dumps(test_values.mock_messagedata(mock_command)))
+        assert json.loads(rv.get_data())['color'] == strings.succes_color
+
+        # circles and circles/id/roles are needed for both roles, but fetched once
+        paths = [request['path'] for request in glassfrogServer.requests]
+        assert sorted(paths) == sorted(set(paths))
+        assert sorted(paths) == sorted(['/api/v3/circles',
+                                        '/api/v3/circles/{}/roles'.format(circle['id']),
+                                        '/api/v3/roles/{}'.format(roles[0]['id']),
+                                        '/api/v3/roles/{}'.format(roles[1]['id'])])
+        assert rv.headers['X-Glassfrog-Upstream-Calls'] == str(len(paths))
+        assert apiCalls.requestMemoStats['requests'] == requestsBefore['requests'] + 1
+        assert apiCalls.requestMemoStats['hits'] == requestsBefore['hits'] + 2
+
+        # Outside of a request nothing is remembered
+        apiCalls.GlassfrogApiHandler().glassfrogApiCall('circles', test_values.mock_glassfrogToken)
+        assert len(glassfrogServer.requests) == len(paths) + 1
+
+    def test_singleFlight(self):
+        singleFlight = caching.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def failing():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            raise ValueError('upstream')
+
+        def call():
+            try:
+                singleFlight.do('key', failing)
+            except ValueError as error:
+                return error
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            first = executor.submit(call)
+            started.wait(5)
+            others = [executor.submit(call) for i in range(2)]
+            while singleFlight.stats()['coalesced'] < 2:
+                time.sleep(0.01)
+            release.set()
+            errors = [future.result() for future in [first] + others]
+        assert len(calls) == 1
+        assert all(error is errors[0] for error in errors)
+
+        # Later calls run again
+        assert singleFlight.do('key', lambda: 'result') == 'result'
+
+    def test_circuitBreaker(self):
+        circuitBreaker = CircuitBreaker(threshold=2, resetTimeout=0.05)
+        assert circuitBreaker.allow('token')
+        circuitBreaker.recordFailure('token')
+        assert circuitBreaker.allow('token') and circuitBreaker.isFailing('token')
+        circuitBreaker.recordFailure('token')
+        assert not circuitBreaker.allow('token')
+        assert circuitBreaker.allow('other-token')
+
+        # One trial call after the timeout, failing opens the circuit again
+        time.sleep(0.06)
+        assert circuitBreaker.allow('token')
+        assert not circuitBreaker.allow('token')
+        circuitBreaker.recordFailure('token')
+        assert not circuitBreaker.allow('token')
+        time.sleep(0.06)
+        assert circuitBreaker.allow('token')
+        circuitBreaker.recordSuccess('token')
+        assert circuitBreaker.allow('token') and not circuitBreaker.isFailing('token')
+        assert circuitBreaker.stats()['rejected'] == 3
+
+    def test_commandRouter(self):
+        Command = commandRouter.Command
+        assert commandRouter.parseMessage('/Circle Sales Members') == {
+            'slashcircle': Command('slashcircle', ['sales', 'members'])}
+        assert commandRouter.parseMessage('/roles') == {'slashrole': Command('slashrole')}
+        assert commandRouter.parseMessage('/hipfrogs') == {}
+        assert commandRouter.parseMessage('Hi /role x') == {}
+        # Every mention, circles without a role part, mentions without a name still count
+        assert commandRouter.parseMessage(
+            '@role sales:secretary and @Circle sales:x, @roles facilitator @circle') == {
+            'atrole': Command('atrole', identifiers=['sales:secretary', 'facilitator']),
+            'atcircle': Command('atcircle', identifiers=['sales'])}
+        assert commandRouter.parseMessage('@role: hi') == {'atrole': Command('atrole')}
+        for message in ['Beste @Role 1000: Hoi!', 'a @circle b-c:d @role e @rolex f']:
+            assert commandRouter.getCommand(message, 'atrole').identifiers == re.findall(
+                strings.regex_at_role_roleId, message)
+            assert commandRouter.getCommand(message, 'atcircle').identifiers == re.findall(
+                strings.regex_at_circle_circleId, message)
+        # Webhooks get the command they were registered for
+        assert commandRouter.getCommand('/hipfrog help', 'slashcircle') == Command(
+            'slashcircle', ['help'])
+        assert commandRouter.getCommand('/hipfrog', 'slashcircle') == Command('slashcircle')
+        # A bare slash command is a lookup of the whole message
+        assert commandRouter.getCommand('/circle', 'slashcircle') is \
+            commandRouter.parseMessage('/circle')['slashcircle']
+
+        router = commandRouter.CommandRouter()
+        router.handles('slashrole')(lambda command, suffix: command.arguments[0] + suffix)
+        assert router.dispatch(Command('slashrole', ['secretary']), '!') == 'secretary!'
+
+    def test_jsonCodec(self):
+        data = json.dumps(test_values.mock_roles_response).encode('utf-8')
+        for name, codec in jsonCodec.codecs.items():
+            assert codec.loads(data) == test_values.mock_roles_response
+            assert codec.loads(codec.dumps(test_values.mock_roles_response)) == (
+                test_values.mock_roles_response)
+            with self.assertRaises(ValueError):
+                codec.loads(b'<html>Bad Gateway</html>')
+        assert jsonCodec.getCodec('stdlib').name == 'stdlib'
+        assert jsonCodec.getCodec('auto').name in jsonCodec.codecs
+        with self.assertRaises(ValueError):
+            jsonCodec.getCodec('simplejson')
+
+        # Webhooks answer through the configured codec
+        with mock.patch.object(jsonCodec, 'codec', jsonCodec.codecs['stdlib']):
+            self.addInstallation(self.defaultInstallation())
+            rv = self.app.post('/hipfrog',
+                               data=json.dumps(test_values.mock_messagedata('/hipfrog')),
+                               headers=test_values.mock_authorization_headers())
+            assert rv.mimetype == 'application/json'
+            assert jsonCodec.loads(rv.get_data())['message'] == strings.help_hipfrog
+
+    def test_sessionPool(self):
+        sessionPool = apiCalls.SessionPool(poolsize=4, timeout=(1, 2))
+        session = sessionPool.getSession('https://glassfrog.holacracy.org/api/v3/circles')
+        # Sessions are shared per host and reused across calls
+        assert session is sessionPool.getSession('https://glassfrog.holacracy.org/api/v3/roles')
+        assert session is not sessionPool.getSession('https://api.hipchat.com/v2/room/1')
+        assert session.get_adapter('https://glassfrog.holacracy.org')._pool_maxsize == 4
+
+        with mock.patch('glassfrog.apiCalls.requests.Session.get') as mock_requests_get:
+            sessionPool.get('https://glassfrog.holacracy.org/api/v3/circles')
+            mock_requests_get.assert_called_with(
+                'https://glassfrog.holacracy.org/api/v3/circles', timeout=(1, 2))
+
+        # Changing the pool size drops the existing sessions
+        sessionPool.configure(poolsize=8)
+        assert session is not sessionPool.getSession('https://glassfrog.holacracy.org/')
+        sessionPool.close()
+
+    @mock.patch('glassfrog.functions.caching.time.time')
+    def test_sharedCache(self, mock_time):
+        mock_time.return_value = 1000
+        path = os.path.join(tempfile.mkdtemp(), 'cache.sqlite')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+
+        # Two workers with their own store on the same file
+        cache = caching.SharedCache(caching.SQLiteStore(path), 'glassfrog', ttl=10, maxsize=2)
+        otherCache = caching.SharedCache(caching.SQLiteStore(path), 'glassfrog', ttl=10,
+                                         maxsize=2)
+        cache.set(('token', 'circles'), test_values.mock_circles_response)
+        rv = otherCache.get(('token', 'circles'))
+        assert rv == test_values.mock_circles_response
+        # Unchanged entries are not decoded again
+        assert otherCache.get(('token', 'circles')) is rv
+        assert otherCache.get(('token', 'roles')) is None
+
+        # Expiry and invalidation are shared
+        mock_time.return_value = 1010
+        assert otherCache.get(('token', 'circles')) is None
+        cache.set(('token', 'circles'), test_values.mock_circles_response)
+        otherCache.invalidate(('token', 'circles'))
+        assert cache.get(('token', 'circles')) is None
+
+        # Entries beyond maxsize and maxbytes are evicted oldest first
+        for i in range(3):
+            mock_time.return_value = 1020 + i
+            cache.set(('token', 'circles/{}'.format(i)), 'x' * 100)
+        assert cache.get(('token', 'circles/0')) is None
+        stats = otherCache.stats()
+        assert stats['size'] == 2 and 200 < stats['bytes'] < 300
+        cache.store.maxbytes = 150
+        cache.set(('token', 'circles/3'), 'x' * 100)
+        assert cache.stats()['size'] == 1
+        assert otherCache.get(('token', 'circles/3')) == 'x' * 100
+
+        # Namespaces are independent
+        cache.store.maxbytes = 64 * 1024
+        installationCache = caching.SharedCache(cache.store, 'installation',
+                                                encode=messageFunctions.encodeInstallation,
+                                                decode=messageFunctions.decodeInstallation)
+        installationCache.set('oauthId', self.defaultInstallation())
+        assert installationCache.get('oauthId') == self.defaultInstallation()
+        installationCache.clear()
+        assert cache.stats()['size'] == 1
+
+        # Entries are JSON in a file only this user can read, never pickles
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        storedAt, value = cache.store.get('glassfrog', json.dumps(['token', 'circles/3']))
+        assert json.loads(value) == {'value': 'x' * 100}
+        cache.store.set('glassfrog', json.dumps(['token', 'pickled']), b'\x80\x04K\x01.',
+                        storedAt, 10)
+        assert cache.get(('token', 'pickled')) is None
+        with mock.patch('os.getuid', return_value=os.getuid() + 1):
+            with self.assertRaises(PermissionError):
+                caching.SQLiteStore(path)
+
+    def test_configureCache(self):
+        path = os.path.join(tempfile.mkdtemp(), 'cache.sqlite')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        config = dict(glassfrog.app.config, CACHE_BACKEND='sqlite', CACHE_SQLITE_PATH=path)
+        apiCalls.configure(config)
+        self.addCleanup(apiCalls.configure, glassfrog.app.config)
+        sharedCache = apiCalls.glassfrogResponseCache
+        assert isinstance(sharedCache, caching.SharedCache)
+        assert isinstance(messageFunctions.installationCache, caching.SharedCache)
+        apiCalls.configure(config)
+        assert apiCalls.glassfrogResponseCache is sharedCache
+
+        # Installations are shared as detached snapshots
+        self.addInstallation(self.defaultInstallation())
+        with glassfrog.app.app_context():
+            installation = messageFunctions.getInstallationFromOauthId(
+                test_values.mock_installdata['oauthId'])
+        messageFunctions.installationCache._loaded.clear()
+        assert messageFunctions.installationCache.get(installation.oauthId) == installation
+
+        apiCalls.configure(dict(config, CACHE_BACKEND='memory'))
+        assert isinstance(apiCalls.glassfrogResponseCache, caching.TTLCache)
+        with self.assertRaises(ValueError):
+            apiCalls.configure(dict(config, CACHE_BACKEND='memcached'))
+
+    @mock.patch('glassfrog.functions.caching.time.monotonic')
+    def test_TTLCache(self, mock_monotonic):
+        mock_monotonic.return_value = 0
+        cache = apiCalls.TTLCache(ttl=10, maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        # 'b' is now least recently used and gets evicted
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+
+        mock_monotonic.return_value = 10
+        assert cache.get('a') is None
+        assert cache.stats() == {'hits': 2, 'misses': 2, 'staleHits': 0, 'size': 1, 'maxsize': 2,
+                                 'ttl': 10, 'stale': 0}
+
+    @mock.patch('glassfrog.apiCalls.HipchatApiHandler')
+    @mock.patch('glassfrog.getCircles')
+    def test_getInstallationFromOauthId_cache(self, mock_getCircles, mock_HipchatApiHandler):
+        installation = self.addInstallation()
+        oauthId = installation.oauthId
+
+        with glassfrog.app.app_context():
+            cached_installation = messageFunctions.getInstallationFromOauthId(oauthId)
+            assert cached_installation.oauthSecret == installation.oauthSecret
+            # Served from the cache without a database round-trip
+            with mock.patch('glassfrog.functions.messageFunctions.Installation') as \
+                    mock_Installation:
+                assert messageFunctions.getInstallationFromOauthId(oauthId) is \
+                    cached_installation
+                assert not mock_Installation.query.filter_by.called
+        stats = messageFunctions.installationCache.stats()
+        assert stats['hits'] == 1 and stats['misses'] == 1
+
+        # Configuring stores the token and drops the snapshot
+        mock_getCircles.return_value = (200, test_values.mock_circles_message)
+        with mock.patch('glassfrog.functions.messageFunctions.getInstallationFromJWT',
+                        return_value=cached_installation):
+            self.app.post('/configure.html', data=dict(glassfrogtoken='new-token'),
+                          query_string=test_values.mock_jwt_data('bogus'))
+        with glassfrog.app.app_context():
+            configured_installation = messageFunctions.getInstallationFromOauthId(oauthId)
+            assert configured_installation is not cached_installation
+            assert configured_installation.glassfrogToken == 'new-token'
+
+        # Uninstalling drops the snapshot
+        self.app.delete('/installed/{}'.format(oauthId))
+        with glassfrog.app.app_context():
+            assert messageFunctions.getInstallationFromOauthId(oauthId) is None
 
     def test_getInstallationFromJWT(self):
         oauthId = test_values.mock_installdata['oauthId']
@@ -197,6 +901,71 @@ class GlassfrogTestCase(unittest.TestCase):
             installation = messageFunctions.getInstallationFromJWT(mock_jwt_encoded)
         assert installation is not None
 
+    @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId')
+    def test_webhook_jwt(self, mock_getInstallationFromOauthId):
+        mock_installation = self.defaultInstallation()
+        mock_getInstallationFromOauthId.return_value = mock_installation
+        mock_messagedata = json.dumps(test_values.mock_messagedata('/hipfrog'))
+        expiry = int(time.time())+1000
+
+        rv = self.app.post('/hipfrog', data=mock_messagedata,
+                           headers=test_values.mock_authorization_headers())
+        assert rv.status_code == 200
+
+        for mock_headers in [{},
+                             test_values.mock_authorization_headers('banana'),
+                             test_values.mock_authorization_headers(
+                                 test_values.mock_jwt_encoded(expiry, secret='wrong' * 8)),
+                             test_values.mock_authorization_headers(
+                                 test_values.mock_jwt_encoded(int(time.time())-1000))]:
+            rv = self.app.post('/hipfrog', data=mock_messagedata, headers=mock_headers)
+            assert rv.status_code == 401
+
+        # Malformed claims are rejected, before and after the signature is checked
+        for claims in [{'iss': ['x']}, {'exp': None}, {'exp': 'soon'},
+                       {'nbf': int(time.time())+1000}]:
+            signed_request = jwt.PyJWS().encode(
+                json.dumps(dict(test_values.mock_jwt_decoded(expiry), **claims)).encode('utf-8'),
+                mock_installation.oauthSecret, algorithm='HS256')
+            rv = self.app.post('/hipfrog', data=mock_messagedata,
+                               headers=test_values.mock_authorization_headers(signed_request))
+            assert rv.status_code == 401
+
+        # The token must be issued for the installation the message claims to come from
+        mock_otherdata = test_values.mock_messagedata('/hipfrog')
+        mock_otherdata['oauth_client_id'] = 'someone-else'
+        rv = self.app.post('/hipfrog', data=json.dumps(mock_otherdata),
+                           headers=test_values.mock_authorization_headers())
+        assert rv.status_code == 401
+
+        # The body is parsed once, and a body that is not a JSON object is rejected
+        loads = glassfrog.jsonCodec.loads
+        with mock.patch('glassfrog.jsonCodec.loads', wraps=loads) as mock_loads, \
+                mock.patch('flask.Request.get_json') as mock_get_json:
+            rv = self.app.post('/hipfrog', data=mock_messagedata,
+                               headers=test_values.mock_authorization_headers())
+        assert rv.status_code == 200
+        assert mock_loads.call_count == 1
+        assert not mock_get_json.called
+        for mock_body in ['{"oauth_client_id": ', '[]']:
+            rv = self.app.post('/hipfrog', data=mock_body,
+                               headers=test_values.mock_authorization_headers())
+            assert rv.status_code == 400
+
+        # The token is decoded once and the secret comes from the installation cache
+        header, claims, signing_input, signature = messageFunctions.decodeJWT(
+            test_values.mock_jwt_encoded(expiry))
+        assert header['alg'] == 'HS256'
+        assert claims == test_values.mock_jwt_decoded(expiry)
+        installation, claims = messageFunctions.verifyJWT(test_values.mock_jwt_encoded(expiry))
+        assert installation is mock_installation
+        mock_getInstallationFromOauthId.assert_called_with(claims['iss'])
+
+        with mock.patch.dict(glassfrog.app.config, {'VERIFY_WEBHOOK_JWT': False}):
+            rv = self.app.post('/hipfrog', data=mock_messagedata,
+                               headers=test_values.mock_authorization_headers('banana'))
+        assert rv.status_code == 200
+
     @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromJWT')
     @mock.patch('glassfrog.apiCalls.HipchatApiHandler')
     @mock.patch('glassfrog.getCircles')
@@ -234,7 +1003,7 @@ class GlassfrogTestCase(unittest.TestCase):
     def test_getCircles(self, mock_glassfrogApiHandler):
         # Succesfull call
         mock_glassfrogApiHandler.return_value.glassfrogApiCall.return_value = (
-            200, test_values.mock_circles_response)
+            200, orgModels.OrgSnapshot('circles', test_values.mock_circles_response))
         rv = glassfrog.getCircles(test_values.mock_glassfrogToken)
         assert mock_glassfrogApiHandler.return_value.glassfrogApiCall.called
         for circle in test_values.mock_circles_response['circles']:
@@ -243,10 +1012,124 @@ class GlassfrogTestCase(unittest.TestCase):
 
         # TODO Failing call
 
+    def test_orgGraph(self):
+        snapshot = orgModels.OrgSnapshot('circles', test_values.mock_circles_response)
+        graph = orgGraph.OrgGraph(snapshot)
+        assert graph.getAnchorCircles() == [8495]
+        assert graph.getChildren(8495) == [9032, 15512]
+        assert graph.getChildren(9032) == []
+        assert graph.getCircle(9032).name == 'Delivery'
+
+        # Built once per token for the same snapshot
+        graph = orgGraph.getOrgGraph(test_values.mock_glassfrogToken, snapshot)
+        assert graph is orgGraph.getOrgGraph(test_values.mock_glassfrogToken, snapshot)
+
+    def test_orgSnapshot(self):
+        org = org_generator.SyntheticOrg(depth=1, fanout=2, rolesPerCircle=2)
+        snapshots = {apiEndpoint: orgModels.OrgSnapshot(
+            apiEndpoint, json.loads(json.dumps(org.response(apiEndpoint)[1])))
+            for apiEndpoint in orgModels.snapshotEndpoints}
+        assert [circle.id for circle in snapshots['circles'].circles] == [
+            circle['id'] for circle in org.circles]
+        assert len(snapshots['roles'].roles) == len(org.roles)
+        assert len(snapshots['people'].people) == len(org.people)
+        assert not hasattr(snapshots['roles'].roles[0], '__dict__')
+        secretaries = [role for role in snapshots['roles'].roles if role.name == 'Secretary']
+        assert len(secretaries) == 3
+        assert secretaries[0].name is secretaries[1].name is secretaries[2].name
+
+        # The shared cache stores a snapshot as the payload it rebuilds it from
+        for apiEndpoint, snapshot in snapshots.items():
+            validators = {'etag': '"1"', 'lastModified': None, 'contentHash': 'abc'}
+            value = apiCalls.decodeResponse(apiCalls.encodeResponse((200, snapshot, validators)))
+            assert value == (200, snapshot, validators)
+        value = (404, {'message': 'Not found'}, None)
+        assert apiCalls.decodeResponse(apiCalls.encodeResponse(value)) == value
+        with self.assertRaises(ValueError):
+            orgModels.OrgSnapshot('circles/1', {'circles': []})
+
+    @mock.patch('glassfrog.apiCalls.GlassfrogApiHandler')
+    def test_getCircles_nested(self, mock_glassfrogApiHandler):
+        mock_glassfrogApiHandler.return_value.glassfrogApiCall.return_value = (
+            200, orgModels.OrgSnapshot('circles', test_values.mock_circles_response))
+        code, message = glassfrog.getCircles(test_values.mock_glassfrogToken)
+        assert ('<li><a href="https://app.glassfrog.com/circles/8495">The Hyve Company Circle</a>'
+                '<ul><li><a href="https://app.glassfrog.com/circles/9032">Delivery</a></li>'
+                '<li><a href="https://app.glassfrog.com/circles/15512">'
+                'Business Development & Sales</a></li></ul></li>') in message
+
+    def test_joinFragments(self):
+        fragments = ['<ul>', '<li>One</li>', '<li>Two<br /><ul><li>Three</li>', '</ul></li>',
+                     '</ul>']
+        assert rendering.joinFragments(iter(fragments)) == ''.join(fragments)
+        assert rendering.joinFragments(iter(fragments), suffix='!') == ''.join(fragments) + '!'
+
+        message = rendering.joinFragments(iter(fragments), maxLength=45, suffix='!',
+                                          truncatedMessage='...')
+        assert message == '<ul><li>One</li></ul>...!'
+
+        def fragmentsRendered():
+            for fragment in fragments:
+                rendered.append(fragment)
+                yield fragment
+        rendered = []
+        rendering.joinFragments(fragmentsRendered(), maxLength=20)
+        assert len(rendered) == 3
+
+    @mock.patch('glassfrog.apiCalls.GlassfrogApiHandler')
+    def test_getCircles_limits(self, mock_glassfrogApiHandler):
+        org = org_generator.SyntheticOrg(depth=4, fanout=4, rolesPerCircle=0, peoplePerRole=0)
+        mock_glassfrogApiHandler.return_value.glassfrogApiCall.side_effect = (
+            lambda apiEndpoint, glassfrogToken: org.apiCallResponse(apiEndpoint))
+
+        with mock.patch.dict(glassfrog.app.config, {'HIPCHAT_MESSAGE_LIMIT': 2000}):
+            code, message = glassfrog.getCircles(test_values.mock_glassfrogToken)
+        assert len(message) <= 2000
+        assert message.endswith(strings.message_truncated + strings.help_hipfrog_circle)
+        assert message.count('<ul>') == message.count('</ul>')
+        assert message.count('<li>') == message.count('</li>')
+
+        with mock.patch.dict(glassfrog.app.config, {'CIRCLE_TREE_MAX_DEPTH': 1}):
+            code, message = glassfrog.getCircles(test_values.mock_glassfrogToken)
+        assert message.count('https://app.glassfrog.com/circles/') == 1 + 4
+        assert message.count(strings.subcircles_not_listed.format(4)) == 4
+        assert strings.message_truncated not in message
+
+    def test_nameIndex(self):
+        def bruteForceMatch(entries, keyword):
+            closestDistance = 0
+            closestMatch = -999
+            for name, itemId in entries:
+                distance = Levenshtein.ratio(nameIndex.normalizeName(name),
+                                             nameIndex.normalizeName(keyword))
+                if distance > 0.5 and distance > closestDistance:
+                    closestDistance = distance
+                    closestMatch = itemId
+            return closestMatch
+
+        randomGenerator = random.Random(42)
+        syllables = ['lead', 'link', 'rep', 'sec', 'ret', 'ary', 'fac', 'ili', 'tat', 'or',
+                     'fin', 'ance', 'sal', 'es', ' ', '-', 'ops']
+        entries = [(''.join(randomGenerator.choice(syllables)
+                            for i in range(randomGenerator.randint(1, 6))), itemId)
+                   for itemId in range(300)]
+        index = nameIndex.NameIndex(entries)
+        keywords = [name for name, itemId in entries[:50]] + \
+            [''.join(randomGenerator.choice(syllables)
+                     for i in range(randomGenerator.randint(1, 6))) for j in range(300)]
+        for keyword in keywords:
+            assert index.match(keyword) == bruteForceMatch(entries, keyword), keyword
+
+        # The index is built once per snapshot
+        circles = orgModels.OrgSnapshot('circles', test_values.mock_circles_response).circles
+        assert messageFunctions.getMatchingCircle(circles, 'delivery') == 9032
+        assert nameIndex.getNameIndex('circles', circles, None) is \
+            nameIndex.getNameIndex('circles', circles, None)
+
     @mock.patch('glassfrog.apiCalls.GlassfrogApiHandler')
     def test_getIdForCircleIdentifier(self, mock_glassfrogApiHandler):
         mock_glassfrogApiHandler.return_value.glassfrogApiCall.return_value = (
-            200, test_values.mock_circles_response)
+            200, orgModels.OrgSnapshot('circles', test_values.mock_circles_response))
 
         # Test succesful match
         mock_circleIdentifier = "business-development"
@@ -277,8 +1160,18 @@ class GlassfrogTestCase(unittest.TestCase):
         # Succesfull call
         mock_glassfrogApiHandler.return_value.getCircleForCircleId.return_value = (
             200, test_values.mock_circle_circleId_response)
+        mock_glassfrogApiHandler.return_value.glassfrogApiCall.return_value = (
+            200, orgModels.OrgSnapshot('circles', test_values.mock_circles_response))
         rv = glassfrog.getCircleCircleId(test_values.mock_glassfrogToken, mock_circleId)
         assert mock_glassfrogApiHandler.return_value.getCircleForCircleId.called
+        assert 'Parent circle</a>' in rv[1]
+        mock_circles_response = dict(test_values.mock_circles_response, circles=(
+            test_values.mock_circles_response['circles'] +
+            [{'id': 8996, 'links': {}, 'short_name': 'R&D', 'strategy': None, 'name': 'R&D'}]))
+        mock_glassfrogApiHandler.return_value.glassfrogApiCall.return_value = (
+            200, orgModels.OrgSnapshot('circles', mock_circles_response))
+        rv = glassfrog.getCircleCircleId(test_values.mock_glassfrogToken, mock_circleId)
+        assert 'Parent circle - R&D</a>' in rv[1]
 
         for circle in test_values.mock_circle_circleId_response['circles']:
             assert circle['name'] in rv[1]
@@ -325,7 +1218,7 @@ class GlassfrogTestCase(unittest.TestCase):
     @mock.patch('glassfrog.apiCalls.GlassfrogApiHandler')
     def test_getIdForRoleIdentifier(self, mock_glassfrogApiHandler):
         mock_glassfrogApiHandler.return_value.glassfrogApiCall.return_value = (
-            200, test_values.mock_roles_response)
+            200, orgModels.OrgSnapshot('roles', test_values.mock_roles_response))
 
         # Test succesful match
         mock_roleIdentifier = "fullfil"
@@ -350,8 +1243,11 @@ class GlassfrogTestCase(unittest.TestCase):
     @mock.patch('glassfrog.getIdForCircleIdentifier')
     def test_getIdForRoleIdentifier_with_circle(self, mock_getIdForCircleIdentifier,
                                                 mock_glassfrogApiHandler):
-        mock_glassfrogApiHandler.return_value.glassfrogApiCall.return_value = (
-            200, test_values.mock_circle_roles_response)
+        def glassfrogApiCall(apiEndpoint, glassfrogToken):
+            if apiEndpoint == 'roles':
+                return 200, orgModels.OrgSnapshot('roles', test_values.mock_roles_response)
+            return 200, test_values.mock_circle_roles_response
+        mock_glassfrogApiHandler.return_value.glassfrogApiCall.side_effect = glassfrogApiCall
 
         # Test succesful match
         mock_roleIdentifier = "circlename:finance"
@@ -531,8 +1427,8 @@ class GlassfrogTestCase(unittest.TestCase):
         assert return_messageDict == mock_messageDict
 
     @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId')
-    @mock.patch('glassfrog.getCircleMembers')
-    def test_slash_circle_members(self, mock_getCircleMembers, mock_getInstallationFromOauthId):
+    def test_slash_circle_members(self, mock_getInstallationFromOauthId):
+        mock_getCircleMembers = mock.Mock()
         mock_messagedata = json.dumps(test_values.mock_messagedata('/circle 1000 members'))
 
         mock_color = strings.succes_color
@@ -545,15 +1441,16 @@ class GlassfrogTestCase(unittest.TestCase):
         mock_installation = self.defaultInstallation()
         mock_getInstallationFromOauthId.return_value = mock_installation
 
-        rv = self.app.post('/slashcircle', follow_redirects=True, data=mock_messagedata,
-                           headers=mock_headers)
+        with mock.patch.dict(glassfrog.circleSubcommands, {'members': mock_getCircleMembers}):
+            rv = self.app.post('/slashcircle', follow_redirects=True, data=mock_messagedata,
+                               headers=mock_headers)
         return_messageDict = json.loads(rv.get_data())
 
         assert return_messageDict == mock_messageDict
 
     @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId')
-    @mock.patch('glassfrog.getCircleRoles')
-    def test_slash_circle_roles(self, mock_getCircleRoles, mock_getInstallationFromOauthId):
+    def test_slash_circle_roles(self, mock_getInstallationFromOauthId):
+        mock_getCircleRoles = mock.Mock()
         mock_messagedata = json.dumps(test_values.mock_messagedata('/circle 1000 roles'))
 
         mock_color = strings.succes_color
@@ -566,8 +1463,9 @@ class GlassfrogTestCase(unittest.TestCase):
         mock_installation = self.defaultInstallation()
         mock_getInstallationFromOauthId.return_value = mock_installation
 
-        rv = self.app.post('/slashcircle', follow_redirects=True, data=mock_messagedata,
-                           headers=mock_headers)
+        with mock.patch.dict(glassfrog.circleSubcommands, {'roles': mock_getCircleRoles}):
+            rv = self.app.post('/slashcircle', follow_redirects=True, data=mock_messagedata,
+                               headers=mock_headers)
         return_messageDict = json.loads(rv.get_data())
 
         assert return_messageDict == mock_messageDict
@@ -651,13 +1549,31 @@ class GlassfrogTestCase(unittest.TestCase):
 
             assert return_messageDict == mock_messageDict
 
+    @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId')
+    def test_slash_role_help(self, mock_getInstallationFromOauthId):
+        mock_messagedata = json.dumps(test_values.mock_messagedata('/roles'))
+
+        mock_color = strings.succes_color
+        mock_message = strings.help_hipfrog_role
+        mock_messageDict = messageFunctions.createMessageDict(mock_color, mock_message)
+
+        mock_headers = test_values.mock_authorization_headers()
+        mock_installation = self.defaultInstallation()
+        mock_getInstallationFromOauthId.return_value = mock_installation
+
+        rv = self.app.post('/slashrole', follow_redirects=True, data=mock_messagedata,
+                           headers=mock_headers)
+        return_messageDict = json.loads(rv.get_data())
+
+        assert return_messageDict == mock_messageDict
+
     @mock.patch('glassfrog.apiCalls.GlassfrogApiHandler')
     @mock.patch('glassfrog.apiCalls.HipchatApiHandler')
     def test_getMentionsForRole(self, mock_HipchatApiHandler, mock_glassfrogApiHandler):
         mock_roleId = test_values.mock_role_roleid_response['roles'][0]['id']
         mock_installation = self.defaultInstallation()
-        mock_HipchatApiHandler.return_value.getRoomMembers.return_value = \
-            200, test_values.mock_room_members_response
+        mock_HipchatApiHandler.return_value.getRoomMentionNames.return_value = \
+            200, test_values.mock_room_mention_names
 
         # Succesfull call
         mock_glassfrogApiHandler.return_value.glassfrogApiCall.return_value = (
@@ -675,25 +1591,80 @@ class GlassfrogTestCase(unittest.TestCase):
     def test_getMentionsForCircle(self, mock_HipchatApiHandler, mock_glassfrogApiHandler):
         mock_circleId = 1000
         mock_installation = self.defaultInstallation()
-        mock_HipchatApiHandler.return_value.getRoomMembers.return_value = \
-            200, test_values.mock_room_members_response
+        mock_HipchatApiHandler.return_value.getRoomMentionNames.return_value = \
+            200, test_values.mock_room_mention_names
 
         # Succesfull call
-        mock_glassfrogApiHandler.return_value.glassfrogApiCall.return_value = (
-            200, test_values.mock_circle_members_response)
+        def glassfrogApiCall(apiEndpoint, glassfrogToken):
+            if apiEndpoint == 'circles':
+                return 200, orgModels.OrgSnapshot('circles', test_values.mock_circles_response)
+            return 200, test_values.mock_circle_members_response
+        mock_glassfrogApiHandler.return_value.glassfrogApiCall.side_effect = glassfrogApiCall
         mock_glassfrogApiHandler.return_value.getCircleForCircleId.return_value = (
             200, test_values.mock_circle_circleId_response)
 
         rv = glassfrog.getMentionsForCircle(mock_installation, mock_circleId)
-        assert mock_glassfrogApiHandler.return_value.glassfrogApiCall.called
+        mock_glassfrogApiHandler.return_value.glassfrogApiCall.assert_any_call(
+            'circles/{}/people'.format(mock_circleId), mock_installation.glassfrogToken)
+        assert mock_glassfrogApiHandler.return_value.getCircleForCircleId.called
 
         for person in test_values.mock_circle_members_response['people']:
             for room_member in test_values.mock_room_members_response['items']:
                 if person['name'] == room_member['name']:
                     assert room_member['mention_name'] in rv[1]
 
+        # Circles of the organization take their name from its (cached) circles
+        mock_glassfrogApiHandler.return_value.getCircleForCircleId.reset_mock()
+        rv = glassfrog.getMentionsForCircle(mock_installation, 9032)
+        assert not mock_glassfrogApiHandler.return_value.getCircleForCircleId.called
+        assert rv[1].startswith('Delivery: ')
+
+        # Without the circles of the organization the details name the circle
+        mock_glassfrogApiHandler.return_value.glassfrogApiCall.side_effect = \
+            lambda apiEndpoint, glassfrogToken: (
+                (503, {'message': strings.glassfrog_unavailable}) if apiEndpoint == 'circles'
+                else (200, test_values.mock_circle_members_response))
+        rv = glassfrog.getMentionsForCircle(mock_installation, 9032)
+        assert mock_glassfrogApiHandler.return_value.getCircleForCircleId.called
+        assert rv[0] == 200
+
+    @mock.patch('glassfrog.apiCalls.GlassfrogApiHandler')
+    @mock.patch('glassfrog.apiCalls.HipchatApiHandler')
+    def test_getMentions_concurrent(self, mock_HipchatApiHandler, mock_glassfrogApiHandler):
+        mock_installation = self.defaultInstallation()
+
+        def slowly(result):
+            def call(*args, **kwargs):
+                time.sleep(0.3)
+                return result
+            return call
+
+        mock_HipchatApiHandler.return_value.getRoomMentionNames.side_effect = slowly(
+            (200, test_values.mock_room_mention_names))
+        mock_glassfrogApiHandler.return_value.getCircleForCircleId.side_effect = slowly(
+            (200, test_values.mock_circle_circleId_response))
+        circlesCall = slowly(
+            (200, orgModels.OrgSnapshot('circles', test_values.mock_circles_response)))
+        membersCall = slowly((200, test_values.mock_circle_members_response))
+        mock_glassfrogApiHandler.return_value.glassfrogApiCall.side_effect = \
+            lambda apiEndpoint, glassfrogToken: (
+                circlesCall() if apiEndpoint == 'circles' else membersCall())
+
+        # Three upstream calls take about as long as the slowest one
+        startTime = time.time()
+        code, message = glassfrog.getMentionsForCircle(mock_installation, 9032)
+        assert time.time() - startTime < 0.6
+        assert code == 200 and '@WardWeistra' in message
+
+        mock_glassfrogApiHandler.return_value.glassfrogApiCall.side_effect = slowly(
+            (200, test_values.mock_role_roleid_response))
+        startTime = time.time()
+        code, message = glassfrog.getMentionsForRole(mock_installation, 1000)
+        assert time.time() - startTime < 0.5
+        assert code == 200
+
     @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId')
-    @mock.patch('glassfrog.getMentionsForRole')
+    @mock.patch('glassfrog.getMentionsForRoles')
     def test_atRole(self, mock_getMentionsForRole, mock_getInstallationFromOauthId):
         mock_roleId = test_values.mock_role_roleid_response['roles'][0]['id']
         mock_command = 'Beste @Role {}: Hoi!'.format(mock_roleId)
@@ -718,7 +1689,7 @@ class GlassfrogTestCase(unittest.TestCase):
         assert return_messageDict == mock_messageDict
 
     @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId')
-    @mock.patch('glassfrog.getMentionsForRole')
+    @mock.patch('glassfrog.getMentionsForRoles')
     @mock.patch('glassfrog.getIdForRoleIdentifier')
     def test_atRole_string(self, mock_getIdForRoleIdentifier,
                            mock_getMentionsForRole,
@@ -750,7 +1721,36 @@ class GlassfrogTestCase(unittest.TestCase):
         assert return_messageDict == mock_messageDict
 
     @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId')
-    @mock.patch('glassfrog.getMentionsForCircle')
+    @mock.patch('glassfrog.apiCalls.GlassfrogApiHandler')
+    @mock.patch('glassfrog.apiCalls.HipchatApiHandler')
+    def test_atRole_multiple(self, mock_HipchatApiHandler, mock_glassfrogApiHandler,
+                             mock_getInstallationFromOauthId):
+        secretary_response = dict(test_values.mock_role_roleid_response)
+        secretary_response['roles'] = [dict(secretary_response['roles'][0], name='Secretary')]
+        secretary_response['linked'] = dict(secretary_response['linked'], people=[
+            {'id': 1, 'name': 'Ward Weistra'}, {'id': 811765527, 'name': 'Henk de Vries'}])
+        responses = {'roles/1000': (200, test_values.mock_role_roleid_response),
+                     'roles/2000': (200, secretary_response)}
+        mock_glassfrogApiHandler.return_value.glassfrogApiCall.side_effect = (
+            lambda apiEndpoint, glassfrogToken: responses[apiEndpoint])
+        mock_HipchatApiHandler.return_value.getRoomMentionNames.return_value = \
+            200, test_values.mock_room_mention_names
+        mock_getInstallationFromOauthId.return_value = self.defaultInstallation()
+
+        mock_command = '@role 1000 @Role 2000 and again @role 1000'
+        mock_messagedata = json.dumps(test_values.mock_messagedata(mock_command))
+        rv = self.app.post('/atrole', data=mock_messagedata,
+                           headers=test_values.mock_authorization_headers())
+
+        # One /cc line, every role and the room fetched once, every person mentioned once
+        assert json.loads(rv.get_data())['message'] == (
+            '@WardWeistra said: ' + mock_command + ' /cc Fulfillment Role in Operations, '
+            'Secretary in Operations: @HenkdeVries, @WardWeistra')
+        assert mock_glassfrogApiHandler.return_value.glassfrogApiCall.call_count == 2
+        assert mock_HipchatApiHandler.return_value.getRoomMentionNames.call_count == 1
+
+    @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId')
+    @mock.patch('glassfrog.getMentionsForCircles')
     def test_atCircle(self, mock_getMentionsForCircle, mock_getInstallationFromOauthId):
         mock_circleId = 1000
         mock_command = 'Beste @Circle {}: Hoi!'.format(mock_circleId)
@@ -775,7 +1775,7 @@ class GlassfrogTestCase(unittest.TestCase):
         assert return_messageDict == mock_messageDict
 
     @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId')
-    @mock.patch('glassfrog.getMentionsForCircle')
+    @mock.patch('glassfrog.getMentionsForCircles')
     @mock.patch('glassfrog.getIdForCircleIdentifier')
     def test_atCircle_string(self, mock_getIdForCircleIdentifier,
                              mock_getMentionsForCircle,
@@ -805,6 +1805,208 @@ class GlassfrogTestCase(unittest.TestCase):
 
         assert return_messageDict == mock_messageDict
 
+    @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId')
+    @mock.patch('glassfrog.getMentionsForRoles')
+    @mock.patch('glassfrog.getIdForRoleIdentifier')
+    def test_atRole_deferred(self, mock_getIdForRoleIdentifier, mock_getMentionsForRole,
+                             mock_getInstallationFromOauthId):
+        hipchatServer = stub_servers.StubServer(stub_servers.hipchatRoutes()).start()
+        self.addCleanup(hipchatServer.stop)
+        mock_installation = self.defaultInstallation()
+        mock_installation.hipchatApiProvider_url = hipchatServer.url
+        mock_getInstallationFromOauthId.return_value = mock_installation
+
+        mock_roleId = 1000
+        mock_getIdForRoleIdentifier.return_value = (True, mock_roleId, '')
+
+        def slowMentions(installation, roleIds):
+            time.sleep(0.5)
+            apiCalls.getRequestMemo().countUpstream()
+            return 200, test_values.mock_atrole_mentions.format(roleIds[0])
+        mock_getMentionsForRole.side_effect = slowMentions
+
+        mock_command = 'Beste @Role {}: Hoi!'.format(mock_roleId)
+        mock_messagedata = json.dumps(test_values.mock_messagedata(mock_command))
+        mock_headers = test_values.mock_authorization_headers()
+
+        requestsBefore = dict(apiCalls.requestMemoStats)
+        with mock.patch.dict(glassfrog.app.config, {'ASYNC_WEBHOOK_ROUTES': ['atrole'],
+                                                    'ASYNC_WEBHOOK_BUDGET': 0.05,
+                                                    'CACHE_STATS_ENABLED': True}):
+            # The webhook is acknowledged before the mentions are resolved
+            rv = self.app.post('/atrole', data=mock_messagedata, headers=mock_headers)
+            assert rv.status_code == 204
+            # The upstream calls are counted once the deferred answer is ready
+            assert rv.headers['X-Glassfrog-Upstream-Calls'] == '0+'
+            assert apiCalls.requestMemoStats['requests'] == requestsBefore['requests']
+
+            notifications = hipchatServer.waitForRequests(
+                'POST', '/room/{}/notification'.format(mock_installation.roomId))
+            assert len(notifications) == 1
+            assert apiCalls.requestMemoStats['requests'] == requestsBefore['requests'] + 1
+            assert apiCalls.requestMemoStats['upstreamCalls'] == \
+                requestsBefore['upstreamCalls'] + 1
+            assert stub_servers.notificationData(notifications[0]) == {
+                'color': strings.succes_color,
+                'message': test_values.mock_atrole_message.format(mock_roleId),
+                'notify': 'False',
+                'message_format': 'text'}
+            assert notifications[0]['headers']['Authorization'] == \
+                'Bearer ' + mock_installation.access_token
+
+            # Answers within the budget are still returned directly
+            mock_getMentionsForRole.side_effect = None
+            mock_getMentionsForRole.return_value = (
+                200, test_values.mock_atrole_mentions.format(mock_roleId))
+            with mock.patch.dict(glassfrog.app.config, {'ASYNC_WEBHOOK_BUDGET': 5}):
+                rv = self.app.post('/atrole', data=mock_messagedata, headers=mock_headers)
+            assert json.loads(rv.get_data())['message'] == \
+                test_values.mock_atrole_message.format(mock_roleId)
+
+    @mock.patch('glassfrog.functions.messageFunctions.getInstallationFromOauthId')
+    @mock.patch('glassfrog.getMentionsForCircles')
+    def test_consolidatedWebhook(self, mock_getMentionsForCircles,
+                                 mock_getInstallationFromOauthId):
+        capabilitiesDict = apiCalls.getCapabilitiesDict('https://hipfrog', True)
+        messageWebhooks = [webhook for webhook in capabilitiesDict['capabilities']['webhook']
+                           if webhook['event'] == 'room_message']
+        assert [webhook['url'] for webhook in messageWebhooks] == ['https://hipfrog/command']
+        for message in ['/hipfrog', '/Roles x', '/circle', 'Hi @role x', '@Circles']:
+            assert re.search(messageWebhooks[0]['pattern'], message)
+        assert not re.search(messageWebhooks[0]['pattern'], 'Hi /role x @rolex')
+
+        hipchatServer = stub_servers.StubServer(stub_servers.hipchatRoutes()).start()
+        self.addCleanup(hipchatServer.stop)
+        mock_installation = self.defaultInstallation()
+        mock_installation.hipchatApiProvider_url = hipchatServer.url
+        mock_getInstallationFromOauthId.return_value = mock_installation
+        mock_getMentionsForCircles.return_value = (
+            200, test_values.mock_atcircle_mentions.format(1000))
+        mock_headers = test_values.mock_authorization_headers()
+
+        # A single command is answered like its own webhook would
+        mock_command = 'Beste @Circle 1000: Hoi!'
+        rv = self.app.post('/command', headers=mock_headers,
+                           data=json.dumps(test_values.mock_messagedata(mock_command)))
+        assert json.loads(rv.get_data())['message'] == \
+            test_values.mock_atcircle_message.format(1000, 1000)
+
+        # Several commands in one message are all answered, in the room
+        mock_command = '/hipfrog @circle 1000'
+        rv = self.app.post('/command', headers=mock_headers,
+                           data=json.dumps(test_values.mock_messagedata(mock_command)))
+        assert rv.status_code == 204
+        notifications = hipchatServer.waitForRequests(
+            'POST', '/room/{}/notification'.format(mock_installation.roomId), count=2)
+        assert [stub_servers.notificationData(notification)['message']
+                for notification in notifications] == [
+            strings.missing_functionality.format('@circle'),
+            '@WardWeistra said: /hipfrog @circle 1000 /cc ' +
+            test_values.mock_atcircle_mentions.format(1000)]
+        mock_getMentionsForCircles.assert_called_with(mock_installation, ['1000'])
+
+    def test_notificationQueue(self):
+        responses = [(429, None, {'Retry-After': '30'})]
+
+        def notify(match, request):
+            return responses.pop(0) if responses else (204, None)
+        hipchatServer = stub_servers.StubServer({
+            ('POST', r'/room/\d+/notification'): notify}).start()
+        self.addCleanup(hipchatServer.stop)
+        installation = self.defaultInstallation()
+        installation.hipchatApiProvider_url = hipchatServer.url
+        self.addInstallation(installation)
+        outboundQueue = notificationQueue.NotificationQueue(glassfrog.app)
+        outboundQueue.configure(dict(glassfrog.app.config, NOTIFICATION_COALESCE_WINDOW=1,
+                                     NOTIFICATION_RETRY_DELAY=5, NOTIFICATION_POLL_INTERVAL=60))
+
+        with glassfrog.app.app_context():
+            with mock.patch.dict(glassfrog.app.config, {'NOTIFICATION_QUEUE_ENABLED': True}), \
+                    mock.patch.object(glassfrog, 'outboundQueue', outboundQueue), \
+                    mock.patch('time.time', return_value=1000):
+                glassfrog.sendRoomMessage(color='green', message='one', installation=installation)
+            outboundQueue.enqueue(installation, 'green', 'two', now=1000.5)
+            outboundQueue.enqueue(installation, 'red', 'three', now=1000.5)
+
+            # Nothing goes out within the coalescing window
+            assert outboundQueue.sendDue(1000.5) == 1001
+            assert hipchatServer.requests == []
+
+            # Rate limited: the room waits for the Retry-After
+            outboundQueue.sendDue(1001)
+            assert [stub_servers.notificationData(notification)['message']
+                    for notification in hipchatServer.requests] == ['one<br/>two']
+            assert outboundQueue.sendDue(1010) >= 1031
+            assert len(hipchatServer.requests) == 1
+            stats = outboundQueue.stats()
+            assert (stats['depth'], stats['rateLimited'], stats['rateLimitedTokens']) == (3, 1, 0)
+
+            outboundQueue.sendDue(1032)
+            assert [stub_servers.notificationData(notification)['message']
+                    for notification in hipchatServer.requests[1:]] == ['one<br/>two', 'three']
+            stats = outboundQueue.stats()
+            assert (stats['depth'], stats['queued'], stats['sent'], stats['coalesced']) == \
+                (0, 3, 2, 1)
+            assert stats['latency']['max'] >= 31
+
+            # A failing send is retried later, a rejected one dropped
+            responses[:] = [(500, None), (400, None)]
+            outboundQueue.enqueue(installation, 'green', 'four', now=2000)
+            outboundQueue.sendDue(2001)
+            assert 2006 <= outboundQueue.sendDue(2002) < 2007
+            outboundQueue.sendDue(2007)
+            stats = outboundQueue.stats()
+            assert (stats['depth'], stats['retried'], stats['failed']) == (0, 1, 1)
+            assert len(hipchatServer.requests) == 5
+
+    def test_benchmark_webhooks(self):
+        with mock.patch.dict(glassfrog.app.config), \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+            benchmark_webhooks.main(['--requests', '2'])
+        report = mock_stdout.getvalue().splitlines()
+        assert len(report) == len(benchmark_webhooks.scenarios) + 1
+        assert 'p99 ms' in report[0]
+
+    @mock.patch('glassfrog.apiCalls.GlassfrogApiHandler')
+    def test_syntheticOrg(self, mock_glassfrogApiHandler):
+        org = org_generator.SyntheticOrg(depth=2, fanout=3, rolesPerCircle=5, peoplePerRole=2,
+                                         people=50, nameCollisions=0.5)
+        assert len(org.circles) == 1 + 3 + 9
+        assert len(org.roles) == len(org.circles) * (1 + 4 + 5)
+        assert org.response('roles/1') == (404, {'message': 'Not found'})
+        mock_glassfrogApiHandler.return_value.glassfrogApiCall.side_effect = (
+            lambda apiEndpoint, glassfrogToken: org.apiCallResponse(apiEndpoint))
+
+        code, message = glassfrog.getCircles(test_values.mock_glassfrogToken)
+        assert code == 200
+        assert message.count('https://app.glassfrog.com/circles/') == len(org.circles)
+
+        anchorCircle = org.circles[0]
+        code, message = glassfrog.getCircleRoles(test_values.mock_glassfrogToken,
+                                                 anchorCircle['id'])
+        assert code == 200
+        subcircles = [circle for circle in org.circles
+                      if org.supportedRole(circle['id'])['links']['circle'] == anchorCircle['id']]
+        assert len(subcircles) == 3
+        for subcircle in subcircles:
+            assert subcircle['name'] in message
+
+        role = [role for role in org.circleRoles(org.circles[1]['id'])
+                if role['links']['supporting_circle'] is None][-1]
+        success, roleId, message = glassfrog.getIdForRoleIdentifier(
+            test_values.mock_glassfrogToken,
+            '{}:{}'.format(org.circles[1]['name'].replace(' ', '-'), role['name']))
+        assert success
+        assert org.rolesById[roleId]['name'] == role['name']
+
+    def test_benchmark_webhooks_syntheticOrg(self):
+        with mock.patch.dict(glassfrog.app.config), \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as mock_stdout:
+            benchmark_webhooks.main(['--requests', '1', '--org-depth', '1', '--org-fanout', '2'])
+        report = mock_stdout.getvalue().splitlines()
+        assert report[0].startswith('Synthetic organization: 3 circles')
+        assert len(report) == len(benchmark_webhooks.scenarios) + 2
+
 
 if __name__ == '__main__':
     unittest.main()
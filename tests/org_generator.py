@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# Generates realistic GlassFrog API v3 payloads for large synthetic organizations
+import random
+import re
+
+from glassfrog.functions import orgModels
+
+coreRoleNames = ['Lead Link', 'Rep Link', 'Facilitator', 'Secretary']
+roleWords = ['Product', 'Marketing', 'Finance', 'Hiring', 'Sales', 'Support', 'Data', 'Security',
+             'Release', 'Design', 'Community', 'Quality', 'Platform', 'Events', 'Legal', 'Office',
+             'Partner', 'Research', 'Training', 'Infrastructure', 'Content', 'Billing']
+roleSuffixes = ['Owner', 'Steward', 'Coordinator', 'Champion', 'Lead', 'Keeper', 'Architect',
+                'Manager', 'Advocate', 'Planner']
+circleSuffixes = ['Circle', 'Team', 'Guild', 'Unit', 'Group']
+firstNames = ['Anna', 'Bram', 'Carlos', 'Daan', 'Eva', 'Femke', 'Henk', 'Ines', 'Joost', 'Kim',
+              'Lotte', 'Maarten', 'Noor', 'Olaf', 'Pieter', 'Roos', 'Sanne', 'Tim', 'Ward', 'Yara']
+lastNames = ['de Vries', 'Jansen', 'Bakker', 'Visser', 'Smit', 'Meijer', 'de Boer', 'Mulder',
+             'de Groot', 'Bos', 'Vos', 'Peters', 'Hendriks', 'van Leeuwen', 'Dekker', 'Brouwer']
+
+
+class SyntheticOrg(object):
+    def __init__(self, depth=3, fanout=4, rolesPerCircle=6, peoplePerRole=2, people=200,
+                 nameCollisions=0.2, seed=0):
+        # depth: levels of subcircles below the anchor circle
+        # fanout: subcircles per circle
+        # rolesPerCircle: custom roles per circle, on top of the four core roles
+        # nameCollisions: chance that a custom role reuses a name from elsewhere in the org
+        self.random = random.Random(seed)
+        self.nextId = 1000
+        self.circles = []
+        self.roles = []
+        self.people = []
+        self.domains = {}
+        self.accountabilities = {}
+        self.circlesById = {}
+        self.rolesById = {}
+        self.peopleById = {}
+
+        usedNames = set()
+        for i in range(people):
+            name = '{} {}'.format(self.random.choice(firstNames), self.random.choice(lastNames))
+            if name in usedNames:
+                name += ' {}'.format(i)
+            usedNames.add(name)
+            person = {'id': self.newId(), 'name': name, 'external_id': None,
+                      'email': '{}@example.org'.format(name.lower().replace(' ', '.')),
+                      'links': {'circles': []}}
+            self.people += [person]
+            self.peopleById[person['id']] = person
+
+        self.peoplePerRole = peoplePerRole
+        self.rolesPerCircle = rolesPerCircle
+        self.nameCollisions = nameCollisions
+        self.roleNames = []
+        self.addCircle('Anchor Circle', None, depth, fanout)
+
+    def newId(self):
+        self.nextId += self.random.randint(1, 9)
+        return self.nextId
+
+    def newRoleName(self):
+        if self.roleNames and self.random.random() < self.nameCollisions:
+            return self.random.choice(self.roleNames)
+        name = '{} {}'.format(self.random.choice(roleWords), self.random.choice(roleSuffixes))
+        self.roleNames += [name]
+        return name
+
+    def addRole(self, name, circleId, supportingCircleId=None):
+        people = self.random.sample(self.people, min(self.peoplePerRole, len(self.people)))
+        domain = {'id': self.newId(), 'description': '{} decisions'.format(name)}
+        accountabilities = [{'id': self.newId(), 'description': '{} for {}'.format(verb, name)}
+                            for verb in ['Planning', 'Reporting', 'Improving'][
+                                :self.random.randint(1, 3)]]
+        self.domains[domain['id']] = domain
+        for accountability in accountabilities:
+            self.accountabilities[accountability['id']] = accountability
+        role = {'id': self.newId(), 'name': name,
+                'purpose': 'Enable {}'.format(name.lower()),
+                'links': {'circle': circleId,
+                          'supporting_circle': supportingCircleId,
+                          'people': [person['id'] for person in people],
+                          'domains': [domain['id']],
+                          'accountabilities': [accountability['id']
+                                               for accountability in accountabilities]}}
+        self.roles += [role]
+        self.rolesById[role['id']] = role
+        for person in people:
+            if circleId is not None and circleId not in person['links']['circles']:
+                person['links']['circles'] += [circleId]
+        return role
+
+    def addCircle(self, name, parentId, depth, fanout):
+        circleId = self.newId()
+        circle = {'id': circleId, 'name': name, 'short_name': name.split(' ')[0],
+                  'strategy': None,
+                  'links': {'roles': [], 'domain': [], 'policies': [], 'supported_role': None}}
+        self.circles += [circle]
+        self.circlesById[circleId] = circle
+
+        supportedRole = self.addRole(name, parentId, circleId)
+        circle['links']['supported_role'] = supportedRole['id']
+        circle['links']['domain'] = supportedRole['links']['domains']
+        if parentId is not None:
+            self.circlesById[parentId]['links']['roles'] += [supportedRole['id']]
+
+        for roleName in coreRoleNames:
+            circle['links']['roles'] += [self.addRole(roleName, circleId)['id']]
+        for i in range(self.rolesPerCircle):
+            circle['links']['roles'] += [self.addRole(self.newRoleName(), circleId)['id']]
+
+        if depth > 0:
+            for i in range(fanout):
+                subcircleName = '{} {}'.format(self.newRoleName().split(' ')[0],
+                                               self.random.choice(circleSuffixes))
+                if any(other['name'] == subcircleName for other in self.circles):
+                    subcircleName += ' {}'.format(len(self.circles))
+                self.addCircle(subcircleName, circleId, depth - 1, fanout)
+        return circle
+
+    def supportedRole(self, circleId):
+        return self.rolesById[self.circlesById[circleId]['links']['supported_role']]
+
+    def circleRoles(self, circleId):
+        return [self.rolesById[roleId] for roleId in self.circlesById[circleId]['links']['roles']]
+
+    def circlePeople(self, circleId):
+        peopleIds = []
+        for role in self.circleRoles(circleId):
+            for personId in role['links']['people']:
+                if personId not in peopleIds:
+                    peopleIds += [personId]
+        return [self.peopleById[personId] for personId in peopleIds]
+
+    def linkedFor(self, roles):
+        domains = []
+        accountabilities = []
+        people = []
+        for role in roles:
+            domains += [self.domains[domainId] for domainId in role['links']['domains']]
+            accountabilities += [self.accountabilities[accountabilityId]
+                                 for accountabilityId in role['links']['accountabilities']]
+            people += [self.peopleById[personId] for personId in role['links']['people']
+                       if self.peopleById[personId] not in people]
+        return domains, accountabilities, people
+
+    def response(self, apiEndpoint):
+        # Returns (code, responsebody) as GlassFrog would for the endpoint
+        if apiEndpoint == 'circles':
+            return 200, {'circles': self.circles,
+                         'linked': {'roles': [], 'domains': [], 'policies': [],
+                                    'supported_roles': [self.supportedRole(circle['id'])
+                                                        for circle in self.circles]}}
+        if apiEndpoint == 'roles':
+            return 200, {'roles': self.roles,
+                         'linked': {'circles': [], 'accountabilities': [], 'people': [],
+                                    'domains': []}}
+        if apiEndpoint == 'people':
+            return 200, {'people': self.people}
+
+        match = re.fullmatch(r'(circles|roles)/(\d+)(?:/(people|roles))?', apiEndpoint)
+        if match is None:
+            return 404, {'message': 'Not found'}
+        kind, itemId, subresource = match.group(1), int(match.group(2)), match.group(3)
+
+        if kind == 'circles' and itemId in self.circlesById:
+            if subresource == 'people':
+                return 200, {'people': self.circlePeople(itemId)}
+            if subresource == 'roles':
+                roles = self.circleRoles(itemId)
+                domains, accountabilities, people = self.linkedFor(roles)
+                return 200, {'roles': roles,
+                             'linked': {'domains': domains, 'accountabilities': accountabilities,
+                                        'people': people, 'circles': []}}
+            supportedRole = self.supportedRole(itemId)
+            domains, accountabilities, people = self.linkedFor([supportedRole])
+            return 200, {'circles': [self.circlesById[itemId]],
+                         'linked': {'supported_roles': [supportedRole], 'domains': domains,
+                                    'policies': [], 'roles': []}}
+        if kind == 'roles' and itemId in self.rolesById and subresource is None:
+            role = self.rolesById[itemId]
+            domains, accountabilities, people = self.linkedFor([role])
+            circleId = role['links']['circle'] or role['links']['supporting_circle']
+            return 200, {'roles': [role],
+                         'linked': {'domains': domains, 'accountabilities': accountabilities,
+                                    'people': people,
+                                    'circles': [self.circlesById[circleId]]}}
+        return 404, {'message': 'Not found'}
+
+    def apiCallResponse(self, apiEndpoint):
+        # Returns (code, responsebody) as GlassfrogApiHandler.glassfrogApiCall would
+        code, responsebody = self.response(apiEndpoint)
+        if code == 200 and apiEndpoint in orgModels.snapshotEndpoints:
+            responsebody = orgModels.OrgSnapshot(apiEndpoint, responsebody)
+        return code, responsebody
+
+    def routes(self, prefix='/api/v3/'):
+        # Routes for stub_servers.StubServer
+        def respond(match, request):
+            return self.response(match.group(1))
+        return {('GET', re.escape(prefix) + r'(.+)'): respond}
+
+    def scenarios(self):
+        # (route, message) pairs that resolve against this organization
+        circle = self.circles[min(1, len(self.circles) - 1)]
+        role = [role for role in self.circleRoles(circle['id'])
+                if role['links']['supporting_circle'] is None][-1]
+        circleName = circle['name'].lower().replace(' ', '-')
+        roleName = role['name'].lower().replace(' ', '-')
+        return [
+            ('/hipfrog', '/hipfrog'),
+            ('/slashcircle', '/circle'),
+            ('/slashcircle', '/circle {}'.format(circleName)),
+            ('/slashcircle', '/circle {} members'.format(circleName)),
+            ('/slashcircle', '/circle {} roles'.format(circleName)),
+            ('/slashrole', '/role {}'.format(roleName)),
+            ('/atrole', 'Hi @role {}:{}, how are you?'.format(circleName, roleName)),
+            ('/atcircle', 'Hi @circle {}, how are you?'.format(circleName)),
+        ]
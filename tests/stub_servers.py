@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Local stand-ins for the HipChat and GlassFrog APIs, serving canned JSON over real HTTP
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import test_values
+
+
+class StubServer(object):
+    def __init__(self, routes=None, latency=0):
+        # routes: {(method, path regex): (status, body)
+        #          or callable(match, request) -> (status, body)}
+        # bodies are sent as JSON, bytes as they are. (status, body, headers) adds headers.
+        self.routes = dict(routes or {})
+        self.latency = latency
+        self.requests = []
+        self.requestsLock = threading.Condition()
+        self.httpServer = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.httpServer.server_address[:2])
+
+    def addRoute(self, method, pathPattern, response):
+        self.routes[(method, pathPattern)] = response
+
+    def start(self):
+        stubServer = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def handle_method(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                request = {'method': method, 'path': self.path,
+                           'headers': dict(self.headers), 'body': body}
+                if stubServer.latency:
+                    time.sleep(stubServer.latency)
+                status, responsebody, *responseheaders = stubServer.respond(request)
+                with stubServer.requestsLock:
+                    stubServer.requests += [request]
+                    stubServer.requestsLock.notify_all()
+                if responsebody is None:
+                    data = b''
+                elif isinstance(responsebody, bytes):
+                    data = responsebody
+                else:
+                    data = json.dumps(responsebody).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for header, value in (responseheaders[0] if responseheaders else {}).items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.handle_method('GET')
+
+            def do_POST(self):
+                self.handle_method('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpServer = ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+        self.httpServer.daemon_threads = True
+        threading.Thread(target=self.httpServer.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+
+    def respond(self, request):
+        path = request['path'].split('?')[0]
+        for (method, pathPattern), response in self.routes.items():
+            match = re.fullmatch(pathPattern, path)
+            if method == request['method'] and match:
+                if callable(response):
+                    return response(match, request)
+                return response
+        return 404, {'message': 'Not found'}
+
+    def waitForRequests(self, method, pathPattern, count=1, timeout=5):
+        def matching():
+            return [request for request in self.requests
+                    if request['method'] == method and re.fullmatch(pathPattern, request['path'])]
+
+        with self.requestsLock:
+            self.requestsLock.wait_for(lambda: len(matching()) >= count, timeout=timeout)
+            return matching()
+
+
+def notificationData(request):
+    return {key: values[0] for key, values in parse_qs(request['body'].decode('utf-8')).items()}
+
+
+def hipchatRoutes(room_response=None, room_members_response=None):
+    room_response = room_response or test_values.mock_room_response
+    room_members_response = room_members_response or test_values.mock_room_members_response
+    return {
+        ('GET', r'/room/\d+'): (200, room_response),
+        ('GET', r'/room/\d+/(participant|member)'): (200, room_members_response),
+        ('POST', r'/room/\d+/notification'): (204, None),
+    }
+
+
+def glassfrogRoutes(prefix='/api/v3/'):
+    return {
+        ('GET', prefix + 'circles'): (200, test_values.mock_circles_response),
+        ('GET', prefix + r'circles/\d+'): (200, test_values.mock_circle_circleId_response),
+        ('GET', prefix + r'circles/\d+/people'): (200, test_values.mock_circle_members_response),
+        ('GET', prefix + r'circles/\d+/roles'): (200, test_values.mock_circle_roles_response),
+        ('GET', prefix + 'roles'): (200, test_values.mock_roles_response),
+        ('GET', prefix + r'roles/\d+'): (200, test_values.mock_role_roleid_response),
+    }
@@ -1,3 +1,7 @@
+import time
+import jwt
+
+
 mock_installdata = {
     "oauthId": "f3100c47-9936-40e8-a8aa-12314e8da8f0",
     "capabilitiesUrl": "https://api.hipchat.com/v2/capabilities",
@@ -92,10 +96,19 @@ mock_tokenData = {
 mock_glassfrogToken = '172aa12c195cf90cf6bcg856523111c0ceec4eab'
 
 
-def mock_authorization_headers(jwt_token='banana'):
+def mock_authorization_headers(jwt_token=None):
+    if jwt_token is None:
+        jwt_token = mock_jwt_encoded(int(time.time())+1000)
     return {'Authorization': 'JWT ' + jwt_token}
 
 
+def mock_jwt_encoded(time, secret=mock_installdata['oauthSecret']):
+    jwt_token = jwt.encode(mock_jwt_decoded(time), secret, algorithm='HS256')
+    if isinstance(jwt_token, bytes):
+        jwt_token = jwt_token.decode('utf-8')
+    return jwt_token
+
+
 def mock_jwt_data(signed_request):
     return {'xdmhost': 'https://transmart.hipchat.com', 'signed_request': signed_request}
 
@@ -150,7 +163,7 @@ def mock_messagedata(message):
                 "version": "0XLIKALD"
             }
         },
-        "oauth_client_id": "ed8bb9f0-02d8-426b-9226-0d50fdcd47ea",
+        "oauth_client_id": mock_installdata['oauthId'],
         "webhook_id": 4965523
     }
 
@@ -650,6 +663,11 @@ mock_room_members_response = {
     "startIndex": 0
 }
 
+mock_room_mention_names = {
+    "Henk de Vries": "HenkdeVries",
+    "Ward Weistra": "WardWeistra"
+}
+
 mock_atrole_mentions = '''Fulfillment Role (/role {0}) - @HenkdeVries'''
 mock_atrole_message = ('@WardWeistra said: Beste @Role {0}: Hoi! /cc '
                        'Fulfillment Role (/role {0}) - @HenkdeVries')